@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+
+# This file is part of pyteensy.
+#
+# pyteensy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# pyteensy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with pyteensy.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+'''The asyncteensy module exports the AsyncTeensy class, a Teensy client
+that runs the complete protocol on an asyncio event loop.
+'''
+
+import asyncio
+import collections
+import os
+
+import teensyclock as tc
+
+from pyteensy import (
+    _TeensyPackage,
+    _TeensyFramer,
+    _open_device_file,
+    TeensyLineEvent,
+    TeensyError,
+    ZEP_TEENSY_TO_ZEP_UUID
+    )
+
+
+class AsyncTeensy(object):
+    '''Class that communicates with a teensy device from an asyncio event loop.
+
+    Just like the UnixTeensy, the AsyncTeensy reads straight from a device
+    file, but instead of a worker thread, the file descriptor is watched
+    with loop.add_reader. Commands are coroutines and the replies of the
+    Teensy are matched with the commands in the order they were sent, so
+    several commands can be awaited concurrently. Events are obtained with:
+
+        async with await AsyncTeensy.open("/dev/ttyACM0") as teensy:
+            await teensy.register_line(1)
+            async for event in teensy.events():
+                print(event)
+    '''
+
+    def __init__(self):
+        self.connected = False
+        self._fd = None
+        self._loop = None
+        self._framer = None
+        self._pending = collections.deque() # futures that await a reply
+        self._wbuf = bytearray()            # bytes that still must be written
+        self._events = None                 # Becomes queue for events
+        self.clock_sync = None              # The result of the last sync
+
+    @classmethod
+    async def open(cls, devfn="/dev/ttyACM0"):
+        '''Creates an AsyncTeensy and connects it with devfn.'''
+        teensy = cls()
+        await teensy.connect(devfn)
+        return teensy
+
+    async def connect(self, devfn):
+        '''Connects with an actual teensy device. The file descriptor is
+        registered with the running event loop and a handshake is done with
+        the teensy.
+        '''
+        if self.connected:
+            self.close()
+        self._loop = asyncio.get_running_loop()
+        self._fd = _open_device_file(devfn, os.O_NONBLOCK)
+        self._framer = _TeensyFramer()
+        self._events = asyncio.Queue()
+        self._loop.add_reader(self._fd, self._on_readable)
+        try:
+            await self._identify()
+        except BaseException:
+            self._disconnect(TeensyError(TeensyError.NOT_CONNECTED))
+            raise
+        self.connected = True
+
+    def close(self):
+        '''Stops watching the device and closes it. The events() iterators
+        stop after the events that were already received.
+        '''
+        if self._fd is not None:
+            self._disconnect(TeensyError(TeensyError.NOT_CONNECTED))
+
+    def _disconnect(self, error):
+        '''Closes the device, the pending commands fail with error.'''
+        self._loop.remove_reader(self._fd)
+        if self._wbuf:
+            self._loop.remove_writer(self._fd)
+            del self._wbuf[:]
+        os.close(self._fd)
+        self._fd = None
+        self.connected = False
+        while self._pending:
+            future = self._pending.popleft()
+            if not future.done():
+                future.set_exception(error)
+        self._events.put_nowait(None)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def handle_event(self, event):
+        '''When an event is received it is handled inside this handler, it
+        runs on the event loop. The default behavior is to queue the event
+        for the events() iterators.
+        '''
+        self._events.put_nowait(event)
+
+    async def events(self):
+        '''An asynchronous iterator over the events of the teensy, it stops
+        when the teensy is closed.
+        '''
+        while True:
+            event = await self._events.get()
+            if event is None:
+                # let other iterators stop as well.
+                self._events.put_nowait(None)
+                return
+            yield event
+
+    def _on_readable(self):
+        '''Called by the event loop when the device has data available.'''
+        framer = self._framer
+        try:
+            nbytes = os.readv(self._fd, [framer.writable()])
+        except BlockingIOError:
+            return
+        except OSError as err:
+            self._disconnect(
+                TeensyError(TeensyError.NOT_CONNECTED, str(err))
+                )
+            return
+        if not nbytes:
+            self._disconnect(
+                TeensyError(TeensyError.NOT_CONNECTED, "end of file")
+                )
+            return
+        framer.commit(nbytes)
+
+        buf = framer.view
+        unpack_event = _TeensyPackage._EVENT_TRIGGER.unpack_from
+        event_type = _TeensyPackage.EVENT_TRIGGER
+        while True:
+            offset = framer.next_frame()
+            if offset < 0:
+                return
+            if buf[offset + 1] == event_type:
+                _, _, line, timestamp, logic = unpack_event(buf, offset)
+                self.handle_event(TeensyLineEvent(timestamp, line, logic))
+            elif self._pending:
+                future = self._pending.popleft()
+                if not future.done():
+                    future.set_result(
+                        _TeensyPackage(
+                            bytearray(buf[offset:offset + buf[offset]])
+                            )
+                        )
+
+    def _on_writable(self):
+        '''Called by the event loop when the device accepts data again.'''
+        try:
+            nbytes = os.write(self._fd, self._wbuf)
+        except BlockingIOError:
+            return
+        del self._wbuf[:nbytes]
+        if not self._wbuf:
+            self._loop.remove_writer(self._fd)
+
+    def _write(self, data):
+        '''Writes data to the device without blocking the event loop.'''
+        if not self._wbuf:
+            try:
+                nbytes = os.write(self._fd, data)
+            except BlockingIOError:
+                nbytes = 0
+            if nbytes == len(data):
+                return
+            self._loop.add_writer(self._fd, self._on_writable)
+            data = data[nbytes:]
+        self._wbuf.extend(data)
+
+    async def _command(self, frame) -> _TeensyPackage:
+        '''Sends frame, the bytes of a command, and returns the reply of the
+        teensy.
+        '''
+        if self._fd is None:
+            raise TeensyError(TeensyError.NOT_CONNECTED)
+        future = self._loop.create_future()
+        self._pending.append(future)
+        self._write(frame)
+        return await future
+
+    async def _identify(self):
+        '''Does a handshake with the teensy'''
+        package = await self._command(_TeensyPackage._IDENTIFY_FRAME)
+        if package.pkgtype() != _TeensyPackage.IDENTIFY:
+            raise TeensyError(TeensyError.NOT_A_TEENSY)
+        _, _, uuid = package.parse_packet()
+        if uuid != ZEP_TEENSY_TO_ZEP_UUID:
+            raise TeensyError(TeensyError.NOT_A_TEENSY)
+
+    async def _register(self, frame):
+        '''Sends a (single shot) register frame and checks the reply.'''
+        reply = (await self._command(frame)).pkgtype()
+        if reply == _TeensyPackage.ACKNOWLEDGE_LINE_INVALID:
+            raise TeensyError(TeensyError.INVALID_TRIGGER_LINE)
+        elif reply != _TeensyPackage.ACKNOWLEDGE_SUCCES:
+            raise TeensyError(TeensyError.TEENSY_ERROR)
+
+    async def register_line(self, line):
+        '''Register one line on the teensy device. The line will trigger on
+        rising and falling flanks.
+        '''
+        await self._register(
+            _TeensyPackage.line_frame(_TeensyPackage.REGISTER_INPUT, line)
+            )
+
+    async def register_single_shot(self, line):
+        ''' Register a single shot Teensy line. The line can be triggered once.
+        It depends on the current state of the Teensy whether it will be a
+        rising or a falling flank.
+        '''
+        await self._register(
+            _TeensyPackage.line_frame(_TeensyPackage.REGISTER_SINGLE_SHOT, line)
+            )
+
+    async def deregister_input(self, line):
+        '''Deregister a previously registerd (single_shot) line.'''
+        reply = await self._command(
+            _TeensyPackage.line_frame(_TeensyPackage.DEREGISTER_INPUT, line)
+            )
+        if reply.pkgtype() != _TeensyPackage.ACKNOWLEDGE_SUCCES:
+            raise TeensyError(TeensyError.TEENSY_ERROR)
+
+    async def time(self) -> int:
+        '''Obtain a timestamp from the Teensy.'''
+        reply = await self._command(_TeensyPackage._TIME_FRAME)
+        if reply.pkgtype() != _TeensyPackage.ACKNOWLEDGE_TIME:
+            raise TeensyError(TeensyError.TEENSY_ERROR)
+        _, _, time = reply.parse_packet()
+        return time
+
+    async def time_set(self, time_us: int):
+        '''Sets the time in us on the teensy.'''
+        package = _TeensyPackage()
+        package.prepare_set_time(time_us)
+        reply = await self._command(package.buf)
+        if reply.pkgtype() != _TeensyPackage.ACKNOWLEDGE_SUCCES:
+            raise TeensyError(TeensyError.TEENSY_ERROR)
+
+    async def _time_exchange(self, cclock: callable) -> tc.ClockSample:
+        '''Obtains the Teensy time and the cclock times just before the
+        request and just after the reply.
+        '''
+        host_send = cclock()
+        teensy_time = await self.time()
+        host_recv = cclock()
+        return tc.ClockSample(host_send, teensy_time, host_recv)
+
+    async def sync_clock(
+            self,
+            cclock: callable,
+            thres_us: int=None,
+            samples: int=16,
+            apply: bool=True
+            ) -> tc.ClockSync:
+        '''Synchronizes the teensy with the cclock, see Teensy.sync_clock.
+        cclock is called on the event loop. Other commands should not be
+        awaited meanwhile, they would delay the time exchanges.
+        '''
+        if not isinstance(cclock(), int):
+            raise ValueError("cclock() must return an integer in µs")
+        exchanges = [await self._time_exchange(cclock) for _ in range(samples)]
+        result = tc.estimate_offset(exchanges)
+        if apply:
+            await self.time_set(cclock() + result.rtt // 2)
+            exchanges = [
+                await self._time_exchange(cclock) for _ in range(samples)
+                ]
+            result = tc.estimate_offset(exchanges)
+            result.applied = True
+        self.clock_sync = result
+        if thres_us is not None:
+            if abs(result.offset) + result.uncertainty >= thres_us:
+                raise TeensyError(TeensyError.UNABLE_TO_SYNC, str(result))
+        return result
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+# This file is part of pyteensy.
+#
+# pyteensy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# pyteensy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with pyteensy.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+'''The fixtures of the tests. The tests that need a device run against a
+teensyemu.TeensyEmulator, so no Teensy has to be connected. The emulator
+requires a pseudo terminal, elsewhere those tests are skipped.
+'''
+
+import random
+import time as tm
+
+import pytest
+
+import pyteensy as pt
+
+try:
+    import teensyemu
+except ImportError:
+    teensyemu = None
+
+
+def _wait_for(condition, timeout: float=5.0) -> bool:
+    '''Polls condition until it is true, returns False if that takes
+    longer than timeout seconds.
+    '''
+    deadline = tm.monotonic() + timeout
+    while not condition():
+        if tm.monotonic() > deadline:
+            return False
+        tm.sleep(0.001)
+    return True
+
+
+def _random_events(count: int, lines, seed: int=1) -> list:
+    '''Returns count TeensyLineEvents in order of time on lines, the levels
+    of every line alternate.
+    '''
+    rng = random.Random(seed)
+    levels = {}
+    events = []
+    timestamp = 0
+    for _ in range(count):
+        timestamp += rng.randint(1, 1000)
+        line = rng.choice(lines)
+        levels[line] = level = levels.get(line, 0) ^ 1
+        events.append(pt.TeensyLineEvent(timestamp, line, level))
+    return events
+
+
+@pytest.fixture
+def random_events():
+    return _random_events
+
+
+@pytest.fixture
+def wait_for():
+    return _wait_for
+
+
+@pytest.fixture
+def emulator_class():
+    '''The TeensyEmulator class, to create emulators with other settings.'''
+    if teensyemu is None:
+        pytest.skip("the emulator requires a pseudo terminal")
+    return teensyemu.TeensyEmulator
+
+
+@pytest.fixture
+def emulator(emulator_class):
+    with emulator_class() as emu:
+        yield emu
+
+
+@pytest.fixture(params=["Teensy", "UnixTeensy"])
+def teensy(request, emulator):
+    '''A Teensy and a UnixTeensy that are connected to emulator.'''
+    with getattr(pt, request.param)(emulator.devfn) as teensy:
+        yield teensy
@@ -33,12 +33,6 @@ import numpy as np
 import time
 import threading
 import parallel
-try:
-    #python3
-    import queue as q
-except ImportError:
-    #python2
-    import Queue as q
 
 class TogglePort(object):
     '''
@@ -66,38 +60,104 @@ class TogglePort(object):
         self.data = self.ON if (self.data != self.ON) else self.OFF
         self.port.setData(self.data)
 
-class _ToggleSignal(object):
-    ''' a Callable object that can toggle a port and return the timestamp
-    of when the port is toggled.
+class PulseScheduler(object):
+    '''Toggles a port at absolute deadlines from one dedicated thread.
+
+    The deadlines are time.perf_counter_ns times, so steps of the wall clock
+    don't move them. The thread sleeps until spin_us before a deadline and
+    spins for the last part, which absorbs the wake up latency of the
+    sleep. The time just before every toggle is kept in self.times_ns and
+    how late it came in self.lateness_ns.
+    Other Python threads that keep the interpreter busy delay the wake ups,
+    a Teensy is best read by a teensyproc.ProcessTeensy meanwhile.
     '''
 
-    def __init__(self, tport):
-        self.tport = tport
-        self.queue = q.Queue()
-    
-    def wait(self):
-        '''returns the time when the port is toggled.'''
-        return self.queue.get()
+    def __init__(self, toggle, spin_us: float=300.0):
+        self.toggle = toggle
+        self.spin_ns = int(spin_us * 1000)
+        self.times_ns = np.zeros(0, np.int64)
+        self.lateness_ns = np.zeros(0, np.int64)
+        self._thread = None
+        self._quit = threading.Event()
+
+    def start(self, deadlines_ns):
+        '''Starts toggling at deadlines_ns, an array of perf_counter_ns
+        times in order.
+        '''
+        if self._thread is not None:
+            raise RuntimeError("The scheduler is running already")
+        self._quit.clear()
+        self._thread = threading.Thread(
+            target=self._run,
+            args=(np.asarray(deadlines_ns, np.int64),),
+            name=repr(self),
+            daemon=True
+            )
+        self._thread.start()
+
+    def join(self):
+        '''Waits until the last toggle is done.'''
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def stop(self):
+        '''Cancels the toggles that haven't been done yet.'''
+        self._quit.set()
+        self.join()
+
+    def run(self, deadlines_ns) -> tuple:
+        '''Toggles at deadlines_ns and returns self.times_ns and
+        self.lateness_ns when done.
+        '''
+        self.start(deadlines_ns)
+        self.join()
+        return self.times_ns, self.lateness_ns
+
+    def lateness_us(self, percentiles=(50, 99, 100)):
+        '''Returns the percentiles of the lateness in us.'''
+        if not len(self.lateness_ns):
+            return np.zeros(len(percentiles))
+        return np.percentile(self.lateness_ns, percentiles) / 1000
+
+    def _run(self, deadlines):
+        perf_counter_ns = time.perf_counter_ns
+        wait = self._quit.wait
+        toggle = self.toggle
+        spin_ns = self.spin_ns
+        times = []
+        for deadline in deadlines.tolist():
+            remaining = deadline - spin_ns - perf_counter_ns()
+            if remaining > 0 and wait(remaining / 1e9):
+                break
+            now = perf_counter_ns()
+            while now < deadline:
+                now = perf_counter_ns()
+            toggle()
+            times.append(now)
+        self.times_ns = np.array(times, np.int64)
+        self.lateness_ns = self.times_ns - deadlines[:len(times)]
 
-    def __call__(self):
-        self.queue.put(time.time())
-        self.tport.toggle()
 
-def pulse_train(toggle, number=120, jitter=(0.0,1.0)):
+def pulse_train(toggle, number=120, jitter=(0.0,1.0), scheduler=None):
     ''' Apply a train of toggle pulses, the interval will best described
     between a random value between jitter[0] and jitter[1]. So the default
     pulse train consists of 120 pulses with an uniform interval between 
     0 and 1 second. So it lasts about one minute.
-    it returns the jittered interval between the pulses.
+    toggle is a TogglePort. The pulses are timed by scheduler, by default a
+    PulseScheduler for toggle.toggle, its lateness_ns tells how late every
+    toggle was.
+    it returns the times in seconds of the toggles on the
+    time.perf_counter clock.
     '''
     arr         = np.random.uniform(jitter[0], jitter[1], int(number))
-    signal      = _ToggleSignal(toggle)
-    timestamps  = []
-    for second in arr:
-        waitobj = threading.Timer(second, signal)
-        waitobj.start()
-        timestamps.append(signal.wait())
-    return timestamps
+    if scheduler is None:
+        scheduler = PulseScheduler(toggle.toggle)
+    deadlines   = time.perf_counter_ns() + np.cumsum(
+        (arr * 1e9).astype(np.int64)
+        )
+    times, _    = scheduler.run(deadlines)
+    return (times / 1e9).tolist()
 
 def _test():
     port = TogglePort(0)
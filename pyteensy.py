@@ -20,10 +20,16 @@
 '''
 
 from __future__ import print_function
+from concurrent.futures import Future, ThreadPoolExecutor
+import array
+import collections
+import operator
+import pickle
 import struct
 import threading
-import select
+import selectors
 import os
+import time as tm
 
 try:
     # python 3
@@ -32,9 +38,16 @@ except ImportError:
     # python 2
     import Queue as q
 
+try:
+    # numpy is optional, it is only required for the columnar event mode.
+    import numpy as np
+except ImportError:
+    np = None
+
 import serial as s
 import serial.tools.list_ports
 import pyteensy_version as pv
+import teensyclock as tc
 
 def list_devices():
     '''lists the available serial devices'''
@@ -49,6 +62,10 @@ def version():
 ZEP_TEENSY_TO_ZEP_UUID = b"7d945241-0238-4c29-95e4-7d9864710ea2"
 ZEP_ZEP_TO_TEENSY_UUID = b"91ae4c34-00b0-4d91-9000-ccc0989ac92a"
 
+def _line_frames(layout: struct.Struct, pkgtype: int) -> tuple:
+    '''Returns the frames of a command with a line argument for all lines.'''
+    return tuple(layout.pack(layout.size, pkgtype, line) for line in range(256))
+
 class _TeensyPackage(object):
     '''TeensyPackages are the packages that are send over the serial
     connection in order to communicate with a Teensy device. Teensy
@@ -115,6 +132,32 @@ class _TeensyPackage(object):
 
     _events = set([EVENT_TRIGGER])
 
+    # Commands are sent often and have few variants, so their frames are
+    # built once. A frame of a command with a line is found with
+    # _LINE_FRAMES[pkgtype][line].
+    _LINE_FRAMES = {
+        REGISTER_INPUT          : _line_frames(_REGISTER_INPUT, REGISTER_INPUT),
+        REGISTER_SINGLE_SHOT    : _line_frames(
+                                    _REGISTER_SINGLE_SHOT, REGISTER_SINGLE_SHOT
+                                    ),
+        DEREGISTER_INPUT        : _line_frames(
+                                    _DEREGISTER_INPUT, DEREGISTER_INPUT
+                                    )
+    }
+    _IDENTIFY_FRAME = _IDENTIFY.pack(
+        _IDENTIFY.size, IDENTIFY, ZEP_ZEP_TO_TEENSY_UUID
+        )
+    _TIME_FRAME = _TIME.pack(_TIME.size, TIME)
+
+    @classmethod
+    def line_frame(cls, pkgtype: int, line: int) -> bytes:
+        '''Returns the prebuilt frame of the command pkgtype for line, a
+        TeensyError is raised if line isn't a valid line.
+        '''
+        if not 0 <= line < len(cls._LINE_FRAMES[pkgtype]):
+            raise TeensyError(TeensyError.INVALID_TRIGGER_LINE, str(line))
+        return cls._LINE_FRAMES[pkgtype][line]
+
     def parse_packet(self):
         '''Parses the bytearray self.buf and returns a tuple of
         size, message_type and payload or None
@@ -151,42 +194,19 @@ class _TeensyPackage(object):
 
     def prepare_register(self, line):
         '''Construct a message to send to register a trigger line.'''
-        self.buf = bytearray(
-            self._REGISTER_INPUT.pack(
-                self._HDR_SZ + 1,
-                self.REGISTER_INPUT,
-                line
-                )
-            )
+        self.buf = bytearray(self.line_frame(self.REGISTER_INPUT, line))
 
     def prepare_deregister(self, line):
         '''Construct a package to deregister a trigger line.'''
-        self.buf = bytearray(
-            self._DEREGISTER_INPUT.pack(
-                self._HDR_SZ + 1,
-                self.DEREGISTER_INPUT,
-                line
-                )
-            )
+        self.buf = bytearray(self.line_frame(self.DEREGISTER_INPUT, line))
 
     def prepare_single_shot(self, line):
         ''''Prepare a message to register a line on the teensy as singleshot.'''
-        self.buf = bytearray(
-            self._REGISTER_SINGLE_SHOT.pack(
-                self._HDR_SZ + 1,
-                self.REGISTER_SINGLE_SHOT,
-                line
-                )
-            )
+        self.buf = bytearray(self.line_frame(self.REGISTER_SINGLE_SHOT, line))
 
     def prepare_time(self):
         '''Prepare a message to request the teensy time.'''
-        self.buf = bytearray(
-            self._TIME.pack(
-                self._HDR_SZ,
-                self.TIME
-                )
-            )
+        self.buf = bytearray(self._TIME_FRAME)
 
     def prepare_set_time(self, time_us):
         '''Prepare a message to set the teensy time.'''
@@ -209,11 +229,94 @@ class _TeensyPackage(object):
     def __len__(self):
         return self.buf[0]
 
+class _TeensyFramer(object):
+    '''Incremental decoder for the byte stream that a Teensy device sends.
+
+    Instead of reading a packet byte by byte, the worker thread reads
+    whatever is available into one preallocated buffer. Complete frames are
+    taken from the front of the buffer, a partial frame simply stays in the
+    buffer until the rest of it has been read. The buffer is only compacted
+    (the partial frame is moved to the front) when there is not enough room
+    left to read another chunk, so in the common case no bytes are copied
+    at all.
+    '''
+
+    # Size of the internal buffer and the maximum number of bytes read at once
+    BUFSIZE = 1 << 16
+    READSIZE = 4096
+
+    def __init__(self, bufsize: int=BUFSIZE):
+        self.buf = bytearray(bufsize)
+        self.view = memoryview(self.buf)
+        self.head = 0   # offset of the first byte that is not parsed yet.
+        self.tail = 0   # offset of the first free byte.
+
+    def __len__(self):
+        '''Returns the number of buffered bytes that are not parsed yet.'''
+        return self.tail - self.head
+
+    def _compact(self):
+        '''Moves the unparsed bytes to the front of the buffer.'''
+        nbytes = self.tail - self.head
+        if nbytes:
+            self.view[:nbytes] = self.view[self.head:self.tail]
+        self.head = 0
+        self.tail = nbytes
+
+    def writable(self, size: int=READSIZE) -> memoryview:
+        '''Returns a view on the free part of the buffer of at most size bytes.
+        After writing into it, call commit with the number of bytes written.
+        '''
+        if self.head == self.tail:
+            self.head = self.tail = 0
+        elif len(self.buf) - self.tail < size:
+            self._compact()
+        return self.view[self.tail:min(self.tail + size, len(self.buf))]
+
+    def commit(self, nbytes: int):
+        '''Marks nbytes of the view returned by writable as valid data.'''
+        self.tail += nbytes
+
+    def feed(self, data):
+        '''Copies data, e.g. the bytes returned by a read, into the buffer.'''
+        nbytes = len(data)
+        self.writable(nbytes)[:nbytes] = data
+        self.commit(nbytes)
+
+    def skip(self, nbytes: int):
+        '''Consumes nbytes of parsed data from the front of the buffer.'''
+        self.head += nbytes
+
+    def next_frame(self) -> int:
+        '''Returns the offset of the next complete frame in self.buf or -1
+        when there is no complete frame available. The frame is consumed, it
+        remains valid until the next call to writable or feed.
+        '''
+        head = self.head
+        avail = self.tail - head
+        if not avail:
+            return -1
+        size = self.buf[head]
+        if size < _TeensyPackage._HDR_SZ:
+            raise TeensyError(
+                TeensyError.TEENSY_ERROR,
+                "invalid frame size {}".format(size)
+                )
+        if avail < size:
+            return -1
+        self.head = head + size
+        return head
+
 class TeensyEvent(object):
     '''An event send by a Teensy device to the worker thread of a python
     Teensy object. Currently there is only one Type of event. The most
     characterizing property of an event is that has a time stamp.
+    Events use __slots__, long sessions collect millions of them and a
+    per instance __dict__ would multiply their size.
     '''
+
+    __slots__ = ("timestamp",)
+
     def __init__(self, timestamp):
         '''Sets the timestamp'''
         self.timestamp = timestamp
@@ -229,14 +332,268 @@ class TeensyLineEvent(TeensyEvent):
     LOW = 0
     HIGH = 1
 
+    __slots__ = ("line", "logiclevel")
+
     def __init__(self, time, line, logiclevel):
-        super(TeensyLineEvent, self).__init__(time)
+        # Sets the timestamp itself, instead of via TeensyEvent.__init__,
+        # this is the hot path for every event that is received.
+        self.timestamp = time
         self.line = line
         self.logiclevel = self.HIGH if logiclevel else self.LOW
 
     def __str__(self):
         return "{}\t{}\t{}".format(self.timestamp, self.line, self.logiclevel)
 
+class TeensyStampedLineEvent(TeensyLineEvent):
+    '''A line event that also carries the host time at which it occurred,
+    according to the clock model of the Teensy that received it.
+    '''
+
+    __slots__ = ("host_time",)
+
+    def __init__(self, time, line, logiclevel, host_time):
+        super(TeensyStampedLineEvent, self).__init__(time, line, logiclevel)
+        self.host_time = host_time
+
+    def __str__(self):
+        return "{}\t{}\t{}\t{:.1f}".format(
+            self.timestamp, self.line, self.logiclevel, self.host_time
+            )
+
+if np is not None:
+    # The layout of one event in a TeensyEventStore.
+    EVENT_DTYPE = np.dtype([
+        ("line", np.uint8),
+        ("timestamp", np.uint64),
+        ("level", np.uint8)
+        ])
+
+    # The layout of an EVENT_TRIGGER frame on the wire, it matches
+    # _TeensyPackage._EVENT_TRIGGER, so a run of frames can be decoded at once.
+    _EVENT_TRIGGER_DTYPE = np.dtype([
+        ("size", np.uint8),
+        ("type", np.uint8),
+        ("line", np.uint8),
+        ("timestamp", "<u8"),
+        ("level", np.uint8)
+        ])
+    assert _EVENT_TRIGGER_DTYPE.itemsize == _TeensyPackage._EVENT_TRIGGER.size
+
+class TeensyEventStore(object):
+    '''A growable array of line events. The events are stored as a numpy
+    structured array with the fields line, timestamp and level (see
+    EVENT_DTYPE), so consumers get whole arrays instead of one TeensyLineEvent
+    per event. The store may be filled from the worker thread of a Teensy
+    while it is read from another thread.
+    Because no Python object is created per event, a store is also gentle on
+    the garbage collector. Indexing or iterating a store materializes
+    TeensyLineEvents lazily, one at a time.
+    '''
+
+    def __init__(self, capacity: int=4096):
+        if np is None:
+            raise ImportError("TeensyEventStore requires numpy")
+        self._data = np.empty(capacity, dtype=EVENT_DTYPE)
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, index: int) -> TeensyLineEvent:
+        with self._lock:
+            if index < 0:
+                index += self._size
+            if not 0 <= index < self._size:
+                raise IndexError("TeensyEventStore index out of range")
+            line, timestamp, level = self._data[index].item()
+        return TeensyLineEvent(timestamp, line, level)
+
+    def __iter__(self):
+        events = self.events()
+        for start in range(0, len(events), 4096):
+            for line, timestamp, level in events[start:start + 4096].tolist():
+                yield TeensyLineEvent(timestamp, line, level)
+
+    def _reserve(self, nevents):
+        '''Makes sure there is room for nevents more events.'''
+        needed = self._size + nevents
+        if needed > len(self._data):
+            # A store without capacity must still grow.
+            capacity = max(len(self._data), 1)
+            while capacity < needed:
+                capacity *= 2
+            data = np.empty(capacity, dtype=EVENT_DTYPE)
+            data[:self._size] = self._data[:self._size]
+            self._data = data
+
+    def append(self, timestamp: int, line: int, logiclevel: int):
+        '''Appends one event to the store.'''
+        with self._lock:
+            self._reserve(1)
+            self._data[self._size] = (line, timestamp, 1 if logiclevel else 0)
+            self._size += 1
+
+    def extend_frames(self, frames):
+        '''Appends an array of raw EVENT_TRIGGER frames to the store.'''
+        nevents = len(frames)
+        with self._lock:
+            self._reserve(nevents)
+            dest = self._data[self._size:self._size + nevents]
+            dest["line"] = frames["line"]
+            dest["timestamp"] = frames["timestamp"]
+            np.not_equal(frames["level"], 0, out=dest["level"], casting="unsafe")
+            self._size += nevents
+
+    def events(self):
+        '''Returns a copy of all events in the store.'''
+        with self._lock:
+            return self._data[:self._size].copy()
+
+    def drain(self):
+        '''Returns all events in the store and empties the store.'''
+        with self._lock:
+            events = self._data[:self._size].copy()
+            self._size = 0
+        return events
+
+    def clear(self):
+        '''Removes all events from the store.'''
+        with self._lock:
+            self._size = 0
+
+class TeensyEventQueue(q.Queue):
+    '''A queue for the events of a Teensy that holds at most maxsize
+    events in memory. What happens when it is full is determined by policy:
+
+    BLOCK makes put wait until a consumer made room; the worker thread then
+    stops reading and the device's buffers fill up.
+    DROP_OLDEST discards the oldest event to make room for the new one.
+    DROP_NEWEST discards the new event.
+    SPILL appends the events that don't fit to spill_file, a file object
+    opened for binary reading and writing, by default an anonymous
+    temporary file. They are read back in order as room becomes available.
+
+    self.dropped and self.spilled count the events that were dropped or
+    written to the spill file. A maxsize of 0 makes the queue unbounded.
+    Once the queue is closed, put doesn't wait anymore; events that don't
+    fit are dropped.
+    '''
+
+    BLOCK = "block"
+    DROP_OLDEST = "drop_oldest"
+    DROP_NEWEST = "drop_newest"
+    SPILL = "spill"
+    POLICIES = (BLOCK, DROP_OLDEST, DROP_NEWEST, SPILL)
+
+    _LENGTH = struct.Struct("<I")
+
+    def __init__(self, maxsize: int=0, policy: str=BLOCK, spill_file=None):
+        if policy not in self.POLICIES:
+            raise ValueError("Unknown overflow policy: {}".format(policy))
+        self.policy = policy
+        self.capacity = maxsize
+        self.dropped = 0
+        self.spilled = 0
+        self._spill_file = spill_file
+        self._spill_count = 0   # events in the spill file
+        self._spill_read = 0    # file offset of the oldest spilled event
+        self._spill_write = 0   # file offset after the newest one
+        self._closed = False
+        super(TeensyEventQueue, self).__init__(maxsize)
+
+    def close(self):
+        '''Stops put from waiting for room, so a worker thread that waits
+        for a consumer can quit. Teensy.close calls this.
+        '''
+        with self.mutex:
+            self._closed = True
+            self.not_full.notify_all()
+
+    def put(self, item, block: bool=True, timeout: float=None):
+        '''Puts item in the queue, see queue.Queue.put. A closed queue drops
+        the item instead of waiting for room.
+        '''
+        with self.not_full:
+            # Only BLOCK lets put wait, the other policies handle a full
+            # queue in _put.
+            if self.maxsize > 0 and self.policy == self.BLOCK:
+                if not block:
+                    if self._qsize() >= self.maxsize:
+                        raise q.Full
+                else:
+                    end = None if timeout is None else tm.monotonic() + timeout
+                    while self._qsize() >= self.maxsize and not self._closed:
+                        if end is None:
+                            self.not_full.wait()
+                            continue
+                        remaining = end - tm.monotonic()
+                        if remaining <= 0:
+                            raise q.Full
+                        self.not_full.wait(remaining)
+                if self._qsize() >= self.maxsize:
+                    self.dropped += 1
+                    return
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    def _qsize(self):
+        return len(self.queue) + self._spill_count
+
+    def _put(self, item):
+        capacity = self.capacity
+        if not capacity or (
+                len(self.queue) < capacity and not self._spill_count):
+            self.queue.append(item)
+        elif self.policy == self.DROP_OLDEST:
+            self.queue.popleft()
+            self.queue.append(item)
+            self._drop()
+        elif self.policy == self.DROP_NEWEST:
+            self._drop()
+        else:
+            self._spill(item)
+
+    def _drop(self):
+        # put counts every item as an unfinished task, a dropped item will
+        # never be marked as done.
+        self.dropped += 1
+        self.unfinished_tasks -= 1
+
+    def _spill(self, item):
+        if self._spill_file is None:
+            import tempfile
+            self._spill_file = tempfile.TemporaryFile()
+        data = pickle.dumps(item, pickle.HIGHEST_PROTOCOL)
+        record = self._LENGTH.pack(len(data)) + data
+        self._spill_file.seek(self._spill_write)
+        self._spill_file.write(record)
+        self._spill_write += len(record)
+        self._spill_count += 1
+        self.spilled += 1
+
+    def _unspill(self):
+        f = self._spill_file
+        f.seek(self._spill_read)
+        length, = self._LENGTH.unpack(f.read(self._LENGTH.size))
+        item = pickle.loads(f.read(length))
+        self._spill_read += self._LENGTH.size + length
+        self._spill_count -= 1
+        if not self._spill_count:
+            # Start over, so the file doesn't keep growing.
+            f.truncate(0)
+            self._spill_read = self._spill_write = 0
+        return item
+
+    def _get(self):
+        item = self.queue.popleft()
+        if self._spill_count:
+            # The spilled events are newer than those in memory.
+            self.queue.append(self._unspill())
+        return item
+
+
 class TeensyError(Exception):
     '''If an error occurs with a teensy device this will be raised.'''
 
@@ -262,6 +619,10 @@ class TeensyError(Exception):
         self.extra = extra
         super(TeensyError, self).__init__()
 
+    def __reduce__(self):
+        # Lets errors be pickled, e.g. to pass them between processes.
+        return (TeensyError, (self.int_error, self.extra))
+
     def __str__(self):
         if self.extra:
             return "TeensyError: {}, Extra info: {}".format(
@@ -271,14 +632,149 @@ class TeensyError(Exception):
             return "TeensyError: {}".format(self._errdict[self.int_error])
 
 
+class TeensySubscription(object):
+    '''A callback that is subscribed to the events of one line of a Teensy,
+    optionally only to the events with one logic level. It counts how
+    often it was called and how long the calls took, so slow handlers can
+    be found.
+    '''
+
+    def __init__(self, line: int, callback: callable, level: int=None):
+        self.line = line
+        self.level = level
+        self.callback = callback
+        self.calls = 0      # number of calls
+        self.errors = 0     # number of calls that raised an exception
+        self.total_ns = 0   # total duration of the calls in ns
+        self.max_ns = 0     # duration of the slowest call in ns
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        '''Calls the callback with event and updates the counters.'''
+        start = tm.perf_counter_ns()
+        try:
+            self.callback(event)
+            failed = 0
+        except Exception:
+            import sys
+            import traceback
+            traceback.print_exc(file=sys.stderr)
+            failed = 1
+        duration = tm.perf_counter_ns() - start
+        with self._lock:
+            self.calls += 1
+            self.errors += failed
+            self.total_ns += duration
+            if duration > self.max_ns:
+                self.max_ns = duration
+
+    @property
+    def mean_ns(self) -> float:
+        '''The mean duration of a call in ns.'''
+        return self.total_ns / self.calls if self.calls else 0.0
+
+    def __str__(self):
+        return "line {} level {}: {} calls, mean {:.0f} ns, max {} ns".format(
+            self.line, self.level, self.calls, self.mean_ns, self.max_ns
+            )
+
+class TeensyHistogram(object):
+    '''A histogram of non negative integers with power of two buckets:
+    bucket i counts the values with bit length i, i.e. the values smaller
+    than 2 ** i and at least 2 ** (i - 1). Adding a value is cheap enough
+    for the hot path of the worker thread.
+    '''
+
+    def __init__(self):
+        self.buckets = [0] * 65
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value: int):
+        self.buckets[value.bit_length()] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, percentile: float) -> int:
+        '''Returns the upper bound of the bucket that contains the
+        percentile.
+        '''
+        rank = self.count * percentile / 100
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return min(self.max, (1 << index) - 1)
+        return 0
+
+    def snapshot(self) -> dict:
+        return {
+            "count" : self.count,
+            "mean" : self.total / self.count if self.count else 0.0,
+            "max" : self.max,
+            "p50" : self.percentile(50),
+            "p99" : self.percentile(99),
+            "buckets" : list(self.buckets[:self.max.bit_length() + 1])
+            }
+
+
+class TeensyStats(object):
+    '''The counters and histograms of an instrumented Teensy, see
+    Teensy.stats(). They are updated by the worker thread without locking,
+    so a snapshot taken from another thread may be off by the read that is
+    being handled.
+    '''
+
+    def __init__(self):
+        self.bytes_read = 0
+        self.reads = 0          # read system calls
+        self.frames = 0         # frames decoded
+        self.events = 0
+        self.replies = 0
+        self.queue_high_water = 0
+        self.frames_per_read = TeensyHistogram()
+        self.handle_event_ns = TeensyHistogram()
+        self.syncs = []         # the ClockSync of every sync_clock
+        self._read_frames = 0   # frames decoded since the last read
+
+    def snapshot(self) -> dict:
+        '''Returns the statistics as a dict of plain values.'''
+        return {
+            "bytes_read" : self.bytes_read,
+            "reads" : self.reads,
+            "frames" : self.frames,
+            "events" : self.events,
+            "replies" : self.replies,
+            "queue_high_water" : self.queue_high_water,
+            "frames_per_read" : self.frames_per_read.snapshot(),
+            "handle_event_ns" : self.handle_event_ns.snapshot(),
+            "syncs" : [
+                {
+                    "offset_us" : sync.offset,
+                    "uncertainty_us" : sync.uncertainty,
+                    "rtt_us" : sync.rtt,
+                    "applied" : sync.applied
+                } for sync in self.syncs
+                ]
+            }
+
+
 class _TeensyTask(object):
     ''' Is used to communicate between the teensy client and the Teensy
-    internal thread.
+    internal thread. The thread reports the outcome of the task via
+    self.future, a concurrent.futures.Future.
     '''
+
+    __slots__ = ("task", "args", "kwargs", "future")
+
     def __init__(self, task, *args, **kwargs):
         self.task = task
         self.args = args
         self.kwargs = kwargs
+        self.future = Future()
 
     def has_payload(self):
         '''Returns whether the task has a payload/extra argument for the
@@ -298,6 +794,105 @@ class _TeensyTask(object):
         '''Return the keyword arguments for the task'''
         return self.kwargs
 
+class _TeensyWakeup(object):
+    '''A file descriptor that the client side of a Teensy signals when it
+    queued a task, so the worker thread can block in one select call on both
+    the device and its tasks. It is an eventfd when available, otherwise
+    a self-pipe.
+    '''
+
+    def __init__(self):
+        if hasattr(os, "eventfd"):
+            self._rfd = self._wfd = os.eventfd(
+                0, os.EFD_NONBLOCK | os.EFD_CLOEXEC
+                )
+        else:
+            self._rfd, self._wfd = os.pipe()
+            os.set_blocking(self._rfd, False)
+            os.set_blocking(self._wfd, False)
+
+    def fileno(self) -> int:
+        '''Returns the file descriptor that becomes readable when set.'''
+        return self._rfd
+
+    def set(self):
+        '''Wakes up the thread that waits on fileno().'''
+        try:
+            if self._rfd == self._wfd:
+                os.eventfd_write(self._wfd, 1)
+            else:
+                os.write(self._wfd, b"\x00")
+        except BlockingIOError:
+            # The pipe is full, so it is readable already.
+            pass
+
+    def clear(self):
+        '''Consumes all pending wake ups.'''
+        try:
+            if self._rfd == self._wfd:
+                os.eventfd_read(self._rfd)
+            else:
+                while os.read(self._rfd, 4096):
+                    pass
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        os.close(self._rfd)
+        if self._wfd != self._rfd:
+            os.close(self._wfd)
+
+class _TeensyBatch(object):
+    '''Collects the replies to a batch of commands that were written at once.
+    Every command gets a part, a part is resolved like a future. When all
+    parts are resolved the future of the batch is resolved; it fails with
+    a TeensyError when one or more commands failed.
+    '''
+
+    class _Part(object):
+        '''Stands in for the future of one command of the batch.'''
+
+        def __init__(self, batch, index):
+            self.batch = batch
+            self.index = index
+
+        def done(self):
+            return False
+
+        def set_result(self, result):
+            self.batch._resolve(self.index, None)
+
+        def set_exception(self, error):
+            self.batch._resolve(self.index, error)
+
+    def __init__(self, future, args):
+        self.future = future
+        self.args = args
+        self.errors = [None] * len(args)
+        self.remaining = len(args)
+
+    def part(self, index):
+        '''Returns the part for the command at index.'''
+        return self._Part(self, index)
+
+    def _resolve(self, index, error):
+        self.errors[index] = error
+        self.remaining -= 1
+        if self.remaining:
+            return
+        failed = [
+            (arg, err) for arg, err in zip(self.args, self.errors) if err
+            ]
+        if not failed:
+            self.future.set_result(None)
+            return
+        self.future.set_exception(
+            TeensyError(
+                failed[0][1].int_error,
+                ", ".join(str(arg) for arg, _ in failed)
+                )
+            )
+
 class Teensy(object):
     '''Class that communicates with a teensy device.
 
@@ -305,6 +900,17 @@ class Teensy(object):
     Writing to the teensy device occurs from the thread. The thread monitors
     The eventqueue from the client and post a reply back, in the meanwhile the
     thread monitors events from the Teensy device.
+
+    Commands are pipelined: the thread writes a command as soon as it is
+    submitted and matches the replies of the Teensy with the commands in the
+    order in which they were written. Hence several commands may be in flight
+    at once. submit() returns a concurrent.futures.Future for a command, the
+    other methods wait for the result of their command.
+
+    On POSIX systems the thread blocks in a single select call on the device
+    and on a wake up file descriptor that is signalled when a task is
+    submitted. Elsewhere it alternates between waiting for tasks and
+    polling the device.
     '''
 
     READ_TIMEOUT = 0.0001
@@ -315,18 +921,125 @@ class Teensy(object):
 
     #ask thread to sync the clocks.
     SYNC_CLOCK = -1
+    #ask thread to write a batch of commands at once.
+    REGISTER_INPUTS = -2
+    REGISTER_SINGLE_SHOTS = -3
+    DEREGISTER_INPUTS = -4
+    #ask thread to start or stop tracking clock drift.
+    TRACK_DRIFT = -5
+    #ask thread for a number of time exchanges.
+    CLOCK_SAMPLES = -6
+
+    # The commands that are send to the Teensy as is.
+    REGISTER_INPUT = _TeensyPackage.REGISTER_INPUT
+    REGISTER_SINGLE_SHOT = _TeensyPackage.REGISTER_SINGLE_SHOT
+    DEREGISTER_INPUT = _TeensyPackage.DEREGISTER_INPUT
+    TIME = _TeensyPackage.TIME
+    TIME_SET = _TeensyPackage.TIME_SET
+
+    # The names of the commands in rtt_stats().
+    COMMAND_NAMES = {
+        REGISTER_INPUT : "register_input",
+        REGISTER_SINGLE_SHOT : "register_single_shot",
+        DEREGISTER_INPUT : "deregister_input",
+        TIME : "time",
+        TIME_SET : "time_set",
+    }
 
-    def __init__(self, devfn="/dev/ttyACM0"):
+    # The number of lines that can be subscribed to, a line is one byte.
+    NUM_LINES = 256
+
+    def __init__(
+            self,
+            devfn="/dev/ttyACM0",
+            columnar: bool=False,
+            executor=None,
+            recorder=None,
+            instrument: bool=False,
+            queue_size: int=0,
+            overflow: str=TeensyEventQueue.BLOCK
+            ):
         ''' Opens communication with serial device.
         devfn is a path to the device name or something like COM5 on windows.
+        If columnar is True, events are not queued one by one in self.events,
+        but runs of events are decoded at once and appended to
+        self.event_store, a TeensyEventStore. This requires numpy.
+        executor determines where the callbacks of subscribe() run: None
+        runs them inline on the thread that reads the device, "thread" runs
+        them in order on a dedicated dispatcher thread and an instance of
+        concurrent.futures.Executor, e.g. a ThreadPoolExecutor, runs them
+        on that executor.
+        recorder may be a teensyrecord.TeensyRecorder, all events are then
+        appended to its session file as they are read.
+        If instrument is True, the worker thread keeps statistics, see
+        stats(). Otherwise the instrumentation costs nothing at all.
+        queue_size limits the number of events in self.events, overflow is
+        the TeensyEventQueue policy that applies when it is full. By default
+        the queue is unbounded.
         '''
         super(Teensy, self).__init__()
         self.connected = False
         self._quit = None   # Becomes an event to stop the thread.
         self._thread = None   # Becomes the thread on connection
         self._tqueue = None   # Becomes Task queue on connection
-        self._aqueue = None   # Becomes Answer queue on connection
+        self._wakeup = None   # Becomes the wake up fd of the thread
+        self._pending = None   # Becomes queue of commands awaiting a reply
+        self._task = None   # The task that the thread is handling
         self.events = None   # Becomes queue for events on connection
+        self._framer = None   # Becomes the frame decoder on connection
+        # Receives the events in columnar mode.
+        self.event_store = TeensyEventStore() if columnar else None
+        # The result of the last sync_clock.
+        self.clock_sync = None
+        # Becomes (model, cclock, interval) while drift is tracked.
+        self._drift = None
+        self._drift_due = 0.0
+        # Becomes a function that maps Teensy to host time when events are
+        # stamped.
+        self._stamp = None
+        # The subscriptions per line, a tuple per line that has subscribers.
+        self._subscriptions = [None] * self.NUM_LINES
+        self._subscribe_lock = threading.Lock()
+        self._executor_spec = executor
+        self._executor = None   # Becomes the executor for the callbacks.
+        self.recorder = recorder
+        self._recv_ns = 0   # The recorder time of the last read.
+        # The TIME_SET frame is packed into this buffer.
+        self._time_set_buf = bytearray(_TeensyPackage._TIME_SET.size)
+        # Maps the tasks to the methods that handle them in the thread.
+        tp = _TeensyPackage
+        self._task_handlers = {
+            # values not from _TeensyPackage (these should be negative)
+            self.SYNC_CLOCK             : self._sync_clock,
+            self.REGISTER_INPUTS        : self._register_lines,
+            self.REGISTER_SINGLE_SHOTS  : self._register_single_shots,
+            self.DEREGISTER_INPUTS      : self._deregister_inputs,
+            self.TRACK_DRIFT            : self._track_drift,
+            self.CLOCK_SAMPLES          : self._clock_samples,
+
+            #values from _TeensyPackage (these should be positive)
+            tp.REGISTER_INPUT       : self._register_line,
+            tp.REGISTER_SINGLE_SHOT : self._register_single_shot,
+            tp.DEREGISTER_INPUT     : self._deregister_input,
+            tp.TIME                 : self._time_request,
+            tp.TIME_SET             : self._time_set_request,
+        }
+        # The round trip times in us per command, see rtt_stats().
+        self._rtt = {
+            pkgtype: TeensyHistogram() for pkgtype in self.COMMAND_NAMES
+            }
+        # The perf_counter_ns times at which the command whose reply is being
+        # parsed was written and its reply was handled.
+        self._exchange = (0, 0)
+        self._stats = None  # Becomes a TeensyStats when instrumented.
+        self._stats_report = None   # Becomes (callback, interval)
+        self._stats_due = 0.0
+        if overflow not in TeensyEventQueue.POLICIES:
+            raise ValueError("Unknown overflow policy: {}".format(overflow))
+        self._queue_size = queue_size
+        self._overflow = overflow
+        if instrument:
+            self._instrument()
 
         if devfn:
             self.connect(devfn)
@@ -340,10 +1053,7 @@ class Teensy(object):
         the "with Teensy() as instance:" syntax. If you forget to use this
         the thread doesn't shut down.
         '''
-        self._quit.set()
-        self._thread.join(0.1)
-        if self._thread.isAlive():
-            raise RuntimeError("Unable to close Teensy thread.")
+        self._stop_thread()
         self._serial.close()
 
     def connect(self, devfn):
@@ -361,56 +1071,307 @@ class Teensy(object):
                 TeensyError.UNABLE_TO_CONNECT,
                 str(err)
                 )
-        # empty queues to be sure.
-        self._tqueue = q.Queue()
-        self._aqueue = q.Queue()
-        self.events = q.Queue()
-
+        if self.recorder is not None:
+            self.recorder.update_metadata(device=devfn)
+        self._reset_queues()
         self._start_thread()
 
+    def _reset_queues(self):
+        '''Creates empty queues for a new connection.'''
+        self._quit = threading.Event()
+        self._tqueue = q.Queue()
+        self._wakeup = _TeensyWakeup() if os.name == "posix" else None
+        if self._executor_spec == "thread":
+            self._executor = ThreadPoolExecutor(
+                1, thread_name_prefix="teensy-dispatch"
+                )
+        else:
+            self._executor = self._executor_spec
+        self._pending = collections.deque()
+        self.events = TeensyEventQueue(self._queue_size, self._overflow)
+        self._framer = _TeensyFramer()
+
     def _start_thread(self):
         ''' Starts the internal thread.
         '''
-        self._thread = threading.Thread(target=self.run, name=repr(self))
+        started = _TeensyTask(_TeensyPackage.IDENTIFY)
+        self._thread = threading.Thread(
+            target=self.run, args=(started,), name=repr(self)
+            )
         self._thread.start()
 
         #sync with thread
-        ans = self._aqueue.get(True, 1)
-        if ans:
-            raise TeensyError(ans)
+        started.future.result(1)
         self.connected = True
 
-    def run(self):
+    def _stop_thread(self):
+        '''Asks the thread to quit and waits for it.'''
+        self._quit.set()
+        if self._wakeup:
+            self._wakeup.set()
+        if self.events is not None:
+            # The thread may be waiting for room in a full queue.
+            self.events.close()
+        self._thread.join(0.1)
+        if self._thread.is_alive():
+            raise RuntimeError("Unable to close Teensy thread.")
+        self._release()
+
+    def _release(self):
+        '''Releases what _reset_queues acquired, after the thread stopped
+        serving the Teensy.
+        '''
+        self.connected = False
+        if self._wakeup:
+            self._wakeup.close()
+            self._wakeup = None
+        if self._executor_spec == "thread":
+            # Deliver the events that are still queued for the callbacks.
+            self._executor.shutdown()
+        if self.recorder is not None and not self.recorder.closed:
+            self.recorder.flush()
+
+    def _fileno(self):
+        '''Returns the file descriptor of the device if the thread can select
+        on it, otherwise None.
+        '''
+        if self._wakeup is None:
+            return None
+        return self._serial.fileno()
+
+    def run(self, started: _TeensyTask):
         ''' The Teensy thread, the Teensy is read from or written to from here.
         '''
         assert self._serial
-        self._quit = threading.Event()
-        timeout = 0.001 #one millisecond
-        tasks = self._tqueue
-        reply = self._aqueue
 
         try:
             self._identify()
 
             #sync with client
-            reply.put(TeensyError.NO_ERROR)
+            started.future.set_result(None)
+
+            fileno = self._fileno()
+            if fileno is None:
+                self._run_polling()
+            else:
+                self._run_selector(fileno)
+        except Exception as err:
+            self._abort(started, err)
 
+    def _run_selector(self, fileno: int):
+        '''Waits in one select call until the device has data or the client
+        has submitted tasks.
+        '''
+        with selectors.DefaultSelector() as selector:
+            selector.register(fileno, selectors.EVENT_READ, self._fetch_events)
+            selector.register(
+                self._wakeup, selectors.EVENT_READ, self._handle_tasks
+                )
             while not self._quit.is_set():
-                try:
-                    task = tasks.get(True, timeout)
-                    answer = self._handle_task(task)
-                    reply.put(answer)
-                except q.Empty:
-                    # Fetch events while we have incoming data.
-                    while self._serial.in_waiting:
-                        self._fetch_event()
+                for key, _ in selector.select(self._timer_timeout()):
+                    key.data()
+                self._run_timers()
+
+    def _run_polling(self):
+        '''Alternates between waiting shortly for tasks and polling the
+        device, used where the device can't be selected on.
+        '''
+        timeout = 0.001 #one millisecond
+        tasks = self._tqueue
+        while not self._quit.is_set():
+            try:
+                # Don't wait for tasks while replies are expected.
+                task = tasks.get(not self._pending, timeout)
+                self._handle_task(task)
+            except q.Empty:
+                if self._pending:
+                    self._fetch_events()
+                # Fetch events while we have incoming data.
+                while self._serial.in_waiting:
+                    self._fetch_events()
+            self._run_timers()
+
+    def _timer_timeout(self):
+        '''Returns the number of seconds until the next timer of the thread
+        is due, or None if there are no timers.
+        '''
+        timeouts = []
+        if self._drift is not None:
+            timeouts.append(max(0.0, self._drift_due - tm.monotonic()))
+        if self.recorder is not None:
+            due = self.recorder.due()
+            if due is not None:
+                timeouts.append(due)
+        if self._stats_report is not None:
+            timeouts.append(max(0.0, self._stats_due - tm.monotonic()))
+        return min(timeouts) if timeouts else None
+
+    def _run_timers(self):
+        '''Runs the timers of the thread that are due.'''
+        if self.recorder is not None:
+            self.recorder.poll()
+        if self._stats_report is not None:
+            self._run_stats_report()
+        if self._drift is None:
+            return
+        now = tm.monotonic()
+        if now < self._drift_due:
+            return
+        if self._pending:
+            # A time exchange needs the line for itself, try again shortly.
+            self._drift_due = now + 0.001
+            return
+        model, cclock, interval = self._drift
+        model.add(self._time_exchange(cclock))
+        self._drift_due = now + interval
+
+    def _instrument(self):
+        '''Wraps the methods of the hot path in instance attributes that
+        update self._stats. An instance that isn't instrumented runs the
+        plain methods, so it doesn't pay for the instrumentation.
+        '''
+        stats = self._stats = TeensyStats()
+        perf_counter_ns = tm.perf_counter_ns
+        fill = self._fill
+        handle_event = self.handle_event
+        handle_event_array = self.handle_event_array
+        handle_reply = self._handle_reply
+
+        def counted_fill():
+            nbytes = fill()
+            stats.reads += 1
+            stats.bytes_read += nbytes
+            stats.frames_per_read.add(stats._read_frames)
+            stats._read_frames = 0
+            return nbytes
+
+        def timed_handle_event(event):
+            start = perf_counter_ns()
+            handle_event(event)
+            stats.handle_event_ns.add(perf_counter_ns() - start)
+            stats.events += 1
+            stats.frames += 1
+            stats._read_frames += 1
+            if self.events is not None:
+                depth = self.events.qsize()
+                if depth > stats.queue_high_water:
+                    stats.queue_high_water = depth
+
+        def timed_handle_event_array(frames):
+            start = perf_counter_ns()
+            handle_event_array(frames)
+            stats.handle_event_ns.add(perf_counter_ns() - start)
+            stats.events += len(frames)
+            stats.frames += len(frames)
+            stats._read_frames += len(frames)
+
+        def counted_handle_reply(package):
+            stats.replies += 1
+            stats.frames += 1
+            stats._read_frames += 1
+            handle_reply(package)
+
+        self._fill = counted_fill
+        self.handle_event = timed_handle_event
+        self.handle_event_array = timed_handle_event_array
+        self._handle_reply = counted_handle_reply
+
+    def stats(self, reset: bool=False) -> dict:
+        '''Returns a snapshot of the statistics of the worker thread as a
+        dict: bytes and reads from the device, frames decoded, the high
+        water mark of the event queue and histograms of the frames per read,
+        the duration of handle_event in ns and the command round trip times
+        in us, see rtt_stats. Returns None when the Teensy isn't
+        instrumented. If reset is True, the statistics start over.
+        '''
+        stats = self._stats
+        if stats is None:
+            return None
+        snapshot = stats.snapshot()
+        snapshot["command_rtt_us"] = self.rtt_stats(reset)
+        if reset:
+            # The wrappers close over the TeensyStats, so it is cleared in
+            # place.
+            stats.__init__()
+        return snapshot
+
+    def rtt_stats(self, reset: bool=False) -> dict:
+        '''Returns the distributions of the round trip times of the commands
+        in us, as a dict of command name to TeensyHistogram snapshot. Every
+        command is timed, from just before it was written until its reply
+        was decoded, also the time exchanges of sync_clock and the other
+        clock methods. If reset is True, the distributions start over.
+        '''
+        snapshot = {}
+        for pkgtype, name in self.COMMAND_NAMES.items():
+            histogram = self._rtt[pkgtype]
+            snapshot[name] = histogram.snapshot()
+            if reset:
+                histogram.__init__()
+        return snapshot
+
+    def report_stats(self, callback: callable, interval: float=1.0):
+        '''Calls callback(self.stats()) every interval seconds on the worker
+        thread, until report_stats(None) is called. The callback must return
+        quickly, it delays the events.
+        '''
+        if self._stats is None:
+            raise ValueError("report_stats requires an instrumented Teensy")
+        self._stats_due = tm.monotonic() + interval
+        self._stats_report = (callback, interval) if callback else None
+        if self._wakeup is not None:
+            # The thread must pick up the new timer.
+            self._wakeup.set()
+
+    def _run_stats_report(self):
+        '''Calls the stats callback when it is due.'''
+        callback, interval = self._stats_report
+        now = tm.monotonic()
+        if now < self._stats_due:
+            return
+        self._stats_due = now + interval
+        try:
+            callback(self.stats())
         except Exception:
-            # Abort from thread when an uncaught exception occurs.
             import sys
             import traceback
-            print(traceback.print_exc(), file=sys.stderr)
-            self.connected = False
-            return
+            traceback.print_exc(file=sys.stderr)
+
+    def _handle_tasks(self):
+        '''Handles all tasks that have been submitted.'''
+        self._wakeup.clear()
+        tasks = self._tqueue
+        while True:
+            try:
+                task = tasks.get(False)
+            except q.Empty:
+                return
+            self._handle_task(task)
+
+    def _abort(self, started: _TeensyTask, err: Exception):
+        '''Aborts the thread when an uncaught exception occurs. Everyone
+        who waits on the thread is notified.
+        '''
+        import sys
+        import traceback
+        traceback.print_exc(file=sys.stderr)
+        self.connected = False
+        if not isinstance(err, TeensyError):
+            err = TeensyError(TeensyError.NOT_CONNECTED, str(err))
+        if not started.future.done():
+            started.future.set_exception(err)
+        if self._task is not None and not self._task.future.done():
+            self._task.future.set_exception(err)
+        self._task = None
+        while self._pending:
+            future = self._pending.popleft()[0]
+            if not future.done():
+                future.set_exception(err)
+        while True:
+            try:
+                self._tqueue.get(False).future.set_exception(err)
+            except q.Empty:
+                break
 
     def handle_event(self, event):
         '''When an event is received it is handled inside this handler. If
@@ -420,222 +1381,613 @@ class Teensy(object):
         '''
         self.events.put(event)
 
-    def _read_packet(self, handle_event: bool=True)->_TeensyPackage:
-        '''Reads one packet from the stream, if it is an event it will be
-        handled.'''
+    def subscribe(
+            self, line: int, callback: callable, level: int=None
+            ) -> TeensySubscription:
+        '''Calls callback(event) for every event on line, or only for the
+        events on line with logiclevel level. Where the callback runs is
+        determined by the executor argument of the constructor. The events
+        are still handled by handle_event as well. Subscriptions don't apply
+        to columnar mode.
+        Returns the subscription, which keeps count of the calls and their
+        duration and can be passed to unsubscribe.
+        '''
+        if not 0 <= line < self.NUM_LINES:
+            raise TeensyError(TeensyError.INVALID_TRIGGER_LINE, str(line))
+        subscription = TeensySubscription(line, callback, level)
+        with self._subscribe_lock:
+            # The reader thread reads the tuples without locking, so they
+            # are replaced rather than modified.
+            current = self._subscriptions[line] or ()
+            self._subscriptions[line] = current + (subscription,)
+        return subscription
+
+    def unsubscribe(self, subscription: TeensySubscription):
+        '''Stops calling the callback of subscription.'''
+        with self._subscribe_lock:
+            current = self._subscriptions[subscription.line] or ()
+            remaining = tuple(s for s in current if s is not subscription)
+            self._subscriptions[subscription.line] = remaining or None
+
+    def subscriptions(self):
+        '''Returns a list of all current subscriptions.'''
+        return [s for subs in self._subscriptions if subs for s in subs]
+
+    def _notify(self, event, subscriptions):
+        '''Passes event to the subscriptions that are interested in it.'''
+        executor = self._executor
+        for subscription in subscriptions:
+            if subscription.level is None or \
+                    subscription.level == event.logiclevel:
+                if executor is None:
+                    subscription(event)
+                else:
+                    executor.submit(subscription, event)
+
+    def handle_event_array(self, frames):
+        '''In columnar mode a run of events is handled at once inside this
+        handler. frames is a numpy array of raw EVENT_TRIGGER frames, it is
+        a view on the read buffer that is only valid during this call. The
+        default behavior is to append the events to self.event_store.
+        '''
+        self.event_store.extend_frames(frames)
+
+    def _fill(self) -> int:
+        '''Reads the bytes that are currently available, or blocks shortly
+        until at least one byte is available, into the frame decoder.
+        Returns the number of bytes read.
+        '''
+        nbytes = min(self._serial.in_waiting or 1, _TeensyFramer.READSIZE)
+        data = self._serial.read(nbytes)
+        self._framer.feed(data)
+        return len(data)
+
+    def _dispatch_frames(self):
+        '''Handles all complete frames in the frame decoder. Events are passed
+        on to handle_event, when a frame is found that isn't an event, it is
+        returned as _TeensyPackage and the remaining frames are left alone.
+        Returns None if all complete frames are events.
+        '''
+        if self.event_store is not None:
+            return self._dispatch_event_runs()
+        framer = self._framer
+        buf = framer.view
+        unpack_event = _TeensyPackage._EVENT_TRIGGER.unpack_from
+        event_type = _TeensyPackage.EVENT_TRIGGER
+        stamp = self._stamp
+        subscriptions = self._subscriptions
+        recorder = self.recorder
         while True:
-            tbuf = bytearray()
-            while not tbuf:
-                tbuf.extend(self._serial.read())
-            totsize = tbuf[0]
-            while len(tbuf) != totsize:
-                tbuf.extend(self._serial.read(totsize - len(tbuf)))
-            pkt = _TeensyPackage(tbuf)
-            if handle_event and pkt.is_event():
-                _, _, line, timestamp, logic = pkt.parse_packet()
-                self.handle_event(TeensyLineEvent(timestamp, line, logic))
+            offset = framer.next_frame()
+            if offset < 0:
+                return None
+            if buf[offset + 1] == event_type:
+                if recorder is not None:
+                    recorder.record(buf, offset, self._recv_ns)
+                _, _, line, timestamp, logic = unpack_event(buf, offset)
+                if stamp is None:
+                    event = TeensyLineEvent(timestamp, line, logic)
+                else:
+                    event = TeensyStampedLineEvent(
+                        timestamp, line, logic, stamp(timestamp)
+                        )
+                self.handle_event(event)
+                if subscriptions[line]:
+                    self._notify(event, subscriptions[line])
             else:
+                return _TeensyPackage(bytearray(buf[offset:offset + buf[offset]]))
+
+    def _dispatch_event_runs(self):
+        '''The columnar counterpart of _dispatch_frames. Consecutive
+        EVENT_TRIGGER frames are decoded with one numpy call and passed on to
+        handle_event_array.
+        '''
+        framer = self._framer
+        buf = framer.view
+        frame_size = _TeensyPackage._EVENT_TRIGGER.size
+        event_type = _TeensyPackage.EVENT_TRIGGER
+        while True:
+            nframes = len(framer) // frame_size
+            if nframes:
+                headers = np.frombuffer(
+                    framer.buf, np.uint8, nframes * frame_size, framer.head
+                    ).reshape(nframes, frame_size)[:, :2]
+                is_event = (headers[:, 0] == frame_size) & \
+                           (headers[:, 1] == event_type)
+                nevents = nframes if is_event.all() else int(is_event.argmin())
+                if nevents:
+                    if self.recorder is not None:
+                        self.recorder.record_run(
+                            buf, framer.head, nevents, self._recv_ns
+                            )
+                    frames = np.frombuffer(
+                        framer.buf, _EVENT_TRIGGER_DTYPE, nevents, framer.head
+                        )
+                    framer.skip(nevents * frame_size)
+                    self.handle_event_array(frames)
+                    continue
+            offset = framer.next_frame()
+            if offset < 0:
+                return None
+            return _TeensyPackage(bytearray(buf[offset:offset + buf[offset]]))
+
+    def _receive(self):
+        '''Reads from the device into the frame decoder and notes the time
+        of the read when events are recorded.
+        '''
+        self._fill()
+        if self.recorder is not None:
+            self._recv_ns = self.recorder.clock()
+
+    def _read_packet(self) -> _TeensyPackage:
+        '''Reads from the stream until a packet arrives that isn't an event.
+        Events that arrive in the meanwhile are handled. This may only be
+        used when no commands are pending.
+        '''
+        assert not self._pending
+        while True:
+            pkt = self._dispatch_frames()
+            if pkt is not None:
+                # The frames that arrived together with the reply must not
+                # wait in the decoder until the device sends more.
+                self._dispatch_received()
                 return pkt
+            self._receive()
+
+    def _write(self, data):
+        '''Write bytes to the Teensy Device.'''
+        self._serial.write(data)
+        self._serial.flush()
 
     def _write_packet(self, pkt: _TeensyPackage):
         '''Write one teensy packet to the Teensy Device.'''
-        self._serial.write(pkt)
-        self._serial.flush()
+        self._write(pkt.buf)
+
+    def _fetch_events(self):
+        '''Read the available bytes from the serial device and handle all the
+        events and replies that are complete.'''
+        self._receive()
+        self._dispatch_received()
+
+    def _dispatch_received(self):
+        '''Handles all the events and replies that are complete in the frame
+        decoder.'''
+        package = self._dispatch_frames()
+        while package is not None:
+            self._handle_reply(package)
+            package = self._dispatch_frames()
+
+    def _handle_reply(self, package: _TeensyPackage):
+        '''Resolves the oldest pending command with the reply in package.'''
+        if not self._pending:
+            # Nobody is waiting for this reply, it is ignored.
+            return
+        recv_ns = tm.perf_counter_ns()
+        future, parse_reply, pkgtype, sent_ns = self._pending.popleft()
+        self._rtt[pkgtype].add((recv_ns - sent_ns) // 1000)
+        self._exchange = (sent_ns, recv_ns)
+        if future.done():
+            # The client cancelled the command.
+            return
+        try:
+            future.set_result(parse_reply(package))
+        except TeensyError as err:
+            future.set_exception(err)
+
+    def _flush_pending(self):
+        '''Waits until all pending commands are answered.'''
+        while self._pending:
+            self._fetch_events()
+
+    def _send(self, frame, future, parse_reply):
+        '''Writes frame, the bytes of a command, to the Teensy, once the
+        reply arrives, it is parsed by parse_reply and the result or error is
+        set on future. The command is stamped with the time it was written,
+        see rtt_stats.
+        '''
+        self._pending.append(
+            (future, parse_reply, frame[1], tm.perf_counter_ns())
+            )
+        self._write(frame)
+
+    def _send_batch(self, future, pkgtype, lines, parse_reply):
+        '''Writes the commands pkgtype for all lines in one go. Future is
+        resolved when all replies have arrived.
+        '''
+        if not lines:
+            future.set_result(None)
+            return
+        line_frame = _TeensyPackage.line_frame
+        data = b"".join([line_frame(pkgtype, line) for line in lines])
+        batch = _TeensyBatch(future, lines)
+        sent_ns = tm.perf_counter_ns()
+        for index in range(len(lines)):
+            self._pending.append(
+                (batch.part(index), parse_reply, pkgtype, sent_ns)
+                )
+        self._write(data)
+
+    @staticmethod
+    def _parse_register_reply(package: _TeensyPackage):
+        '''Parses the reply to a (single shot) register command.'''
+        reply = package.pkgtype()
+        if reply == _TeensyPackage.ACKNOWLEDGE_LINE_INVALID:
+            raise TeensyError(TeensyError.INVALID_TRIGGER_LINE)
+        elif reply != _TeensyPackage.ACKNOWLEDGE_SUCCES:
+            raise TeensyError(TeensyError.TEENSY_ERROR)
+
+    @staticmethod
+    def _parse_success_reply(package: _TeensyPackage):
+        '''Parses a reply that must be ACKNOWLEDGE_SUCCES.'''
+        if package.pkgtype() != _TeensyPackage.ACKNOWLEDGE_SUCCES:
+            raise TeensyError(TeensyError.TEENSY_ERROR)
+
+    @staticmethod
+    def _parse_time_reply(package: _TeensyPackage) -> int:
+        '''Parses the reply to a time request and returns the time.'''
+        if package.pkgtype() != _TeensyPackage.ACKNOWLEDGE_TIME:
+            raise TeensyError(TeensyError.TEENSY_ERROR)
+        _, _, time = package.parse_packet()
+        return time
 
-    def _fetch_event(self):
-        '''Try to read one event from the serial device.'''
-        package = self._read_packet(False)
-        assert package.is_event()
-        _, _, line, timestamp, logic = package.parse_packet()
-        event = TeensyLineEvent(timestamp, line, logic)
-        self.handle_event(event)
+    def _parse_stamped_time_reply(self, package: _TeensyPackage) -> tuple:
+        '''Parses the reply to a time request and returns the time between
+        the perf_counter_ns times of the exchange.
+        '''
+        sent_ns, recv_ns = self._exchange
+        return sent_ns, self._parse_time_reply(package), recv_ns
 
     def _identify(self):
         '''Does a handshake with the teensy'''
-        package = _TeensyPackage()
-        package.prepare_identify(ZEP_ZEP_TO_TEENSY_UUID)
-        self._write_packet(package)
+        self._write(_TeensyPackage._IDENTIFY_FRAME)
         package = self._read_packet()
-        _, type_, uuid = package.parse_packet()
-        if type_ != _TeensyPackage.IDENTIFY:
-            return TeensyError.NOT_A_TEENSY
+        if package.pkgtype() != _TeensyPackage.IDENTIFY:
+            raise TeensyError(TeensyError.NOT_A_TEENSY)
+        _, _, uuid = package.parse_packet()
         if uuid != ZEP_TEENSY_TO_ZEP_UUID:
-            return TeensyError.NOT_A_TEENSY
-        return TeensyError.NO_ERROR
+            raise TeensyError(TeensyError.NOT_A_TEENSY)
+
+    def submit(self, command: int, *args) -> Future:
+        '''Submits a command to the thread and returns a Future for its
+        result, it does not wait for the Teensy to reply. command is one of
+        the command values of this class, e.g. Teensy.REGISTER_INPUT, args
+        are the arguments of the matching method. The Future raises a
+        TeensyError if the command failed.
+        '''
+        if command not in self._task_handlers:
+            raise ValueError("Unknown command: {}".format(command))
+        if not self.connected:
+            raise TeensyError(TeensyError.NOT_CONNECTED)
+        task = _TeensyTask(command, *args)
+        self._tqueue.put(task)
+        if self._wakeup:
+            self._wakeup.set()
+        return task.future
+
+    def _check_lines(self, lines) -> list:
+        '''Returns lines as a list of ints. A TeensyError that names the
+        invalid lines is raised if any line isn't a valid line.
+        '''
+        valid = []
+        invalid = []
+        for line in lines:
+            try:
+                line = operator.index(line)
+            except TypeError:
+                invalid.append(line)
+                continue
+            if 0 <= line < self.NUM_LINES:
+                valid.append(line)
+            else:
+                invalid.append(line)
+        if invalid:
+            raise TeensyError(
+                TeensyError.INVALID_TRIGGER_LINE,
+                ", ".join(repr(line) for line in invalid)
+                )
+        return valid
 
     def register_line(self, line):
         '''Register one line on the teensy device. The line will trigger on
         rising and falling flanks.
         '''
-        if not self.connected:
-            raise TeensyError(TeensyError.NOT_CONNECTED)
-        task = _TeensyTask(_TeensyPackage.REGISTER_INPUT, line)
-        self._tqueue.put(task)
-        reply = self._aqueue.get()
-        if reply:
-            raise TeensyError(reply)
-
-    def _register_line(self, line):
-        package = _TeensyPackage()
-        package.prepare_register(line)
-        self._write_packet(package)
-        package = self._read_packet()
-        _, reply = package.parse_packet()
-        if   reply == _TeensyPackage.ACKNOWLEDGE_SUCCES:
-            return TeensyError.NO_ERROR
-        elif reply == _TeensyPackage.ACKNOWLEDGE_LINE_INVALID:
-            return TeensyError.INVALID_TRIGGER_LINE
-        else:
-            return TeensyError.TEENSY_ERROR
+        line, = self._check_lines([line])
+        self.submit(self.REGISTER_INPUT, line).result()
+
+    def _register_line(self, future, line):
+        self._send(
+            _TeensyPackage.line_frame(self.REGISTER_INPUT, line),
+            future,
+            self._parse_register_reply
+            )
+
+    def register_lines(self, lines):
+        '''Register multiple lines on the teensy device. All commands are
+        written at once, if some lines couldn't be registered a TeensyError
+        is raised after all lines have been tried. Lines that aren't valid
+        at all are refused before anything is written, with one TeensyError
+        that names them.
+        '''
+        lines = self._check_lines(lines)
+        self.submit(self.REGISTER_INPUTS, lines).result()
+
+    def _register_lines(self, future, lines):
+        self._send_batch(
+            future,
+            self.REGISTER_INPUT,
+            lines,
+            self._parse_register_reply
+            )
 
     def register_single_shot(self, line):
         ''' Register a single shot Teensy line. The line can be triggered once.
         It depends on the current state of the Teensy whether it will be a
         rising or a falling flank.
         '''
-        if not self.connected:
-            raise TeensyError(TeensyError.NOT_CONNECTED)
-        task = _TeensyTask(_TeensyPackage.REGISTER_SINGLE_SHOT, line)
-        self._tqueue.put(task)
-        reply = self._aqueue.get()
-        if reply:
-            raise TeensyError(reply)
-
-    def _register_single_shot(self, line):
-        package = _TeensyPackage()
-        package.prepare_single_shot(line)
-        self._write_packet(package)
-        package = self._read_packet()
-        _, reply, _ = package.parse_packet()
-        if   reply == _TeensyPackage.ACKNOWLEDGE_SUCCES:
-            return TeensyError.NO_ERROR
-        elif reply == _TeensyPackage.ACKNOWLEDGE_LINE_INVALID:
-            return TeensyError.INVALID_TRIGGER_LINE
-        else:
-            return TeensyError.TEENSY_ERROR
+        line, = self._check_lines([line])
+        self.submit(self.REGISTER_SINGLE_SHOT, line).result()
+
+    def _register_single_shot(self, future, line):
+        self._send(
+            _TeensyPackage.line_frame(self.REGISTER_SINGLE_SHOT, line),
+            future,
+            self._parse_register_reply
+            )
+
+    def register_single_shots(self, lines):
+        '''Register multiple single shot lines, see register_lines.'''
+        lines = self._check_lines(lines)
+        self.submit(self.REGISTER_SINGLE_SHOTS, lines).result()
+
+    def _register_single_shots(self, future, lines):
+        self._send_batch(
+            future,
+            self.REGISTER_SINGLE_SHOT,
+            lines,
+            self._parse_register_reply
+            )
 
     def deregister_input(self, line):
         '''Deregister a previously registerd (single_shot) line.'''
-        if not self.connected:
-            raise TeensyError(TeensyError.NOT_CONNECTED)
-        task = _TeensyTask(_TeensyPackage.DEREGISTER_INPUT, line)
-        self._tqueue.put(task)
-        reply = self._aqueue.get()
-        if reply:
-            raise TeensyError(reply)
-
-    def _deregister_input(self, line):
-        package = _TeensyPackage()
-        package.prepare_deregister(line)
-        self._write_packet(package)
-        package = self._read_packet()
-        _, reply = package.parse_packet()
-        assert reply == _TeensyPackage.ACKNOWLEDGE_SUCCES
-        return TeensyError.NO_ERROR
+        line, = self._check_lines([line])
+        self.submit(self.DEREGISTER_INPUT, line).result()
+
+    def _deregister_input(self, future, line):
+        self._send(
+            _TeensyPackage.line_frame(self.DEREGISTER_INPUT, line),
+            future,
+            self._parse_success_reply
+            )
+
+    def deregister_inputs(self, lines):
+        '''Deregister multiple lines, see register_lines.'''
+        lines = self._check_lines(lines)
+        self.submit(self.DEREGISTER_INPUTS, lines).result()
+
+    def _deregister_inputs(self, future, lines):
+        self._send_batch(
+            future,
+            self.DEREGISTER_INPUT,
+            lines,
+            self._parse_success_reply
+            )
 
-    def time(self):
+    def time(self, stamped: bool=False):
         '''Obtain a timestamp from the Teensy.
+        If stamped is True, a tuple (host_send, teensy_us, host_recv) is
+        returned, where host_send and host_recv are the time.perf_counter_ns
+        times at which the request was written and the reply was read.
         '''
-        if not self.connected:
-            raise TeensyError(TeensyError.NOT_CONNECTED)
-        task = _TeensyTask(_TeensyPackage.TIME)
-        self._tqueue.put(task)
-        reply, time = self._aqueue.get()
-        if reply:
-            raise TeensyError(reply)
-        return time
+        return self.submit(self.TIME, stamped).result()
 
-    def _time(self):
-        package = _TeensyPackage()
-        package.prepare_time()
-        self._write_packet(package)
-        package = self._read_packet()
-        _, reply, time = package.parse_packet()
-        if reply == _TeensyPackage.ACKNOWLEDGE_TIME:
-            return TeensyError.NO_ERROR, time
+    def _time_request(self, future, stamped: bool=False):
+        if stamped:
+            parse_reply = self._parse_stamped_time_reply
         else:
-            return TeensyError(TeensyError.TEENSY_ERROR), None
+            parse_reply = self._parse_time_reply
+        self._send(_TeensyPackage._TIME_FRAME, future, parse_reply)
+
+    def time_samples(self, samples: int) -> tuple:
+        '''Does samples time exchanges back to back in one task of the
+        thread and returns the arrays (host_send, teensy_us, host_recv), see
+        time(stamped=True). The arrays are numpy arrays of int64, or
+        array.arrays when numpy isn't available.
+        '''
+        exchanges = self.submit(
+            self.CLOCK_SAMPLES, tm.perf_counter_ns, samples
+            ).result()
+        columns = (
+            [sample.host_send for sample in exchanges],
+            [sample.teensy for sample in exchanges],
+            [sample.host_recv for sample in exchanges]
+            )
+        if np is not None:
+            return tuple(np.array(column, np.int64) for column in columns)
+        return tuple(array.array("q", column) for column in columns)
 
     def time_set(self, time_us: int):
         '''Sets the time in us on the teensy.
         '''
-        if not self.connected:
-            raise TeensyError(TeensyError.NOT_CONNECTED)
-        task = _TeensyTask(_TeensyPackage.DEREGISTER_INPUT, time_us)
-        self._tqueue.put(task)
-        reply = self._aqueue.get()
-        if reply:
-            raise TeensyError(reply)
+        self.submit(self.TIME_SET, self._check_time(time_us)).result()
+
+    @staticmethod
+    def _check_time(time_us) -> int:
+        '''Returns time_us as an int, a ValueError is raised if it doesn't
+        fit the clock of the Teensy.
+        '''
+        try:
+            time_us = operator.index(time_us)
+        except TypeError:
+            raise ValueError("time_us must be an integer")
+        if not 0 <= time_us < 1 << 64:
+            raise ValueError("time_us must be from 0 up to 2 ** 64")
+        return time_us
+
+    def _time_set_frame(self, time_us: int) -> bytearray:
+        '''Packs a TIME_SET frame into the buffer that is reused for it.'''
+        layout = _TeensyPackage._TIME_SET
+        layout.pack_into(
+            self._time_set_buf, 0, layout.size, _TeensyPackage.TIME_SET, time_us
+            )
+        return self._time_set_buf
+
+    def _time_set_request(self, future, time_us: int):
+        self._send(
+            self._time_set_frame(time_us), future, self._parse_success_reply
+            )
 
     def _time_set(self, time_us: int):
-        package = _TeensyPackage()
-        package.prepare_set_time(time_us)
-        self._write_packet(package)
+        '''Sets the Teensy time from inside the thread.'''
+        sent_ns = tm.perf_counter_ns()
+        self._write(self._time_set_frame(time_us))
         package = self._read_packet()
-        _, reply = package.parse_packet()
-        assert reply == _TeensyPackage.ACKNOWLEDGE_SUCCES
-        return TeensyError.NO_ERROR
-
-    def sync_clock(self, cclock: callable, thres_us: int=100):
+        self._rtt[self.TIME_SET].add((tm.perf_counter_ns() - sent_ns) // 1000)
+        self._parse_success_reply(package)
+
+    def sync_clock(
+            self,
+            cclock: callable,
+            thres_us: int=None,
+            samples: int=16,
+            apply: bool=True
+            ) -> tc.ClockSync:
         '''Synchronizes the teensy with the cclock. The cclock must be a
         callable function or object that can safely operate from another
         thread. Also when called it should provide time in a integral value
         in us.
-        thres_us is the threshold, in order to sync the time is set and
-        asked back from the teensy, this returned value must be less than
-        the threshold.
+        The offset between the clocks is estimated from samples time
+        exchanges, see teensyclock.estimate_offset. If apply is True the
+        Teensy clock is set to cclock once and the offset is measured again,
+        otherwise the Teensy clock is left alone and the offset can be
+        corrected for at the host, e.g. with the to_host_time method of the
+        result. Either way the result is a teensyclock.ClockSync that
+        reports the achieved precision, it is also kept in self.clock_sync.
+        If thres_us is given, a TeensyError is raised when the remaining
+        offset plus its uncertainty is not less than thres_us.
         Note although syncs the clocks, this function does not correct for
         clock drift. Hence, over time, the clock of the Teensy might drift
         away from cclock.
         '''
-        if not self.connected:
-            raise TeensyError(TeensyError.NOT_CONNECTED)
-
         if not isinstance(cclock(), int):
             raise ValueError("cclock() must return an integer in µs")
+        if samples < 1:
+            raise ValueError("sync_clock requires at least one sample")
+
+        result = self.submit(self.SYNC_CLOCK, cclock, samples, apply).result()
+        self.clock_sync = result
+        if self._stats is not None:
+            self._stats.syncs.append(result)
+        if self.recorder is not None:
+            self.recorder.update_metadata(
+                clock_sync={
+                    "offset_us" : result.offset,
+                    "uncertainty_us" : result.uncertainty,
+                    "rtt_us" : result.rtt,
+                    "samples" : result.nsamples,
+                    "applied" : result.applied
+                    }
+                )
+        if thres_us is not None:
+            if abs(result.offset) + result.uncertainty >= thres_us:
+                raise TeensyError(TeensyError.UNABLE_TO_SYNC, str(result))
+        return result
+
+    def _time_exchange(self, cclock: callable) -> tc.ClockSample:
+        '''Obtains the Teensy time and the cclock times just before the
+        request and just after the reply, from inside the thread.
+        '''
+        sent_ns = tm.perf_counter_ns()
+        host_send = cclock()
+        self._write(_TeensyPackage._TIME_FRAME)
+        package = self._read_packet()
+        host_recv = cclock()
+        self._rtt[self.TIME].add((tm.perf_counter_ns() - sent_ns) // 1000)
+        return tc.ClockSample(
+            host_send, self._parse_time_reply(package), host_recv
+            )
 
-        task = _TeensyTask(self.SYNC_CLOCK, cclock, thres_us)
-        self._tqueue.put(task)
-        reply = self._aqueue.get()
-        if reply:
-            raise TeensyError(reply)
-
-    def _sync_clock(self, cclock: callable, thres_us: int=100) -> int:
-        synced = False
-        tries = 10
-        while not synced:
-            for _ in range(tries):
-                tim = cclock()
-                self._time_set(tim)
-                err, teensy_time = self._time()
-                if err:
-                    return err
-                synced = teensy_time - tim < thres_us
-                if synced:
-                    break
-            break
-        return TeensyError.NO_ERROR if synced else TeensyError.UNABLE_TO_SYNC
+    def _sync_clock(self, future, cclock: callable, samples: int, apply: bool):
+        # The exchanges below need the line for themselves.
+        self._flush_pending()
+        result = tc.estimate_offset(
+            [self._time_exchange(cclock) for _ in range(samples)]
+            )
+        if apply:
+            # The Teensy sets its clock about half a round trip after the
+            # host read cclock.
+            self._time_set(cclock() + result.rtt // 2)
+            result = tc.estimate_offset(
+                [self._time_exchange(cclock) for _ in range(samples)]
+                )
+            result.applied = True
+        future.set_result(result)
+
+    def track_drift(
+            self,
+            cclock: callable,
+            interval: float=1.0,
+            window: int=64,
+            stamp_events: bool=False
+            ) -> tc.DriftModel:
+        '''Starts tracking the drift of the Teensy clock relative to cclock,
+        see sync_clock for the requirements of cclock. Every interval
+        seconds the thread does a time exchange with the Teensy and refits
+        a teensyclock.DriftModel to the last window exchanges. The model is
+        returned, its to_host_time method converts Teensy timestamps, also
+        arrays of them, to cclock time and its residuals record how well
+        the model predicted every new exchange.
+        If stamp_events is True, the events that are received are
+        TeensyStampedLineEvents with the host time according to the model
+        in their host_time member. This does not apply to columnar mode.
+        '''
+        if not isinstance(cclock(), int):
+            raise ValueError("cclock() must return an integer in µs")
+        model = tc.DriftModel(window)
+        self.submit(
+            self.TRACK_DRIFT, model, cclock, interval, stamp_events
+            ).result()
+        return model
+
+    def stop_tracking_drift(self):
+        '''Stops tracking the clock drift and stamping the events.'''
+        self.submit(self.TRACK_DRIFT, None, None, 0.0, False).result()
+
+    def _clock_samples(self, future, cclock: callable, samples: int):
+        '''Does samples time exchanges back to back, the result is a list of
+        teensyclock.ClockSamples.
+        '''
+        self._flush_pending()
+        future.set_result([self._time_exchange(cclock) for _ in range(samples)])
+
+    def _track_drift(self, future, model, cclock, interval, stamp_events):
+        self._stamp = None
+        self._drift = None
+        if model is not None:
+            # Fit the model before the first event is stamped.
+            self._flush_pending()
+            model.add(self._time_exchange(cclock))
+            self._drift = (model, cclock, interval)
+            self._drift_due = tm.monotonic() + interval
+            if stamp_events:
+                self._stamp = model.to_host_time
+        future.set_result(None)
 
     def _handle_task(self, task):
         '''Handles a Teensy task, like registering a input line etc.
         A task is a list of [TeensyPackage.MESSAGE and it arguments]
         '''
-        #alias
-        tp = _TeensyPackage
-        tasks = {
-            # values not from _TeensyPackage (these should be negative)
-            self.SYNC_CLOCK         : self._sync_clock,
-
-            #values from _TeensyPackage (these should be positive)
-            tp.IDENTIFY             : None, # is handled differently
-            tp.REGISTER_INPUT       : self._register_line,
-            tp.REGISTER_SINGLE_SHOT : self._register_single_shot,
-            tp.DEREGISTER_INPUT     : self._deregister_input,
-            tp.TIME                 : self._time,
-            tp.TIME_SET             : self._time_set,
-            #tp.ACKNOWLEDGE_SUCCES only on teensy not on client
-        }
-        return tasks[task.task](*task.args, **task.kwargs)
+        if not task.future.set_running_or_notify_cancel():
+            return
+        self._task = task
+        try:
+            self._task_handlers[task.task](
+                task.future, *task.args, **task.kwargs
+                )
+        except Exception as err:
+            # Whatever went wrong, the client must not wait forever.
+            if not task.future.done():
+                task.future.set_exception(err)
+        self._task = None
 
     def __enter__(self):
         return self
@@ -643,6 +1995,30 @@ class Teensy(object):
     def __exit__(self, exc_type, exc_value, traceback):
         self.close()
 
+def _open_device_file(devfn, flags: int=0) -> int:
+    '''Opens a device file for reading and writing and returns its file
+    descriptor, extra flags are or-ed with the default flags.
+    '''
+    flags |= os.O_RDWR
+    try:
+        # UNIX flavors
+        flags |= os.O_NOCTTY
+    except AttributeError:
+        # windows
+        flags |= os.O_BINARY
+
+    try:
+        fd = os.open(devfn, flags)
+    except OSError as err:
+        raise TeensyError(TeensyError.UNABLE_TO_CONNECT, str(err))
+
+    if os.name == "posix" and os.isatty(fd):
+        # The protocol is binary, so the terminal must not interpret or
+        # buffer the bytes. A read blocks until at least one byte arrived.
+        import tty
+        tty.setraw(fd)
+    return fd
+
 class UnixTeensy(Teensy):
 
     '''This class is just like the original teensy, however, it doesn't use
@@ -653,22 +2029,6 @@ class UnixTeensy(Teensy):
     is written to address that issue.
     '''
 
-    def __init__(self, devfn="/dev/ttyACM0"):
-        ''' Opens communication with serial device.
-        devfn is a path to the device name or something like COM5 on windows.
-        '''
-        self.connected = False
-        self._quit = None   # Becomes an event to stop the thread.
-        self._thread = None   # Becomes the thread on connection
-        self._tqueue = None   # Becomes Task queue on connection
-        self._aqueue = None   # Becomes Answer queue on connection
-        self.events = None   # Becomes queue for events on connection
-
-        if devfn:
-            self.connect(devfn)
-        else:
-            self._serial = None
-
     def close(self):
         ''' Closes the thread and the serial connection
         Make sure not to forget to call this function when you don't need
@@ -676,10 +2036,7 @@ class UnixTeensy(Teensy):
         the "with Teensy() as instance:" syntax. If you forget to use this
         the thread doesn't shut down.
         '''
-        self._quit.set()
-        self._thread.join(0.1)
-        if self._thread.isAlive():
-            raise RuntimeError("Unable to close Teensy thread.")
+        self._stop_thread()
         os.close(self._serial)
 
     def connect(self, devfn):
@@ -690,83 +2047,32 @@ class UnixTeensy(Teensy):
         if self.connected:
             self.close()
 
-        flags = os.O_RDWR
-        try:
-            # UNIX flavors
-            flags |= os.O_NOCTTY
-        except AttributeError:
-            # windows
-            flags |= os.O_BINARY
-
-        try:
-            self._serial = os.open(devfn, flags)
-        except OSError as err:
-            raise TeensyError(TeensyError.UNABLE_TO_CONNECT, str(err))
-
-        # empty queues to be sure.
-        self._tqueue = q.Queue()
-        self._aqueue = q.Queue()
-        self.events = q.Queue()
-
+        self._serial = _open_device_file(devfn)
+        if self.recorder is not None:
+            self.recorder.update_metadata(device=devfn)
+        self._reset_queues()
         self._start_thread()
 
-    def run(self):
-        ''' The Teensy thread, the Teensy is read from or written to from here.
-        '''
-        assert self._serial
-        self._quit = threading.Event()
-        timeout = 0.001 #one millisecond
-        tasks = self._tqueue
-        reply = self._aqueue
+    def _fileno(self):
+        '''Returns the file descriptor of the device.'''
+        return self._serial
 
-        try:
-            self._identify()
-
-            #sync with client
-            reply.put(TeensyError.NO_ERROR)
-
-            poller = select.poll()
-            poller.register(self._serial, select.POLLIN)
-
-            while not self._quit.is_set():
-                try:
-                    task = tasks.get(True, timeout)
-                    answer = self._handle_task(task)
-                    reply.put(answer)
-                except q.Empty:
-                    fevents = poller.poll(timeout)
-                    while fevents:
-                        self._fetch_event()
-                        fevents = poller.poll(timeout)
-
-        except Exception:
-            # Abort from thread when an uncaught exception occurs.
-            import sys
-            import traceback
-            print(traceback.print_exc(), file=sys.stderr)
-            self.connected = False
-            return
-
-    def _read_packet(self, handle_event: bool=True) -> _TeensyPackage:
-        '''Reads one packet from the stream, if it is an event it will be
-        handled.'''
-        while True:
-            tbuf = bytearray()
-            while not tbuf:
-                tbuf.extend(os.read(self._serial, 1))
-            totsize = tbuf[0]
-            while len(tbuf) != totsize:
-                tbuf.extend(os.read(self._serial, totsize - len(tbuf)))
-            pkt = _TeensyPackage(tbuf)
-            if handle_event and pkt.is_event():
-                _, _, line, timestamp, logic = pkt.parse_packet()
-                self.handle_event(TeensyLineEvent(timestamp, line, logic))
-            else:
-                return pkt
-
-    def _write_packet(self, pkt: _TeensyPackage):
-        '''Write one teensy packet to the Teensy Device.'''
-        os.write(self._serial, pkt.buf)
+    def _fill(self) -> int:
+        '''Reads the bytes that are currently available, or blocks until at
+        least one byte is available, straight into the frame decoder.
+        Returns the number of bytes read.
+        '''
+        nbytes = os.readv(self._serial, [self._framer.writable()])
+        if not nbytes:
+            raise TeensyError(TeensyError.NOT_CONNECTED, "end of file")
+        self._framer.commit(nbytes)
+        return nbytes
+
+    def _write(self, data):
+        '''Write bytes to the Teensy Device.'''
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self._serial, view):]
 
 def _test():
     print(version())
@@ -0,0 +1,595 @@
+#!/usr/bin/env python3
+
+# This file is part of pyteensy.
+#
+# pyteensy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# pyteensy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with pyteensy.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+'''teensybench contains microbenchmarks for the hot paths of pyteensy.
+Every benchmark is a function that returns a dict with its results, the
+main function runs the benchmarks that are selected on the command line
+and prints the results, optionally they are also written as JSON so the
+results of releases can be compared. The benchmarks that need a Teensy run
+against a teensyemu.TeensyEmulator unless a device is given.
+'''
+
+from __future__ import print_function
+import argparse as arg
+import contextlib
+import gc
+import inspect
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import pyteensy as t
+import teensyemu as emu
+
+
+def _event_frames(number, nlines=8):
+    '''Returns a bytes object with number EVENT_TRIGGER frames.'''
+    pkt = t._TeensyPackage
+    frame = pkt._EVENT_TRIGGER
+    size = frame.size
+    buf = bytearray(size * number)
+    for i in range(number):
+        frame.pack_into(
+            buf, i * size, size, pkt.EVENT_TRIGGER, i % nlines, i * 10, i & 1
+            )
+    return bytes(buf)
+
+
+def _frame_file(number):
+    '''Returns a file descriptor of an unlinked file that contains number
+    event frames, the file position is at the start of the file.
+    '''
+    fd, fn = tempfile.mkstemp(prefix="teensybench")
+    os.unlink(fn)
+    os.write(fd, _event_frames(number))
+    os.lseek(fd, 0, os.SEEK_SET)
+    return fd
+
+
+class _CountingUnixTeensy(t.UnixTeensy):
+    '''A UnixTeensy that isn't connected to a device, it reads from an
+    arbitrary file descriptor and counts the reads and the events.
+    '''
+
+    def __init__(self, fd, columnar=False):
+        super(_CountingUnixTeensy, self).__init__(None, columnar=columnar)
+        self._serial = fd
+        self._framer = t._TeensyFramer()
+        self.syscalls = 0
+        self.nevents = 0
+
+    def _fill(self):
+        self.syscalls += 1
+        return super(_CountingUnixTeensy, self)._fill()
+
+    def handle_event(self, event):
+        self.nevents += 1
+
+    def handle_event_array(self, frames):
+        super(_CountingUnixTeensy, self).handle_event_array(frames)
+        self.nevents += len(frames)
+
+
+def _legacy_read_events(fd, number):
+    '''Reads number events the way the worker thread did before frames were
+    decoded in chunks: one read for the size byte and one for the rest of
+    each frame. Returns the number of read system calls.
+    '''
+    syscalls = 0
+    for _ in range(number):
+        tbuf = bytearray()
+        while not tbuf:
+            tbuf.extend(os.read(fd, 1))
+            syscalls += 1
+        totsize = tbuf[0]
+        while len(tbuf) != totsize:
+            tbuf.extend(os.read(fd, totsize - len(tbuf)))
+            syscalls += 1
+        pkt = t._TeensyPackage(tbuf)
+        assert pkt.is_event()
+        _, _, line, timestamp, logic = pkt.parse_packet()
+        t.TeensyLineEvent(timestamp, line, logic)
+    return syscalls
+
+
+def bench_framing(number=100000):
+    '''Compares reading number EVENT_TRIGGER frames one by one with
+    reading them in chunks via the frame decoder.
+    '''
+    results = {}
+
+    fd = _frame_file(number)
+    try:
+        start = time.perf_counter()
+        syscalls = _legacy_read_events(fd, number)
+        duration = time.perf_counter() - start
+    finally:
+        os.close(fd)
+    results["legacy"] = {
+        "syscalls_per_event" : syscalls / number,
+        "events_per_s" : number / duration
+        }
+
+    fd = _frame_file(number)
+    try:
+        teensy = _CountingUnixTeensy(fd)
+        start = time.perf_counter()
+        while teensy.nevents < number:
+            teensy._fetch_events()
+        duration = time.perf_counter() - start
+    finally:
+        os.close(fd)
+    results["chunked"] = {
+        "syscalls_per_event" : teensy.syscalls / number,
+        "events_per_s" : number / duration
+        }
+    return results
+
+
+def bench_columnar(number=1000000):
+    '''Compares decoding number EVENT_TRIGGER frames into TeensyLineEvents
+    with decoding them into a TeensyEventStore.
+    '''
+    results = {}
+    for variant, columnar in (("objects", False), ("columnar", True)):
+        fd = _frame_file(number)
+        try:
+            teensy = _CountingUnixTeensy(fd, columnar)
+            start = time.perf_counter()
+            while teensy.nevents < number:
+                teensy._fetch_events()
+            duration = time.perf_counter() - start
+        finally:
+            os.close(fd)
+        results[variant] = {"events_per_s" : number / duration}
+    return results
+
+
+class _DictEvent(object):
+    '''The dict backed TeensyEvent from before events used __slots__.'''
+
+    def __init__(self, timestamp):
+        self.timestamp = timestamp
+
+
+class _DictLineEvent(_DictEvent):
+    '''The dict backed TeensyLineEvent from before events used __slots__.'''
+
+    def __init__(self, time, line, logiclevel):
+        super(_DictLineEvent, self).__init__(time)
+        self.line = line
+        self.logiclevel = 1 if logiclevel else 0
+
+
+def _collect_objects(cls, number):
+    '''Creates number events of type cls and keeps them in a list.'''
+    return [cls(i * 10, i & 7, i & 1) for i in range(number)]
+
+
+def _collect_store(number):
+    '''Appends number events to a TeensyEventStore in chunks of frames.'''
+    chunk = 4096
+    frames = t.np.frombuffer(_event_frames(chunk), t._EVENT_TRIGGER_DTYPE)
+    store = t.TeensyEventStore()
+    for start in range(0, number, chunk):
+        store.extend_frames(frames[:number - start])
+    return store
+
+
+def bench_events(number=10000000):
+    '''Measures the construction cost and the memory per event of number
+    events for the old dict backed events, the __slots__ based
+    TeensyLineEvent and a columnar TeensyEventStore.
+    '''
+    variants = (
+        ("dict", lambda: _collect_objects(_DictLineEvent, number)),
+        ("slots", lambda: _collect_objects(t.TeensyLineEvent, number)),
+        ("store", lambda: _collect_store(number)),
+        )
+    results = {}
+    for variant, collect in variants:
+        gc.collect()
+        tracked = len(gc.get_objects())
+        start = time.perf_counter()
+        events = collect()
+        duration = time.perf_counter() - start
+        gc_objects = len(gc.get_objects()) - tracked
+        del events
+        gc.collect()
+
+        tracemalloc.start()
+        events = collect()
+        nbytes, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del events
+
+        results[variant] = {
+            "ns_per_event" : duration * 1e9 / number,
+            "bytes_per_event" : nbytes / number,
+            "gc_objects_per_event" : gc_objects / number
+            }
+    return results
+
+
+class _LegacyEncoder(t.UnixTeensy):
+    '''Encodes commands the way the worker thread did before frames were
+    prebuilt: a new dispatch dict and a new _TeensyPackage per command.
+    '''
+
+    def _handle_task(self, task):
+        if not task.future.set_running_or_notify_cancel():
+            return
+        tp = t._TeensyPackage
+        tasks = {
+            self.SYNC_CLOCK             : self._sync_clock,
+            self.REGISTER_INPUTS        : self._register_lines,
+            self.REGISTER_SINGLE_SHOTS  : self._register_single_shots,
+            self.DEREGISTER_INPUTS      : self._deregister_inputs,
+            self.TRACK_DRIFT            : self._track_drift,
+            tp.IDENTIFY                 : None,
+            tp.REGISTER_INPUT           : self._register_line,
+            tp.REGISTER_SINGLE_SHOT     : self._register_single_shot,
+            tp.DEREGISTER_INPUT         : self._deregister_input,
+            tp.TIME                     : self._time_request,
+            tp.TIME_SET                 : self._time_set_request,
+        }
+        tasks[task.task](task.future, *task.args, **task.kwargs)
+
+    def _register_line(self, future, line):
+        pkg = t._TeensyPackage
+        package = pkg()
+        package.buf = bytearray(
+            pkg._REGISTER_INPUT.pack(3, pkg.REGISTER_INPUT, line)
+            )
+        self._send(package.buf, future, self._parse_register_reply)
+
+    def _time_request(self, future):
+        pkg = t._TeensyPackage
+        package = pkg()
+        package.buf = bytearray(pkg._TIME.pack(2, pkg.TIME))
+        self._send(package.buf, future, self._parse_time_reply)
+
+    def _time_set_request(self, future, time_us):
+        pkg = t._TeensyPackage
+        package = pkg()
+        package.buf = bytearray(pkg._TIME_SET.pack(10, pkg.TIME_SET, time_us))
+        self._send(package.buf, future, self._parse_success_reply)
+
+
+def _command_teensy(cls):
+    '''Returns a Teensy of cls without a device or a thread, that discards
+    the commands it writes, so only the overhead of the commands is left.
+    '''
+    teensy = cls(None)
+    teensy._reset_queues()
+    teensy._write = lambda data: None
+    return teensy
+
+
+def bench_commands(number=100000, repeat=5):
+    '''Measures the overhead of handling a command inside the worker
+    thread, up to writing it: building a dispatch dict and packing a new
+    frame per command versus a dispatch table and frames that are built
+    once. The best of repeat runs is reported.
+    '''
+    commands = (
+        ("register", t.Teensy.REGISTER_INPUT, lambda i: (i & 255,)),
+        ("time", t.Teensy.TIME, lambda i: ()),
+        ("time_set", t.Teensy.TIME_SET, lambda i: (i,))
+        )
+    results = {}
+    for variant, cls in (("legacy", _LegacyEncoder), ("prebuilt", t.UnixTeensy)):
+        teensy = _command_teensy(cls)
+        results[variant] = {}
+        for name, command, args in commands:
+            durations = []
+            for _ in range(repeat):
+                tasks = [t._TeensyTask(command, *args(i)) for i in range(number)]
+                handle_task = teensy._handle_task
+                start = time.perf_counter()
+                for task in tasks:
+                    handle_task(task)
+                durations.append(time.perf_counter() - start)
+                teensy._pending.clear()
+            results[variant][name + "_ns"] = min(durations) * 1e9 / number
+        teensy._wakeup.close()
+    return results
+
+
+def _percentiles(durations, percentiles=(50, 90, 99)):
+    '''Returns a dict with the percentiles of durations in microseconds.'''
+    durations = sorted(durations)
+    results = {}
+    for percentile in percentiles:
+        index = min(len(durations) - 1, len(durations) * percentile // 100)
+        results["p{}_us".format(percentile)] = durations[index] * 1e6
+    return results
+
+
+@contextlib.contextmanager
+def _device(device=None, **kwargs):
+    '''Yields device, or the device of a TeensyEmulator that is created
+    with kwargs when device is None.
+    '''
+    if device:
+        yield device
+        return
+    with emu.TeensyEmulator(**kwargs) as emulator:
+        yield emulator.devfn
+
+
+@contextlib.contextmanager
+def _emulator_process(rate, burst, number):
+    '''Runs a TeensyEmulator in another process, so it doesn't compete
+    with the client for the interpreter and the process time of the
+    client can be measured. Yields its device.
+    '''
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          "teensyemu.py")
+    proc = subprocess.Popen(
+        [sys.executable, script, "-r", str(rate), "-b", str(burst),
+         "-n", str(number)],
+        stdout=subprocess.PIPE,
+        universal_newlines=True
+        )
+    try:
+        yield proc.stdout.readline().strip()
+    finally:
+        proc.terminate()
+        proc.wait()
+        proc.stdout.close()
+
+
+def _received(teensy, columnar):
+    if columnar:
+        return len(teensy.event_store)
+    return teensy.events.qsize()
+
+
+def bench_throughput(number=200000, rate=1000000, burst=256, timeout=60.0):
+    '''Measures the maximum number of events per second that a Teensy and
+    a UnixTeensy sustain and the process time they use per event. The
+    emulator offers rate events per second, more than a client handles,
+    so the client is the bottleneck.
+    '''
+    variants = (
+        ("teensy", t.Teensy, False),
+        ("unix", t.UnixTeensy, False),
+        ("unix_columnar", t.UnixTeensy, True)
+        )
+    results = {}
+    for variant, cls, columnar in variants:
+        with _emulator_process(rate, burst, number) as device:
+            with cls(device, columnar=columnar) as teensy:
+                cpu = time.process_time()
+                start = time.perf_counter()
+                teensy.register_lines([1, 2, 3, 4])
+                while _received(teensy, columnar) < number:
+                    if time.perf_counter() - start > timeout:
+                        break
+                    time.sleep(0.001)
+                duration = time.perf_counter() - start
+                cpu = time.process_time() - cpu
+                received = _received(teensy, columnar)
+        results[variant] = {
+            "events_per_s" : received / duration,
+            "cpu_us_per_event" : cpu * 1e6 / max(received, 1),
+            "cpu_percent" : cpu * 100 / duration
+            }
+    return results
+
+
+def bench_delivery(number=2000, rate=1000.0):
+    '''Measures the time from the moment the emulator writes an event
+    frame until a consumer thread obtains the event with events.get().
+    '''
+    variants = (("teensy", t.Teensy), ("unix", t.UnixTeensy))
+    results = {}
+    for variant, cls in variants:
+        latencies = []
+        # The emulated clock is time.monotonic in us, so a timestamp is
+        # the moment its frame was written.
+        start_us = time.monotonic_ns() // 1000
+        emulator = emu.TeensyEmulator(start_us=start_us, count=number)
+        with emulator, cls(emulator.devfn) as teensy:
+
+            def consume():
+                for _ in range(number):
+                    event = teensy.events.get()
+                    latencies.append(
+                        (time.monotonic_ns() // 1000 - event.timestamp) / 1e6
+                        )
+
+            consumer = threading.Thread(target=consume)
+            consumer.start()
+            teensy.register_line(1)
+            emulator.set_load(rate, 1, number)
+            consumer.join()
+        results[variant] = _percentiles(latencies)
+    return results
+
+
+def bench_setup(device=None, number=100, unix=False, nlines=32):
+    '''Measures the time it takes to register and deregister a profile of
+    nlines lines: one command at a time versus all commands at once.
+    '''
+    cls = t.UnixTeensy if unix else t.Teensy
+    lines = list(range(nlines))
+    sequential = []
+    batched = []
+    with _device(device) as devfn, cls(devfn) as teensy:
+        for _ in range(number):
+            start = time.perf_counter()
+            for line in lines:
+                teensy.register_line(line)
+            for line in lines:
+                teensy.deregister_input(line)
+            sequential.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            teensy.register_lines(lines)
+            teensy.deregister_inputs(lines)
+            batched.append(time.perf_counter() - start)
+    return {
+        "sequential" : _percentiles(sequential),
+        "batched" : _percentiles(batched)
+        }
+
+
+class _PollingTeensy(t.Teensy):
+    '''A Teensy whose thread polls the device and the task queue every
+    millisecond, as it does where the device can't be selected on.
+    '''
+
+    def _fileno(self):
+        return None
+
+
+def bench_latency(device=None, number=1000, idle=1.0):
+    '''Measures the round trip time of number time() and register_line()
+    commands and the processor time the worker thread uses while the Teensy
+    is idle.
+    '''
+    variants = (
+        ("polling", _PollingTeensy),
+        ("selector", t.Teensy),
+        ("unix_selector", t.UnixTeensy)
+        )
+    commands = (
+        ("time", lambda teensy: teensy.time()),
+        ("register", lambda teensy: teensy.register_line(1))
+        )
+    results = {}
+    for variant, cls in variants:
+        results[variant] = {}
+        with _device(device) as devfn, cls(devfn) as teensy:
+            for name, command in commands:
+                durations = []
+                for _ in range(number):
+                    start = time.perf_counter()
+                    command(teensy)
+                    durations.append(time.perf_counter() - start)
+                percentiles = _percentiles(durations, (50, 90, 99))
+                for key, value in percentiles.items():
+                    results[variant][name + "_" + key] = value
+            teensy.deregister_input(1)
+            start = time.process_time()
+            time.sleep(idle)
+            cpu = time.process_time() - start
+        results[variant]["idle_cpu_percent"] = cpu * 100 / idle
+    return results
+
+
+BENCHMARKS = {
+    "columnar" : bench_columnar,
+    "commands" : bench_commands,
+    "delivery" : bench_delivery,
+    "events" : bench_events,
+    "framing" : bench_framing,
+    "latency" : bench_latency,
+    "setup" : bench_setup,
+    "throughput" : bench_throughput,
+}
+
+
+def _print_results(name, results):
+    print(name)
+    for variant, values in results.items():
+        print("  {}".format(variant))
+        for key, value in values.items():
+            print("    {:<24}{:>16.3f}".format(key, value))
+
+
+def run_benchmarks():
+    '''Runs the benchmarks that are specified on the command line.'''
+    parser = arg.ArgumentParser(
+        description="Run microbenchmarks of the pyteensy hot paths."
+        )
+    parser.add_argument(
+        "benchmarks",
+        nargs="*",
+        help="The benchmarks to run: {}. By default all of them are run.".format(
+            ", ".join(sorted(BENCHMARKS))
+            )
+        )
+    parser.add_argument(
+        "-d",
+        "--device",
+        type=str,
+        help=("The device for the benchmarks that need a Teensy. "
+              "By default they use an emulated Teensy.")
+        )
+    parser.add_argument(
+        "-u",
+        "--unix",
+        action="store_true",
+        help="Instead of Teensy use a UnixTeensy class",
+        default=False
+        )
+    parser.add_argument(
+        "-n",
+        "--number",
+        type=int,
+        help="The number of events per benchmark, each benchmark has a default."
+        )
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=str,
+        help="Also write the results as JSON to this file."
+        )
+    results = parser.parse_args()
+    names = results.benchmarks or sorted(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark: {}".format(name))
+    options = {
+        "number" : results.number,
+        "device" : results.device,
+        "unix" : results.unix
+        }
+    report = {
+        "version" : t.version(),
+        "python" : platform.python_version(),
+        "platform" : platform.platform(),
+        "time" : time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "options" : options,
+        "results" : {}
+        }
+    for name in names:
+        bench = BENCHMARKS[name]
+        params = inspect.signature(bench).parameters
+        kwargs = {
+            key : value for key, value in options.items()
+            if key in params and value
+            }
+        report["results"][name] = bench(**kwargs)
+        _print_results(name, report["results"][name])
+    if results.output:
+        with open(results.output, "w") as f:
+            json.dump(report, f, indent=4)
+
+
+if __name__ == "__main__":
+    run_benchmarks()
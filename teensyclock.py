@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+
+# This file is part of pyteensy.
+#
+# pyteensy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# pyteensy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with pyteensy.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+'''The teensyclock module relates the clock of a Teensy to a clock of the
+host. It works with time exchanges: the host notes its time, asks the
+Teensy for its time and notes its time again when the answer arrives.
+The Teensy must have read its clock somewhere between the two host times,
+so every exchange bounds the offset between the clocks; the faster the
+round trip, the tighter the bound.
+'''
+
+import collections
+import math
+import time
+
+
+class ClockSample(object):
+    '''One time exchange with a Teensy. host_send and host_recv are the host
+    times in us just before the request was written and just after the
+    reply was read, teensy is the time in us that the Teensy replied.
+    '''
+
+    __slots__ = ("host_send", "teensy", "host_recv")
+
+    def __init__(self, host_send: int, teensy: int, host_recv: int):
+        self.host_send = host_send
+        self.teensy = teensy
+        self.host_recv = host_recv
+
+    @property
+    def rtt(self) -> int:
+        '''The round trip time of the exchange in us.'''
+        return self.host_recv - self.host_send
+
+    @property
+    def offset(self) -> float:
+        '''The offset of the Teensy clock relative to the host clock in us,
+        assuming the request and the reply took equally long.
+        '''
+        return self.teensy - (self.host_send + self.host_recv) / 2
+
+    def __str__(self):
+        return "{}\t{}\t{}".format(self.host_send, self.teensy, self.host_recv)
+
+
+class ClockSync(object):
+    '''The result of a clock synchronization. The Teensy clock reads offset
+    us more than the host clock, give or take uncertainty us. rtt is the
+    smallest round trip time that was seen and nsamples the number of
+    exchanges that the estimate is based on. applied tells whether the
+    Teensy clock was set to the host clock, in which case offset and
+    uncertainty are measured after setting it.
+    '''
+
+    def __init__(self, offset, uncertainty, rtt, nsamples, applied=False):
+        self.offset = offset
+        self.uncertainty = uncertainty
+        self.rtt = rtt
+        self.nsamples = nsamples
+        self.applied = applied
+
+    def to_host_time(self, teensy_us):
+        '''Converts a Teensy timestamp to host time in us.'''
+        return teensy_us - self.offset
+
+    def to_teensy_time(self, host_us):
+        '''Converts a host time in us to a Teensy timestamp.'''
+        return host_us + self.offset
+
+    def __str__(self):
+        return "offset = {:.1f} us +/- {:.1f} us (rtt = {} us, n = {})".format(
+            self.offset, self.uncertainty, self.rtt, self.nsamples
+            )
+
+
+def estimate_offset(samples, keep: float=0.25) -> ClockSync:
+    '''Estimates the offset between a Teensy clock and the host clock from
+    a sequence of ClockSamples. Only the fraction keep of the samples with
+    the lowest round trip times is used; slow exchanges have been delayed
+    by the host or the bus and carry little information.
+
+    Every kept sample limits the offset to the interval
+    [teensy - host_recv, teensy - host_send]. The estimate is the middle of
+    the intersection of those intervals and the uncertainty is half its
+    width. If the intervals don't overlap, e.g. because a clock was stepped,
+    the median offset of the samples is used with half the smallest round
+    trip time as uncertainty.
+    '''
+    samples = sorted(samples, key=lambda sample: sample.rtt)
+    if not samples:
+        raise ValueError("estimate_offset requires at least one sample")
+    kept = samples[:max(1, int(len(samples) * keep))]
+
+    low = max(sample.teensy - sample.host_recv for sample in kept)
+    high = min(sample.teensy - sample.host_send for sample in kept)
+    if low <= high:
+        offset = (low + high) / 2
+        uncertainty = (high - low) / 2
+    else:
+        offsets = sorted(sample.offset for sample in kept)
+        offset = offsets[len(offsets) // 2]
+        uncertainty = kept[0].rtt / 2
+    return ClockSync(offset, uncertainty, kept[0].rtt, len(kept))
+
+
+class DriftModel(object):
+    '''A linear model of a Teensy clock relative to a host clock. The model
+    is fitted to a sliding window of ClockSamples: the host time halfway an
+    exchange is regressed on the Teensy time, so the model captures both
+    the offset and the skew (drift rate) of the Teensy clock. Only the
+    fraction keep of the samples in the window with the lowest round trip
+    times takes part in the fit.
+
+    Every sample that is added is first compared with the current model;
+    the prediction errors are kept in self.residuals as tuples of
+    (host time, prediction error, rms error of the fit), so the alignment
+    can be audited afterwards.
+
+    The model may be updated from one thread, while another thread converts
+    timestamps.
+    '''
+
+    def __init__(self, window: int=64, keep: float=0.5):
+        self._samples = collections.deque(maxlen=window)
+        self._keep = keep
+        # (teensy time, host time, rate), the host time at teensy time is
+        # host + (teensy_us - teensy) * rate.
+        self._params = None
+        self.residuals = []
+
+    def __len__(self):
+        return len(self._samples)
+
+    @property
+    def rate(self) -> float:
+        '''The number of host us per Teensy us.'''
+        return self._params[2]
+
+    @property
+    def skew_ppm(self) -> float:
+        '''How many parts per million the Teensy clock runs faster than the
+        host clock.
+        '''
+        return (1 / self._params[2] - 1) * 1e6
+
+    def add(self, sample: ClockSample):
+        '''Adds a sample and refits the model.'''
+        if self._params is not None:
+            error = (sample.host_send + sample.host_recv) / 2 - \
+                    self.to_host_time(sample.teensy)
+        else:
+            error = 0.0
+        self._samples.append(sample)
+        rms = self._fit()
+        self.residuals.append((sample.host_recv, error, rms))
+
+    def _fit(self) -> float:
+        '''Fits the model to the samples, returns the rms error of the fit.'''
+        samples = sorted(self._samples, key=lambda sample: sample.rtt)
+        kept = samples[:max(2, int(len(samples) * self._keep))]
+        # Large timestamps are taken relative to the first sample before
+        # they are averaged, so no precision is lost in the sums.
+        ref_teensy = kept[0].teensy
+        ref_host = kept[0].host_send
+        xs = [sample.teensy - ref_teensy for sample in kept]
+        ys = [
+            (sample.host_send + sample.host_recv) / 2 - ref_host
+            for sample in kept
+            ]
+        mean_x = sum(xs) / len(xs)
+        mean_y = sum(ys) / len(ys)
+        teensy0 = ref_teensy + mean_x
+        host0 = ref_host + mean_y
+        dxs = [x - mean_x for x in xs]
+        dys = [y - mean_y for y in ys]
+        sxx = sum(dx * dx for dx in dxs)
+        if sxx > 0:
+            rate = sum(dx * dy for dx, dy in zip(dxs, dys)) / sxx
+        else:
+            rate = 1.0
+        self._params = (teensy0, host0, rate)
+        sse = sum((dy - dx * rate) ** 2 for dx, dy in zip(dxs, dys))
+        return math.sqrt(sse / len(kept))
+
+    def to_host_time(self, teensy_us):
+        '''Converts a Teensy timestamp, or a numpy array of them, to host
+        time in us.
+        '''
+        teensy0, host0, rate = self._params
+        if hasattr(teensy_us, "astype"):
+            # unsigned arrays can't hold the negative differences.
+            teensy_us = teensy_us.astype("f8")
+        return host0 + (teensy_us - teensy0) * rate
+
+    def to_teensy_time(self, host_us):
+        '''Converts a host time in us, or a numpy array of them, to Teensy
+        time.
+        '''
+        teensy0, host0, rate = self._params
+        if hasattr(host_us, "astype"):
+            host_us = host_us.astype("f8")
+        return teensy0 + (host_us - host0) / rate
+
+    def __str__(self):
+        if self._params is None:
+            return "no samples"
+        _, _, rms = self.residuals[-1]
+        return "skew = {:.3f} ppm, rms = {:.1f} us (n = {})".format(
+            self.skew_ppm, rms, len(self)
+            )
+
+
+def perf_counter_us() -> int:
+    '''The host clock of TeensyClock: time.perf_counter_ns in integral us.'''
+    return time.perf_counter_ns() // 1000
+
+
+class TeensyClock(object):
+    '''Estimates the time of a Teensy without asking it. The clock is
+    calibrated with time exchanges against time.perf_counter_ns; now() then
+    reads perf_counter_ns and converts it with the fitted offset and rate,
+    which takes well under a microsecond.
+
+    Every calibration does samples exchanges and anchors the offset to the
+    best of them. The exchanges of all calibrations are also fitted with a
+    DriftModel of window samples, once they span min_span seconds its rate
+    is used; before that the clocks are assumed to run equally fast, give
+    or take max_skew_ppm. error_us() bounds how far now() may be off, it
+    grows with the time since the last calibration.
+
+    teensy is a Teensy or a UnixTeensy. now() may be called from any thread.
+    '''
+
+    def __init__(
+            self,
+            teensy,
+            samples: int=32,
+            window: int=256,
+            min_span: float=1.0,
+            max_skew_ppm: float=100.0
+            ):
+        self._teensy = teensy
+        self._samples = samples
+        self._model = DriftModel(window)
+        self._min_span_us = min_span * 1e6
+        self._max_skew = max_skew_ppm * 1e-6
+        self._first_us = None
+        # (teensy us, host ns, teensy us per host ns), read by now().
+        self._params = None
+        # (host ns at calibration, uncertainty in us, drift bound)
+        self._error = None
+        self.calibrate()
+
+    def calibrate(self) -> ClockSync:
+        '''Calibrates the clock with new time exchanges and returns the
+        offset estimate of those exchanges.
+        '''
+        teensy = self._teensy
+        samples = teensy.submit(
+            teensy.CLOCK_SAMPLES, perf_counter_us, self._samples
+            ).result()
+        sync = estimate_offset(samples)
+        host_us = min(samples, key=lambda sample: sample.rtt)
+        host_us = (host_us.host_send + host_us.host_recv) // 2
+        for sample in samples:
+            self._model.add(sample)
+        if self._first_us is None:
+            self._first_us = host_us
+
+        span_us = host_us - self._first_us
+        uncertainty = sync.uncertainty
+        if span_us >= self._min_span_us:
+            _, _, rms = self._model.residuals[-1]
+            rate = self._model.rate
+            drift = 2 * rms / span_us
+            uncertainty += rms
+        else:
+            rate = 1.0
+            drift = self._max_skew
+        self._params = (host_us + sync.offset, host_us * 1000, 1 / (rate * 1000))
+        self._error = (time.perf_counter_ns(), uncertainty, drift)
+        return sync
+
+    def now(self, _perf_counter_ns=time.perf_counter_ns) -> float:
+        '''Returns the estimated time of the Teensy in us.'''
+        teensy0, host0, scale = self._params
+        return teensy0 + (_perf_counter_ns() - host0) * scale
+
+    def to_teensy_time(self, perf_ns: int) -> float:
+        '''Converts a time.perf_counter_ns value to Teensy time in us.'''
+        teensy0, host0, scale = self._params
+        return teensy0 + (perf_ns - host0) * scale
+
+    def error_us(self) -> float:
+        '''Returns a bound on the error of now() in us.'''
+        calibrated, uncertainty, drift = self._error
+        return uncertainty + (time.perf_counter_ns() - calibrated) / 1000 * drift
+
+    def __str__(self):
+        _, _, scale = self._params
+        _, _, drift = self._error
+        return "rate = {:.9f}, error = {:.1f} us, drift bound = {:.2f} ppm".format(
+            scale * 1000, self.error_us(), drift * 1e6
+            )
@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+
+# This file is part of pyteensy.
+#
+# pyteensy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# pyteensy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with pyteensy.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+'''The teensyemu module emulates the firmware of a Teensy on a pseudo
+terminal, so pyteensy can be tested and benchmarked without hardware.
+
+    with TeensyEmulator(rate=100000, burst=64) as emu:
+        with pyteensy.UnixTeensy(emu.devfn) as teensy:
+            teensy.register_lines([1, 2, 3])
+            ...
+
+The emulator answers the complete protocol: the handshake, the
+registration of (single shot) lines, deregistration and getting and setting
+the time. While lines are registered it generates EVENT_TRIGGER frames for
+them at a configurable rate, in turn for every registered line, in bursts
+of a number of frames. The clock of the emulated Teensy may run skew_ppm
+parts per million faster than the host clock. It can also be run from the
+command line, it then prints the device to connect to.
+'''
+
+from __future__ import print_function
+import argparse as arg
+import os
+import pty
+import selectors
+import termios
+import threading
+import time
+import tty
+
+import pyteensy as t
+
+
+class TeensyEmulator(object):
+    '''A virtual Teensy on a pseudo terminal. Connect a Teensy or UnixTeensy
+    to self.devfn.
+
+    rate is the number of events per second that are generated while lines
+    are registered, they are sent in bursts of burst frames. With count, the
+    emulator stops generating after count events. Lines from nlines on are
+    invalid. The emulated clock starts at start_us and runs skew_ppm
+    parts per million faster than time.monotonic.
+
+    When the client doesn't read fast enough and more than max_backlog bytes
+    are waiting, the events that are due are dropped and counted in
+    self.dropped, self.nevents counts the events that were sent.
+    '''
+
+    _PKG = t._TeensyPackage
+    _ACK_SUCCES = _PKG._ACKNOWLEDGE_SUCCES.pack(2, _PKG.ACKNOWLEDGE_SUCCES)
+    _ACK_FAILURE = _PKG._ACKNOWLEDGE_FAILURE.pack(2, _PKG.ACKNOWLEDGE_FAILURE)
+    _ACK_LINE_INVALID = _PKG._ACKNOWLEDGE_LINE_INVALID.pack(
+        2, _PKG.ACKNOWLEDGE_LINE_INVALID
+        )
+
+    def __init__(
+            self,
+            rate: float=0.0,
+            burst: int=1,
+            count: int=None,
+            nlines: int=t.Teensy.NUM_LINES,
+            skew_ppm: float=0.0,
+            start_us: int=0,
+            max_backlog: int=1 << 16
+            ):
+        self.nlines = nlines
+        self.skew_ppm = skew_ppm
+        self.max_backlog = max_backlog
+        self.nevents = 0
+        self.dropped = 0
+        self.lines = {}     # registered line -> True if single shot
+        self._levels = bytearray(t.Teensy.NUM_LINES)
+        self._next_line = 0
+        self._wbuf = bytearray()
+        self._lock = threading.Lock()
+        self._set_clock(start_us)
+        self.set_load(rate, burst, count)
+
+        self._master, self._slave = pty.openpty()
+        # The slave must not echo the commands or translate bytes, even
+        # before a client configured it.
+        tty.setraw(self._slave)
+        os.set_blocking(self._master, False)
+        self.devfn = os.ttyname(self._slave)
+
+        self._wakeup = t._TeensyWakeup()
+        self._quit = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        '''Stops the emulator and closes the pseudo terminal.'''
+        if self._thread is None:
+            return
+        self._quit = True
+        self._wakeup.set()
+        self._thread.join()
+        self._thread = None
+        self._wakeup.close()
+        os.close(self._master)
+        os.close(self._slave)
+
+    def set_load(self, rate: float, burst: int=1, count: int=None):
+        '''Changes the rate in events per second, the number of events per
+        burst and the number of events after which generation stops.
+        '''
+        with self._lock:
+            self.rate = rate
+            self.burst = burst
+            self.count = count
+            self._gen_start = time.monotonic()
+            self._generated = 0
+        if hasattr(self, "_wakeup"):
+            self._wakeup.set()
+
+    def _set_clock(self, time_us: int):
+        self._clock_base = time_us
+        self._clock_host = time.monotonic_ns()
+
+    def clock(self) -> int:
+        '''Returns the time of the emulated Teensy in us.'''
+        elapsed_ns = time.monotonic_ns() - self._clock_host
+        return self._clock_base + int(
+            elapsed_ns * (1 + self.skew_ppm * 1e-6) // 1000
+            )
+
+    def trigger(self, line: int, level: int=None):
+        '''Sends an event for line, whether it is registered or not. By
+        default the logic level of the line toggles.
+        '''
+        with self._lock:
+            self._event(line, level)
+        self._wakeup.set()
+
+    def _event(self, line, level=None):
+        if level is None:
+            level = self._levels[line] ^ 1
+        self._levels[line] = level
+        self._wbuf += self._PKG._EVENT_TRIGGER.pack(
+            self._PKG._EVENT_TRIGGER.size,
+            self._PKG.EVENT_TRIGGER,
+            line,
+            self.clock(),
+            level
+            )
+        self.nevents += 1
+
+    def _reply(self, buf, offset):
+        '''Handles the command frame at offset in buf.'''
+        pkg = self._PKG
+        pkgtype = buf[offset + 1]
+        if pkgtype == pkg.IDENTIFY:
+            # A new client, forget everything that was meant for the
+            # previous one.
+            termios.tcflush(self._slave, termios.TCIFLUSH)
+            del self._wbuf[:]
+            self.lines.clear()
+            _, _, uuid = pkg._IDENTIFY.unpack_from(buf, offset)
+            if uuid == t.ZEP_ZEP_TO_TEENSY_UUID:
+                self._wbuf += pkg._IDENTIFY.pack(
+                    pkg._IDENTIFY.size,
+                    pkg.IDENTIFY,
+                    t.ZEP_TEENSY_TO_ZEP_UUID
+                    )
+            else:
+                self._wbuf += self._ACK_FAILURE
+        elif pkgtype in (pkg.REGISTER_INPUT, pkg.REGISTER_SINGLE_SHOT):
+            line = buf[offset + 2]
+            if line >= self.nlines:
+                self._wbuf += self._ACK_LINE_INVALID
+                return
+            self.lines[line] = pkgtype == pkg.REGISTER_SINGLE_SHOT
+            self._wbuf += self._ACK_SUCCES
+        elif pkgtype == pkg.DEREGISTER_INPUT:
+            self.lines.pop(buf[offset + 2], None)
+            self._wbuf += self._ACK_SUCCES
+        elif pkgtype == pkg.TIME:
+            self._wbuf += pkg._ACKNOWLEDGE_TIME.pack(
+                pkg._ACKNOWLEDGE_TIME.size, pkg.ACKNOWLEDGE_TIME, self.clock()
+                )
+        elif pkgtype == pkg.TIME_SET:
+            _, _, time_us = pkg._TIME_SET.unpack_from(buf, offset)
+            self._set_clock(time_us)
+            self._wbuf += self._ACK_SUCCES
+        else:
+            self._wbuf += self._ACK_FAILURE
+
+    def _generate(self) -> float:
+        '''Generates the bursts that are due, returns the number of seconds
+        until the next burst or None when nothing is generated.
+        '''
+        if not self.rate or not self.lines:
+            self._gen_start = time.monotonic()
+            self._generated = 0
+            return None
+        if self.count is not None and self.nevents >= self.count:
+            return None
+        elapsed = time.monotonic() - self._gen_start
+        due = int(elapsed * self.rate) // self.burst * self.burst
+        due -= self._generated
+        if self.count is not None:
+            due = min(due, self.count - self.nevents)
+        if due > 0:
+            self._generated += due
+            if len(self._wbuf) > self.max_backlog:
+                self.dropped += due
+            else:
+                lines = sorted(self.lines)
+                for _ in range(due):
+                    line = lines[self._next_line % len(lines)]
+                    self._next_line += 1
+                    self._event(line)
+                    if self.lines.get(line):
+                        del self.lines[line]
+                        if not self.lines:
+                            break
+                        lines = sorted(self.lines)
+        next_burst = (self._generated + self.burst) / self.rate
+        return max(0.0, next_burst - (time.monotonic() - self._gen_start))
+
+    def _run(self):
+        '''The thread that answers the commands and generates the events.'''
+        framer = t._TeensyFramer()
+        selector = selectors.DefaultSelector()
+        selector.register(self._master, selectors.EVENT_READ)
+        selector.register(self._wakeup.fileno(), selectors.EVENT_READ)
+        writing = False
+        timeout = None
+        try:
+            while not self._quit:
+                for key, mask in selector.select(timeout):
+                    if key.fd == self._wakeup.fileno():
+                        self._wakeup.clear()
+                    elif mask & selectors.EVENT_READ:
+                        try:
+                            nbytes = os.readv(
+                                self._master, [framer.writable()]
+                                )
+                        except (BlockingIOError, InterruptedError):
+                            continue
+                        framer.commit(nbytes)
+                        with self._lock:
+                            while True:
+                                offset = framer.next_frame()
+                                if offset < 0:
+                                    break
+                                self._reply(framer.view, offset)
+                with self._lock:
+                    timeout = self._generate()
+                    if self._wbuf:
+                        try:
+                            nbytes = os.write(self._master, self._wbuf)
+                        except BlockingIOError:
+                            nbytes = 0
+                        del self._wbuf[:nbytes]
+                    if bool(self._wbuf) != writing:
+                        writing = bool(self._wbuf)
+                        mask = selectors.EVENT_READ
+                        if writing:
+                            mask |= selectors.EVENT_WRITE
+                        selector.modify(self._master, mask)
+        finally:
+            selector.close()
+
+
+def run_emulator():
+    '''Runs an emulator until it is interrupted.'''
+    parser = arg.ArgumentParser(
+        description=("teensyemu emulates a Teensy on a pseudo terminal. "
+                     "It prints the device to connect to.")
+        )
+    parser.add_argument(
+        "-r",
+        "--rate",
+        type=float,
+        help="The events per second while lines are registered.",
+        default=0.0
+        )
+    parser.add_argument(
+        "-b",
+        "--burst",
+        type=int,
+        help="The number of events that are sent at once.",
+        default=1
+        )
+    parser.add_argument(
+        "-n",
+        "--number",
+        type=int,
+        help="Stop generating events after this many.",
+        )
+    parser.add_argument(
+        "-l",
+        "--lines",
+        type=int,
+        help="The number of valid lines.",
+        default=t.Teensy.NUM_LINES
+        )
+    parser.add_argument(
+        "-s",
+        "--skew",
+        type=float,
+        help="How many ppm the emulated clock runs faster than the host's.",
+        default=0.0
+        )
+    results = parser.parse_args()
+    emulator = TeensyEmulator(
+        rate=results.rate,
+        burst=results.burst,
+        count=results.number,
+        nlines=results.lines,
+        skew_ppm=results.skew
+        )
+    print(emulator.devfn, flush=True)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        emulator.close()
+    print("sent {} events, dropped {}".format(
+        emulator.nevents, emulator.dropped
+        ))
+
+
+if __name__ == "__main__":
+    run_emulator()
@@ -24,8 +24,15 @@ output the events that occur on that line of the teensy.
 
 from __future__ import print_function
 import argparse as arg
+import threading
+import time
 import pyteensy as t
 
+try:
+    import queue as q
+except ImportError:
+    import Queue as q
+
 class CmdArgs(dict):
     """Just a dictionary with some static members"""
     DEVICE      = "device"   # string with device name
@@ -37,6 +44,13 @@ class CmdArgs(dict):
     MIN_JITTER  = "min-jitter"# float minimal jitter perion in seconds
     MAX_JITTER  = "max-jitter"# float max jitter perion in seconds
     NUMBER      = "number"   # float max jitter perion in seconds
+    TOLERANCE   = "tolerance"# float max us between a toggle and its event
+    QUEUE_SIZE  = "queue-size"# int max number of queued events, 0 = no max
+    OVERFLOW    = "overflow" # string policy when the event queue is full
+    STREAM      = "stream"   # flag write the events while running
+    FORMAT      = "format"   # string format of the streamed events
+    FLUSH_EVENTS= "flush-events"# int flush the stream after so many events
+    FLUSH_MS    = "flush-ms" # float flush the stream after so many ms
 
 def parse_arguments():
     '''Parses commandline arguments'''
@@ -110,6 +124,61 @@ def parse_arguments():
         help="The number toggles on the parallel port.",
         default=120
         )
+    parser.add_argument(
+        '--tolerance',
+        type=float,
+        help=("The maximum number of us between a toggle on the parallel "
+              "port and the event that it caused, after the clock offset "
+              "and drift are taken into account. The default value = 2000 ."),
+        default=2000.0
+        )
+
+    parser.add_argument(
+        '-q',
+        '--queue-size',
+        type=int,
+        help=("The maximum number of events that are kept, 0 means "
+              "unlimited. The default value = 0 ."),
+        default=0
+        )
+    parser.add_argument(
+        '--overflow',
+        choices=t.TeensyEventQueue.POLICIES,
+        help=("What happens with events when the queue is full. "
+              "The default value = drop_oldest ."),
+        default=t.TeensyEventQueue.DROP_OLDEST
+        )
+
+    parser.add_argument(
+        '--stream',
+        action='store_true',
+        help=("Write the events to stdout while running, instead of on "
+              "program termination."),
+        default=False
+        )
+    parser.add_argument(
+        '-f',
+        '--format',
+        choices=EventWriter.FORMATS,
+        help=("The format of the streamed events: tab separated lines, "
+              "JSON objects per line or binary EVENT_TRIGGER frames. "
+              "The default value = tsv ."),
+        default=EventWriter.TSV
+        )
+    parser.add_argument(
+        '--flush-events',
+        type=int,
+        help=("Flush the stream after this many events. "
+              "The default value = 1024 ."),
+        default=1024
+        )
+    parser.add_argument(
+        '--flush-ms',
+        type=float,
+        help=("Flush the stream when its oldest event waits this many ms. "
+              "The default value = 50 ."),
+        default=50.0
+        )
 
     results = parser.parse_args()
 
@@ -134,28 +203,33 @@ def parse_arguments():
     d[d.MIN_JITTER] = results.min_jitter
     d[d.MAX_JITTER] = results.max_jitter
     d[d.NUMBER] = results.number
+    d[d.TOLERANCE] = results.tolerance
+    d[d.QUEUE_SIZE] = results.queue_size
+    d[d.OVERFLOW] = results.overflow
+    d[d.STREAM] = results.stream
+    d[d.FORMAT] = results.format
+    d[d.FLUSH_EVENTS] = results.flush_events
+    d[d.FLUSH_MS] = results.flush_ms
 
     return d
 
 def reg_lines(teensy, cmdargs):
-    for i in cmdargs[cmdargs.LINES]:
-        try:
-            teensy.register_line(i)
-        except t.TeensyError as e:
-            if e.error == t.TeensError.INVALID_TRIGGER_LINE:
-                exit("{} is an invalid trigger line.".format(i))
-            else:
-                exit(str(e))
+    try:
+        teensy.register_lines(cmdargs[cmdargs.LINES])
+    except t.TeensyError as e:
+        if e.int_error == t.TeensyError.INVALID_TRIGGER_LINE:
+            exit("Invalid trigger line(s): {}.".format(e.extra))
+        else:
+            exit(str(e))
 
 def reg_single_shots(teensy, cmdargs):
-    for i in cmdargs[cmdargs.SINGLESHOTS]:
-        try:
-            teensy.register_single_shot(i)
-        except t.TeensError as e:
-            if e.error == t.TeensError.INVALID_TRIGGER_LINE:
-                exit("{} is an invalid trigger line.".format(i))
-            else:
-                exit(str(e))
+    try:
+        teensy.register_single_shots(cmdargs[cmdargs.SINGLESHOTS])
+    except t.TeensyError as e:
+        if e.int_error == t.TeensyError.INVALID_TRIGGER_LINE:
+            exit("Invalid trigger line(s): {}.".format(e.extra))
+        else:
+            exit(str(e))
 
 def print_events(teensy, **kwargs):
     '''Gets all event from the teensy and prints them to a file
@@ -166,26 +240,146 @@ def print_events(teensy, **kwargs):
         event = q.get(False)
         print(event, **kwargs)
 
-def compare_events(times, queue):
-    import numpy as np
-    stamps = []
+class EventWriter(object):
+    '''Writes line events to a binary file in batches. The events are
+    formatted into a buffer that is written and flushed when it holds
+    flush_events events, or when the oldest event in it waited flush_ms
+    milliseconds, see poll().
+    '''
+
+    TSV = "tsv"
+    NDJSON = "ndjson"
+    BINARY = "binary"
+    FORMATS = (TSV, NDJSON, BINARY)
+
+    def __init__(self, f, fmt=TSV, flush_events=1024, flush_ms=50.0):
+        if fmt not in self.FORMATS:
+            raise ValueError("Unknown format: {}".format(fmt))
+        self.file = f
+        self.flush_events = flush_events
+        self.flush_interval = flush_ms / 1000
+        self.nevents = 0
+        self._format = {
+            self.TSV : self._format_tsv,
+            self.NDJSON : self._format_ndjson,
+            self.BINARY : self._format_binary
+            }[fmt]
+        self._buf = bytearray()
+        self._count = 0         # events in self._buf
+        self._since = 0.0       # time at which the oldest event was buffered
+
+    @staticmethod
+    def _format_tsv(buf, events):
+        buf += "".join([
+            "%d\t%d\t%d\n" % (e.timestamp, e.line, e.logiclevel)
+            for e in events
+            ]).encode("ascii")
+
+    @staticmethod
+    def _format_ndjson(buf, events):
+        buf += "".join([
+            '{"timestamp":%d,"line":%d,"logiclevel":%d}\n' %
+            (e.timestamp, e.line, e.logiclevel)
+            for e in events
+            ]).encode("ascii")
+
+    @staticmethod
+    def _format_binary(buf, events):
+        frame = t._TeensyPackage._EVENT_TRIGGER
+        size = frame.size
+        offset = len(buf)
+        buf.extend(bytes(size * len(events)))
+        for e in events:
+            frame.pack_into(
+                buf, offset, size, t._TeensyPackage.EVENT_TRIGGER,
+                e.line, e.timestamp, e.logiclevel
+                )
+            offset += size
+
+    def write(self, events):
+        '''Buffers events, a list of TeensyLineEvents, and flushes when the
+        buffer holds enough events.
+        '''
+        if not self._count:
+            self._since = time.monotonic()
+        self._format(self._buf, events)
+        self._count += len(events)
+        self.nevents += len(events)
+        if self._count >= self.flush_events:
+            self.flush()
+
+    def timeout(self):
+        '''Returns the seconds until the buffer must be flushed, None when
+        it is empty.
+        '''
+        if not self._count:
+            return None
+        return max(0.0, self._since + self.flush_interval - time.monotonic())
+
+    def poll(self):
+        '''Flushes the buffer when its oldest event waited long enough.'''
+        if self._count and time.monotonic() - self._since >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self.file.write(self._buf)
+        self.file.flush()
+        del self._buf[:]
+        self._count = 0
+
+
+def stream_events(teensy, writer, stop):
+    '''Writes the events of teensy with writer until stop, a
+    threading.Event, is set. Events are taken from the queue in batches
+    of at most writer.flush_events. Ctrl+C stops the stream as well, the
+    events that were received are still written then.
+    '''
+    events = teensy.events
+    batch = []
+    try:
+        while not stop.is_set():
+            timeout = writer.timeout()
+            try:
+                batch.append(
+                    events.get(True, 0.1 if timeout is None else timeout)
+                    )
+                while len(batch) < writer.flush_events:
+                    batch.append(events.get(False))
+            except q.Empty:
+                pass
+            if batch:
+                writer.write(batch)
+                batch = []
+            writer.poll()
+    except KeyboardInterrupt:
+        pass
+    # Write what was received before stopping, also the batch that Ctrl+C
+    # interrupted. When the output is gone the BrokenPipeError skips this.
+    while not events.empty():
+        batch.append(events.get(False))
+    writer.write(batch)
+    writer.flush()
+
+
+def compare_events(times, queue, tolerance_us=2000.0):
+    '''Compares the times in seconds at which the parallel port was toggled
+    with the events in queue and prints a teensylatency report per line.
+    '''
+    import teensylatency as tl
+    stamps = {}
     while not queue.empty():
-        stamps.append(queue.get().timestamp)
-    stamps = np.array(stamps, dtype=float)
-    stamps = stamps/1e6 # convert to seconds
-    diffstamps = np.diff(stamps)
-    difftimes  = np.diff(times)
-    diffs = np.array([diffstamps, difftimes]).transpose()
-    print(diffs)
-    difference = difftimes - diffstamps
-    print(difference.mean())
-    difference[difference < 0] *= -1
-    print(difference.mean())
+        event = queue.get()
+        stamps.setdefault(event.line, []).append(event.timestamp)
+    host_us = [time_s * 1e6 for time_s in times]
+    if not stamps:
+        print("No events were received for {} toggles.".format(len(times)))
+    for line in sorted(stamps):
+        print("line {}:".format(line))
+        print(tl.analyze_latency(host_us, stamps[line], tolerance_us))
 
 def run_teensy_events():
     '''Runs the teensy events program; it is the main function.'''
     import sys
-    import time
     arguments = parse_arguments()
     
     parport = None
@@ -207,7 +401,11 @@ def run_teensy_events():
         from pyteensy import Teensy as Teensy
 
     trigtimes = []
-    with Teensy(arguments[arguments.DEVICE]) as teensy:
+    with Teensy(
+            arguments[arguments.DEVICE],
+            queue_size=arguments[arguments.QUEUE_SIZE],
+            overflow=arguments[arguments.OVERFLOW]
+            ) as teensy:
         if not teensy.connected:
             exit(1)
         reg_lines(teensy, arguments)
@@ -216,16 +414,45 @@ def run_teensy_events():
             print(
                 "Using the parallel port to determine whether the teensy works."
                 )
+            scheduler = pp.PulseScheduler(parport.toggle)
             trigtimes = pp.pulse_train(
                 parport,
                 number=arguments[arguments.NUMBER],
                 jitter=(
                     arguments[arguments.MIN_JITTER],
                     arguments[arguments.MAX_JITTER]
-                    )
+                    ),
+                scheduler=scheduler
+                )
+            print(
+                "toggle lateness: median {:.1f} us, p99 {:.1f} us, "
+                "max {:.1f} us".format(*scheduler.lateness_us())
                 )
             time.sleep(.5)
-            compare_events(trigtimes, teensy.events)
+            compare_events(
+                trigtimes, teensy.events, arguments[arguments.TOLERANCE]
+                )
+        elif arguments[arguments.STREAM]:
+            print("Press ctr+D or ctrl+C to stop.", file=sys.stderr)
+            writer = EventWriter(
+                sys.stdout.buffer,
+                arguments[arguments.FORMAT],
+                arguments[arguments.FLUSH_EVENTS],
+                arguments[arguments.FLUSH_MS]
+                )
+            stop = threading.Event()
+
+            def wait_for_eof():
+                try:
+                    sys.stdin.read()
+                finally:
+                    stop.set()
+
+            threading.Thread(target=wait_for_eof, daemon=True).start()
+            try:
+                stream_events(teensy, writer, stop)
+            except (KeyboardInterrupt, BrokenPipeError):
+                pass
         else:
             print("Press ctr+D or ctrl+C to stop.")
             try:
@@ -236,6 +463,11 @@ def run_teensy_events():
                 pass
             finally:
                 print_events(teensy)
+                if teensy.events.dropped:
+                    print(
+                        "{} events were dropped".format(teensy.events.dropped),
+                        file=sys.stderr
+                        )
 
 if __name__ == "__main__":
     run_teensy_events()
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+
+# This file is part of pyteensy.
+#
+# pyteensy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# pyteensy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with pyteensy.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+'''The teensyindex module exports the TeensyEventIndex class, it keeps the
+events of a Teensy per line in order of time, so questions like "which
+events did line 3 have between t0 and t1" are answered by bisection instead
+of by scanning all events.
+
+    index = TeensyEventIndex()
+    index.attach(teensy)
+    ...
+    timestamps, levels = index.window(3, t0, t1)
+    trial, latency, level = index.epochs(3, onsets, 0, 500000)
+
+An index can also be filled afterwards, e.g. from the events of a
+TeensyEventStore or a teensyrecord.TeensySession, with extend.
+'''
+
+from __future__ import print_function
+import array
+import bisect
+import threading
+
+import pyteensy as pt
+
+
+class _LineTimes(object):
+    '''The timestamps and levels of the events of one line. The events
+    normally arrive in order of time; when one doesn't, e.g. after the clock
+    of the Teensy was set, the line is sorted again before the next query.
+    '''
+
+    __slots__ = ("times", "levels", "ordered")
+
+    def __init__(self):
+        self.times = array.array("Q")
+        self.levels = array.array("B")
+        self.ordered = True
+
+    def sort(self):
+        times = self.times
+        order = sorted(range(len(times)), key=times.__getitem__)
+        self.times = array.array("Q", [times[i] for i in order])
+        self.levels = array.array("B", [self.levels[i] for i in order])
+        self.ordered = True
+
+
+class TeensyEventIndex(object):
+    '''An in memory index of line events. The timestamps of every line are
+    kept in a sorted array, appending an event costs about as much as
+    queueing it and a query costs a bisection of the array of its line, so
+    the index stays fast with millions of events. Times are Teensy times in
+    us and every window is half open: it includes t0 and excludes t1.
+
+    The index may be filled from the worker thread of a Teensy while it is
+    queried from another thread. Only epochs requires numpy.
+    '''
+
+    def __init__(self):
+        self._lines = [None] * pt.Teensy.NUM_LINES
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return sum(len(times.times) for times in self._lines if times)
+
+    def lines(self) -> list:
+        '''Returns the lines that have events.'''
+        return [line for line, times in enumerate(self._lines) if times]
+
+    def add(self, timestamp: int, line: int, logiclevel: int):
+        '''Adds one event to the index.'''
+        with self._lock:
+            times = self._lines[line]
+            if times is None:
+                times = self._lines[line] = _LineTimes()
+            elif times.times and timestamp < times.times[-1]:
+                times.ordered = False
+            times.times.append(timestamp)
+            times.levels.append(1 if logiclevel else 0)
+
+    def add_event(self, event: pt.TeensyLineEvent):
+        '''Adds a TeensyLineEvent to the index.'''
+        self.add(event.timestamp, event.line, event.logiclevel)
+
+    def extend(self, events):
+        '''Adds a structured array of events with the fields line,
+        timestamp and level, e.g. the events of a TeensyEventStore, the
+        frames of a columnar Teensy or the records of a TeensySession.
+        '''
+        np = pt.np
+        lines = events["line"]
+        timestamps = events["timestamp"]
+        levels = events["level"]
+        for line in np.unique(lines).tolist():
+            mask = lines == line
+            self._extend_line(
+                line,
+                timestamps[mask].astype(np.uint64),
+                np.not_equal(levels[mask], 0).astype(np.uint8)
+                )
+
+    def _extend_line(self, line, timestamps, levels):
+        with self._lock:
+            times = self._lines[line]
+            if times is None:
+                times = self._lines[line] = _LineTimes()
+            if len(timestamps):
+                first = int(timestamps[0])
+                if (times.times and first < times.times[-1]) or \
+                        (timestamps[1:] < timestamps[:-1]).any():
+                    times.ordered = False
+            times.times.frombytes(timestamps.tobytes())
+            times.levels.frombytes(levels.tobytes())
+
+    def attach(self, teensy: pt.Teensy):
+        '''Indexes the events of teensy as it receives them, in addition to
+        what its handle_event or handle_event_array does with them.
+        '''
+        handle_event = teensy.handle_event
+        handle_event_array = teensy.handle_event_array
+        add = self.add
+
+        def indexed_handle_event(event):
+            add(event.timestamp, event.line, event.logiclevel)
+            handle_event(event)
+
+        def indexed_handle_event_array(frames):
+            self.extend(frames)
+            handle_event_array(frames)
+
+        teensy.handle_event = indexed_handle_event
+        teensy.handle_event_array = indexed_handle_event_array
+
+    def clear(self):
+        '''Removes all events from the index.'''
+        with self._lock:
+            self._lines = [None] * pt.Teensy.NUM_LINES
+
+    def _times(self, line: int) -> _LineTimes:
+        '''Returns the events of line in order, the lock must be held.'''
+        times = self._lines[line]
+        if times is None:
+            return _LineTimes()
+        if not times.ordered:
+            times.sort()
+        return times
+
+    def window(self, line: int, t0: int, t1: int) -> tuple:
+        '''Returns the timestamps and levels of the events of line from t0
+        up to t1 as two arrays.
+        '''
+        with self._lock:
+            times = self._times(line)
+            start = bisect.bisect_left(times.times, t0)
+            end = bisect.bisect_left(times.times, t1, start)
+            return times.times[start:end], times.levels[start:end]
+
+    def count(self, line: int, t0: int, t1: int) -> int:
+        '''Returns the number of events of line from t0 up to t1.'''
+        with self._lock:
+            times = self._times(line).times
+            start = bisect.bisect_left(times, t0)
+            return bisect.bisect_left(times, t1, start) - start
+
+    def first_after(self, line: int, time_us: int) -> pt.TeensyLineEvent:
+        '''Returns the first event of line at or after time_us, or None.'''
+        with self._lock:
+            times = self._times(line)
+            index = bisect.bisect_left(times.times, time_us)
+            if index == len(times.times):
+                return None
+            return pt.TeensyLineEvent(
+                times.times[index], line, times.levels[index]
+                )
+
+    def last_before(self, line: int, time_us: int) -> pt.TeensyLineEvent:
+        '''Returns the last event of line before time_us, or None.'''
+        with self._lock:
+            times = self._times(line)
+            index = bisect.bisect_left(times.times, time_us)
+            if index == 0:
+                return None
+            return pt.TeensyLineEvent(
+                times.times[index - 1], line, times.levels[index - 1]
+                )
+
+    def epochs(self, line: int, onsets, pre_us: int, post_us: int) -> tuple:
+        '''Cuts the events of line into epochs around every onset in the
+        array onsets: the events from onset - pre_us up to onset + post_us.
+        Returns three arrays with an element per event in an epoch: the
+        index of its onset, its time relative to the onset in us and its
+        level. An event that falls in several epochs occurs once for each.
+        '''
+        np = pt.np
+        if np is None:
+            raise ImportError("TeensyEventIndex.epochs requires numpy")
+        onsets = np.asarray(onsets, np.int64)
+        with self._lock:
+            line_times = self._times(line)
+            times = np.array(line_times.times, np.int64)
+            levels = np.array(line_times.levels, np.uint8)
+        starts = np.searchsorted(times, onsets - pre_us)
+        ends = np.searchsorted(times, onsets + post_us)
+        counts = ends - starts
+        trial = np.repeat(np.arange(len(onsets)), counts)
+        # The position of every event within its epoch, added to the start
+        # of the epoch, gives its index in times.
+        first = np.cumsum(counts) - counts
+        index = np.arange(counts.sum()) - np.repeat(first - starts, counts)
+        return trial, times[index] - onsets[trial], levels[index]
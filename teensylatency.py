@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+
+# This file is part of pyteensy.
+#
+# pyteensy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# pyteensy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with pyteensy.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+'''The teensylatency module analyses validation runs offline: it compares
+the times at which the host produced signals, e.g. the toggles of
+parallelpulse.pulse_train, with the timestamps of the edges that a Teensy
+reported for them.
+
+    report = analyze_latency(host_us, teensy_us, tolerance_us=1000)
+    print(report)
+
+The two series are aligned by matching every host time with the nearest
+Teensy edge within a tolerance, so missing and extra edges show up as such
+instead of shifting all the pairs after them. The clocks of host and
+Teensy need not be synchronized: the offset between them is found first
+and the offset and the drift are then estimated by regression on the
+matched pairs. What remains is the jitter, which is summarized with
+percentiles and a histogram.
+'''
+
+from __future__ import print_function
+import numpy as np
+
+
+def _match(teensy_us, predicted, tolerance_us):
+    '''Matches every predicted Teensy time with the nearest time in the
+    sorted teensy_us within tolerance_us, every Teensy time is used once.
+    The predictions must be in order. Returns the indices of the matched
+    predictions and Teensy times.
+    '''
+    index = np.searchsorted(teensy_us, predicted)
+    right = np.minimum(index, len(teensy_us) - 1)
+    left = np.maximum(index - 1, 0)
+    use_left = np.abs(teensy_us[left] - predicted) < \
+        np.abs(teensy_us[right] - predicted)
+    nearest = np.where(use_left, left, right)
+    distance = np.abs(teensy_us[nearest] - predicted)
+    host_index = np.flatnonzero(distance <= tolerance_us)
+    nearest = nearest[host_index]
+    distance = distance[host_index]
+    if not len(host_index):
+        return host_index, nearest
+    # As the predictions are in order, the host times that claim the same
+    # edge are adjacent; the closest one gets it.
+    starts = np.flatnonzero(np.diff(nearest, prepend=-1))
+    group = np.cumsum(np.diff(nearest, prepend=-1) != 0) - 1
+    closest = distance == np.minimum.reduceat(distance, starts)[group]
+    closest[1:] &= ~(closest[:-1] & (group[1:] == group[:-1]))
+    return host_index[closest], nearest[closest]
+
+
+def _fit_line(x, y) -> tuple:
+    '''Returns the slope and intercept of the least squares line through
+    the points x, y.
+    '''
+    x_mean = x.mean()
+    dx = x - x_mean
+    y_mean = y.mean()
+    denominator = dx.dot(dx)
+    slope = dx.dot(y - y_mean) / denominator if denominator else 0.0
+    return slope, y_mean - slope * x_mean
+
+
+def find_offset(host_us, teensy_us, tolerance_us, candidates=16, probes=256):
+    '''Returns the offset teensy - host that lets most host times match an
+    edge within tolerance_us. The offsets between the first candidates host
+    times and the first candidates Teensy times are tried on the first
+    probes host times, so a few missing or extra events at the start don't
+    matter and the drift has little time to add up.
+    '''
+    host_us = np.asarray(host_us, np.float64)
+    teensy_us = np.asarray(teensy_us, np.float64)
+    if not len(host_us) or not len(teensy_us):
+        return 0.0
+    probe = host_us[:probes]
+    offsets = np.subtract.outer(
+        teensy_us[:candidates], host_us[:candidates]
+        ).ravel()
+    best, best_count = 0.0, -1
+    for offset in offsets:
+        count = len(_match(teensy_us, probe + offset, tolerance_us)[0])
+        if count > best_count:
+            best, best_count = float(offset), count
+    return best
+
+
+class LatencyReport(object):
+    '''The result of analyze_latency. All times are in us.
+
+    host_index and teensy_index are the indices of the matched pairs in the
+    host and Teensy series, missing are the indices of the host times
+    without an edge and extra those of the edges without a host time.
+    The Teensy times are modelled as offset + host * (1 + drift_ppm / 1e6)
+    relative to the first host time, residuals are the matched Teensy times
+    minus the model, so they are the jitter of the latency.
+    '''
+
+    PERCENTILES = (1, 5, 25, 50, 75, 95, 99, 99.9)
+
+    def __init__(
+            self,
+            host_index,
+            teensy_index,
+            missing,
+            extra,
+            offset,
+            drift_ppm,
+            residuals,
+            bins=50
+            ):
+        self.host_index = host_index
+        self.teensy_index = teensy_index
+        self.missing = missing
+        self.extra = extra
+        self.offset = offset
+        self.drift_ppm = drift_ppm
+        self.residuals = residuals
+        if len(residuals):
+            self.percentiles = dict(zip(
+                self.PERCENTILES, np.percentile(residuals, self.PERCENTILES)
+                ))
+            self.histogram = np.histogram(residuals, bins)
+        else:
+            self.percentiles = {}
+            self.histogram = (np.zeros(0, np.int64), np.zeros(0))
+
+    @property
+    def nmatched(self) -> int:
+        return len(self.residuals)
+
+    @property
+    def std(self) -> float:
+        return float(self.residuals.std()) if self.nmatched else 0.0
+
+    @property
+    def mae(self) -> float:
+        '''The mean absolute jitter.'''
+        return float(np.abs(self.residuals).mean()) if self.nmatched else 0.0
+
+    @property
+    def max_abs(self) -> float:
+        return float(np.abs(self.residuals).max()) if self.nmatched else 0.0
+
+    def histogram_lines(self, width: int=40) -> list:
+        '''Returns the histogram of the residuals as lines of text.'''
+        counts, edges = self.histogram
+        if not len(counts):
+            return []
+        scale = width / max(1, counts.max())
+        return [
+            "{:10.1f} {:10.1f} {:8d} {}".format(
+                low, high, count, "#" * int(round(count * scale))
+                )
+            for low, high, count in zip(edges[:-1], edges[1:], counts)
+            ]
+
+    def __str__(self):
+        lines = [
+            "matched {}, missing {}, extra {}".format(
+                self.nmatched, len(self.missing), len(self.extra)
+                ),
+            "offset {:.1f} us, drift {:.3f} ppm".format(
+                self.offset, self.drift_ppm
+                ),
+            "jitter std {:.2f} us, mae {:.2f} us, max {:.2f} us".format(
+                self.std, self.mae, self.max_abs
+                ),
+            "percentiles " + ", ".join(
+                "p{:g} {:.2f}".format(percentile, value)
+                for percentile, value in self.percentiles.items()
+                )
+            ]
+        return "\n".join(lines + self.histogram_lines())
+
+
+def analyze_latency(
+        host_us,
+        teensy_us,
+        tolerance_us: float=1000.0,
+        offset_us: float=None,
+        iterations: int=2,
+        bins: int=50
+        ) -> LatencyReport:
+    '''Aligns the host times host_us with the Teensy times teensy_us of one
+    line, both in us and in order, and returns a LatencyReport.
+
+    An edge matches a host time when it is within tolerance_us of the time
+    that the current model predicts, and every edge matches once. If
+    offset_us, the expected offset teensy - host, isn't given, it is found
+    with find_offset. The model is fitted to the matches of a growing part
+    of the run, so a drift that would carry the edges out of the tolerance
+    over a long run is followed, and finally refitted to all matches
+    iterations times.
+    '''
+    host_us = np.asarray(host_us, np.float64)
+    teensy_us = np.asarray(teensy_us, np.float64)
+    # Times relative to the first host time keep the regression accurate.
+    origin = host_us[0] if len(host_us) else 0.0
+    host = host_us - origin
+    teensy = teensy_us - origin
+    if offset_us is None:
+        offset_us = find_offset(host, teensy, tolerance_us)
+    offset, slope = float(offset_us), 0.0
+    host_index = teensy_index = np.zeros(0, np.int64)
+    size = min(len(host), 256)
+    refits = 0
+    while len(teensy) and refits < iterations:
+        host_index, teensy_index = _match(
+            teensy, offset + host[:size] * (1.0 + slope), tolerance_us
+            )
+        if len(host_index) >= 2:
+            x = host[host_index]
+            slope, offset = _fit_line(x, teensy[teensy_index] - x)
+        if size == len(host):
+            refits += 1
+        size = min(len(host), size * 4)
+    residuals = teensy[teensy_index] - (
+        offset + host[host_index] * (1.0 + slope)
+        )
+    matched_host = np.zeros(len(host), bool)
+    matched_host[host_index] = True
+    matched_teensy = np.zeros(len(teensy), bool)
+    matched_teensy[teensy_index] = True
+    return LatencyReport(
+        host_index,
+        teensy_index,
+        np.flatnonzero(~matched_host),
+        np.flatnonzero(~matched_teensy),
+        float(offset),
+        float(slope) * 1e6,
+        residuals,
+        bins
+        )
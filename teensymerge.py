@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+
+# This file is part of pyteensy.
+#
+# pyteensy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# pyteensy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with pyteensy.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+'''The teensymerge module merges the event streams of several Teensy
+devices into one stream that is ordered in time, while the devices are
+still running.
+
+The timestamps of every device are converted to one time domain with a
+clock model of the device, e.g. the teensyclock.ClockSync that
+Teensy.sync_clock returns or the teensyclock.DriftModel of
+Teensy.track_drift. Every device delivers its own events in order, so once
+every device has delivered an event after time w, no event before w can
+arrive anymore: w is the watermark. A device that is silent would hold
+the watermark back forever, hence the watermark never lags more than
+lateness_us behind the newest event, or behind the host clock if one is
+given. Events are therefore emitted at most lateness_us late, and only the
+events of that period are kept in memory.
+
+    merger = TeensyMerger(5000, clock=cclock)
+    merger.add_source("left", left.sync_clock(cclock))
+    merger.add_source("right", right.sync_clock(cclock))
+    for time_us, device_id, event in merge_events(pool.events, merger):
+        print(time_us, device_id, event)
+'''
+
+from __future__ import print_function
+import heapq
+
+try:
+    import queue as q
+except ImportError:
+    import Queue as q
+
+
+class TeensyMerger(object):
+    '''A streaming k-way merge of the events of several devices. Events are
+    pushed per device in the order in which the device delivered them and
+    pop_ready returns the events that can't be preceded anymore by other
+    events, ordered by their time in the common time domain.
+
+    lateness_us bounds how long an event is held back, clock may be a
+    function that returns the current time in the common domain in us, e.g.
+    the cclock that the devices are synchronized with; it lets the
+    watermark advance while all devices are silent.
+
+    An event that arrives while it is already older than the watermark is
+    late; the events that preceded it were emitted already. A late event is
+    emitted at the next pop_ready anyway, out of order, and counted in
+    self.late.
+    '''
+
+    def __init__(self, lateness_us: int, clock: callable=None):
+        self.lateness_us = lateness_us
+        self.clock = clock
+        self.late = 0
+        self._models = {}
+        self._latest = {}       # device id -> time of its newest event
+        self._newest = None     # the time of the newest event of all
+        self._heap = []
+        self._late_events = []
+        self._seq = 0           # keeps events with equal times in order
+        self._emitted = None    # the watermark of the last pop_ready
+
+    def __len__(self):
+        return len(self._heap) + len(self._late_events)
+
+    def add_source(self, device_id, model=None):
+        '''Adds a device to the merge. model converts the timestamps of the
+        device with model.to_host_time(timestamp), None leaves them as they
+        are, e.g. when the devices were synchronized with time_set.
+        '''
+        self._models[device_id] = model
+        self._latest.setdefault(device_id, None)
+
+    def set_model(self, device_id, model):
+        '''Replaces the clock model of a device, e.g. after a new sync.'''
+        self._models[device_id] = model
+
+    def remove_source(self, device_id):
+        '''Stops waiting for the events of a device, its events that were
+        pushed already are still emitted.
+        '''
+        del self._models[device_id]
+        del self._latest[device_id]
+
+    def push(self, device_id, event):
+        '''Adds the next event of device_id, returns its time in the common
+        domain.
+        '''
+        if device_id not in self._models:
+            self.add_source(device_id)
+        model = self._models[device_id]
+        if model is None:
+            time_us = event.timestamp
+        else:
+            time_us = model.to_host_time(event.timestamp)
+        self._latest[device_id] = time_us
+        if self._newest is None or time_us > self._newest:
+            self._newest = time_us
+        if self._emitted is not None and time_us < self._emitted:
+            self.late += 1
+            self._late_events.append((time_us, device_id, event))
+        else:
+            heapq.heappush(self._heap, (time_us, self._seq, device_id, event))
+            self._seq += 1
+        return time_us
+
+    def watermark(self):
+        '''Returns the time before which no more events are expected, or
+        None when nothing can be emitted yet.
+        '''
+        latest = self._latest.values()
+        mark = None
+        if latest and None not in latest:
+            mark = min(latest)
+        bounds = []
+        if self._newest is not None:
+            bounds.append(self._newest - self.lateness_us)
+        if self.clock is not None:
+            bounds.append(self.clock() - self.lateness_us)
+        if bounds:
+            bound = max(bounds)
+            if mark is None or bound > mark:
+                mark = bound
+        return mark
+
+    def pop_ready(self) -> list:
+        '''Returns the events up to the watermark as a list of tuples
+        (time_us, device_id, event) in order of time. Late events come
+        first.
+        '''
+        ready = self._late_events
+        self._late_events = []
+        mark = self.watermark()
+        if mark is None:
+            return ready
+        heap = self._heap
+        while heap and heap[0][0] <= mark:
+            time_us, _, device_id, event = heapq.heappop(heap)
+            ready.append((time_us, device_id, event))
+        if self._emitted is None or mark > self._emitted:
+            self._emitted = mark
+        return ready
+
+    def flush(self) -> list:
+        '''Returns all remaining events in order of time, e.g. at the end of
+        a session.
+        '''
+        ready = self._late_events
+        self._late_events = []
+        heap = self._heap
+        while heap:
+            time_us, _, device_id, event = heapq.heappop(heap)
+            ready.append((time_us, device_id, event))
+            self._emitted = time_us
+        return ready
+
+
+def merge_events(events, merger: TeensyMerger, poll: float=0.001, stop=None):
+    '''Generates the merged events (time_us, device_id, event) from events,
+    a queue of (device_id, event) tuples such as TeensyPool.events, until
+    stop, a threading.Event, is set. The remaining events are flushed then.
+    poll is how long to wait for new events in seconds.
+    '''
+    while stop is None or not stop.is_set():
+        try:
+            device_id, event = events.get(True, poll)
+            merger.push(device_id, event)
+            # Take a limited bite, so the merged events keep flowing.
+            for _ in range(4096):
+                device_id, event = events.get(False)
+                merger.push(device_id, event)
+        except q.Empty:
+            pass
+        for item in merger.pop_ready():
+            yield item
+    for item in merger.flush():
+        yield item
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+
+# This file is part of pyteensy.
+#
+# pyteensy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# pyteensy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with pyteensy.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+'''The teensypool module exports the TeensyPool class, it serves several
+Teensy devices from a single thread.
+
+    with TeensyPool() as pool:
+        left = pool.add("/dev/ttyACM0", "left")
+        right = pool.add("/dev/ttyACM1", "right", unix=True)
+        left.register_line(1)
+        right.register_line(1)
+        device_id, event = pool.events.get()
+'''
+
+from __future__ import print_function
+import collections
+import os
+from concurrent.futures import TimeoutError
+import selectors
+import threading
+
+try:
+    import queue as q
+except ImportError:
+    import Queue as q
+
+import pyteensy as t
+
+
+class _TeensyPoolMember(object):
+    '''Turns a Teensy class into one that is served by the thread of a
+    TeensyPool instead of a thread of its own. The members share the wake up
+    file descriptor of the pool, so submitting a command works as usual.
+    '''
+
+    def __init__(self, pool, device_id, *args, **kwargs):
+        self._pool = pool
+        self.device_id = device_id
+        super(_TeensyPoolMember, self).__init__(None, *args, **kwargs)
+
+    def handle_event(self, event):
+        '''Queues the event, tagged with the device id, in the events queue
+        of the pool.
+        '''
+        self._pool.events.put((self.device_id, event))
+
+    def _start_thread(self):
+        '''Does the handshake and hands the device over to the pool.'''
+        self._wakeup.close()
+        self._wakeup = None
+        # The pool doesn't read the device yet, so the handshake can be done
+        # from here.
+        self._identify()
+        self._wakeup = self._pool._wakeup
+        self._pool._attach(self)
+        self.connected = True
+
+    def _stop_thread(self):
+        '''Takes the device out of the pool.'''
+        self._pool._detach(self)
+        # The wake up belongs to the pool.
+        self._wakeup = None
+        self._release()
+
+
+class PooledTeensy(_TeensyPoolMember, t.Teensy):
+    '''A Teensy that is served by a TeensyPool, see TeensyPool.add.'''
+
+
+class PooledUnixTeensy(_TeensyPoolMember, t.UnixTeensy):
+    '''A UnixTeensy that is served by a TeensyPool, see TeensyPool.add.'''
+
+
+class TeensyPool(object):
+    '''Serves any number of Teensy devices from one thread that waits in a
+    single select call on all devices and on a wake up file descriptor. Each
+    device keeps its own command channel: the Teensy instances that add()
+    returns have all the usual commands. The events of all devices are
+    queued in self.events as tuples of (device_id, event).
+
+    Commands are pipelined as usual, only the time exchanges that need the
+    line for themselves, those of sync_clock, time_samples and track_drift,
+    hold up the other devices while they run; their bytes wait in the
+    kernel meanwhile. The pool requires a POSIX system.
+
+    Adding or removing a device waits at most TIMEOUT seconds for the
+    thread of the pool.
+    '''
+
+    TIMEOUT = 5.0
+
+    def __init__(self):
+        if os.name != "posix":
+            raise OSError("TeensyPool requires a POSIX system")
+        self.events = q.Queue()
+        self.devices = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._control = q.Queue()
+        self._wakeup = t._TeensyWakeup()
+        self._quit = False
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._wakeup, selectors.EVENT_READ, None)
+        self._thread = threading.Thread(target=self.run, name=repr(self))
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def add(self, devfn, device_id=None, unix: bool=False, **kwargs):
+        '''Connects with the Teensy at devfn and serves it from the pool.
+        device_id tags the events of the device, by default it is devfn.
+        With unix, a UnixTeensy is used instead of a Teensy. The other
+        keyword arguments are passed to the Teensy, e.g. columnar,
+        in which case the events are kept in the event_store of the device.
+        Returns the Teensy.
+        '''
+        if device_id is None:
+            device_id = devfn
+        with self._lock:
+            if device_id in self.devices:
+                raise ValueError("Duplicate device id: {}".format(device_id))
+            cls = PooledUnixTeensy if unix else PooledTeensy
+            teensy = cls(self, device_id, **kwargs)
+            teensy.connect(devfn)
+            self.devices[device_id] = teensy
+        return teensy
+
+    def remove(self, device_id):
+        '''Closes the device with device_id and removes it from the pool.
+        A device that failed is closed as well, so its file is released.
+        '''
+        with self._lock:
+            teensy = self.devices.pop(device_id)
+        teensy.close()
+
+    def close(self):
+        '''Closes all devices and stops the thread.'''
+        if self._thread is None:
+            return
+        for device_id in list(self.devices):
+            self.remove(device_id)
+        self._quit = True
+        self._wakeup.set()
+        self._thread.join()
+        self._thread = None
+        self._selector.close()
+        self._wakeup.close()
+
+    def _control_task(self, task, teensy, error):
+        '''Lets the thread run task for teensy and waits for it, a
+        TeensyError with error is raised when the thread doesn't respond.
+        '''
+        task = t._TeensyTask(task, teensy)
+        self._control.put(task)
+        self._wakeup.set()
+        try:
+            task.future.result(self.TIMEOUT)
+        except TimeoutError:
+            raise t.TeensyError(
+                error, "the thread of the pool doesn't respond"
+                )
+
+    def _attach(self, teensy):
+        '''Asks the thread to start serving teensy.'''
+        self._control_task(
+            self._serve, teensy, t.TeensyError.UNABLE_TO_CONNECT
+            )
+
+    def _detach(self, teensy):
+        '''Asks the thread to stop serving teensy.'''
+        self._control_task(self._unserve, teensy, t.TeensyError.NOT_CONNECTED)
+
+    def _serve(self, teensy):
+        self._selector.register(
+            teensy._fileno(), selectors.EVENT_READ, teensy
+            )
+
+    def _unserve(self, teensy):
+        try:
+            self._selector.unregister(teensy._fileno())
+        except KeyError:
+            # It failed and was taken out already.
+            pass
+
+    def _fail(self, teensy, err):
+        '''Takes a device that failed out of the selection, its commands
+        fail with err.
+        '''
+        self._unserve(teensy)
+        started = t._TeensyTask(t._TeensyPackage.IDENTIFY)
+        started.future.set_result(None)
+        teensy._abort(started, err)
+
+    def _members(self):
+        return [key.data for key in self._selector.get_map().values()
+                if key.data is not None]
+
+    def _handle_wakeup(self):
+        '''Handles the control tasks of the pool and the tasks that were
+        submitted to any of the devices.
+        '''
+        self._wakeup.clear()
+        while True:
+            try:
+                task = self._control.get(False)
+            except q.Empty:
+                break
+            try:
+                task.task(*task.args)
+            except Exception as err:
+                # The thread must go on serving the other devices.
+                task.future.set_exception(err)
+            else:
+                task.future.set_result(None)
+        for teensy in self._members():
+            tasks = teensy._tqueue
+            try:
+                while True:
+                    teensy._handle_task(tasks.get(False))
+            except q.Empty:
+                pass
+            except Exception as err:
+                self._fail(teensy, err)
+
+    def _timer_timeout(self, members):
+        timeouts = [teensy._timer_timeout() for teensy in members]
+        timeouts = [timeout for timeout in timeouts if timeout is not None]
+        return min(timeouts) if timeouts else None
+
+    def run(self):
+        '''The thread of the pool, all devices are read from and written to
+        from here.
+        '''
+        selector = self._selector
+        members = []
+        while not self._quit:
+            for key, _ in selector.select(self._timer_timeout(members)):
+                teensy = key.data
+                if teensy is None:
+                    self._handle_wakeup()
+                    continue
+                try:
+                    teensy._fetch_events()
+                except Exception as err:
+                    self._fail(teensy, err)
+            members = self._members()
+            for teensy in members:
+                try:
+                    teensy._run_timers()
+                except Exception as err:
+                    self._fail(teensy, err)
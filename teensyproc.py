@@ -0,0 +1,435 @@
+#!/usr/bin/env python3
+
+# This file is part of pyteensy.
+#
+# pyteensy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# pyteensy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with pyteensy.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+'''The teensyproc module runs a Teensy in a child process, so reading the
+device doesn't compete for the interpreter with the process that uses the
+events, e.g. one that renders stimuli.
+
+The child publishes the events in a ring buffer in shared memory, the
+commands and their results are passed over a pipe. ProcessTeensy has the
+API of a Teensy:
+
+    with ProcessTeensy("/dev/ttyACM0", unix=True) as teensy:
+        teensy.register_line(1)
+        event = teensy.events.get()
+'''
+
+from __future__ import print_function
+import multiprocessing as mp
+import struct
+import threading
+import time
+from multiprocessing import shared_memory
+
+try:
+    import queue as q
+except ImportError:
+    import Queue as q
+
+import pyteensy as t
+import teensyclock as tc
+
+
+class TeensyEventRing(object):
+    '''A ring buffer of fixed size event records in shared memory, written
+    by one producer and read by any number of TeensyRingReaders, each with
+    a cursor of its own. No locks are used: the producer first advances
+    the claim cursor past the records it is going to write, writes them
+    and then advances the write cursor. A reader copies the records up to
+    the write cursor and afterwards checks with the claim cursor that the
+    producer didn't overwrite them meanwhile. A reader that falls more than
+    capacity records behind loses the oldest ones.
+
+    Pass name to attach to a ring that another process created.
+    '''
+
+    # write cursor, capacity, claim cursor
+    _HEADER = struct.Struct("<QQQ")
+    _CURSOR = struct.Struct("<Q")
+    _CLAIM_OFFSET = 16
+    _HEADER_SIZE = 64
+    # timestamp, line, logic level
+    RECORD = struct.Struct("<QBB6x")
+
+    def __init__(self, capacity: int=1 << 16, name: str=None):
+        if name is None:
+            self._shm = shared_memory.SharedMemory(
+                create=True,
+                size=self._HEADER_SIZE + capacity * self.RECORD.size
+                )
+            self._HEADER.pack_into(self._shm.buf, 0, 0, capacity, 0)
+            self.owner = True
+        else:
+            self._shm = shared_memory.SharedMemory(name)
+            _, capacity, _ = self._HEADER.unpack_from(self._shm.buf, 0)
+            self.owner = False
+        self.name = self._shm.name
+        self.capacity = capacity
+        self.buf = self._shm.buf
+        self._cursor = self.write_cursor()
+
+    def write_cursor(self) -> int:
+        '''The number of records that were ever published.'''
+        return self._CURSOR.unpack_from(self.buf, 0)[0]
+
+    def claim_cursor(self) -> int:
+        '''The number of records that were ever published or are being
+        written; the record at claim_cursor() - capacity and the older ones
+        may have been overwritten.
+        '''
+        return self._CURSOR.unpack_from(self.buf, self._CLAIM_OFFSET)[0]
+
+    def _record_offset(self, cursor):
+        return self._HEADER_SIZE + (cursor % self.capacity) * self.RECORD.size
+
+    def publish(self, event):
+        '''Appends a line event, only the producer may call this.'''
+        cursor = self._cursor
+        self._CURSOR.pack_into(self.buf, self._CLAIM_OFFSET, cursor + 1)
+        self.RECORD.pack_into(
+            self.buf, self._record_offset(cursor),
+            event.timestamp, event.line, event.logiclevel
+            )
+        self._cursor = cursor + 1
+        self._CURSOR.pack_into(self.buf, 0, self._cursor)
+
+    def publish_frames(self, frames):
+        '''Appends a numpy array of EVENT_TRIGGER frames, only the producer
+        may call this.
+        '''
+        np = t.np
+        records = np.ndarray(
+            (self.capacity,), self.record_dtype(), self.buf, self._HEADER_SIZE
+            )
+        # The frames that don't fit are lost, as if they were overwritten.
+        dropped = max(0, len(frames) - self.capacity)
+        frames = frames[dropped:]
+        self._cursor += dropped
+        self._CURSOR.pack_into(
+            self.buf, self._CLAIM_OFFSET, self._cursor + len(frames)
+            )
+        start = self._cursor % self.capacity
+        first = min(len(frames), self.capacity - start)
+        for dest, src in (
+                (records[start:start + first], frames[:first]),
+                (records[:len(frames) - first], frames[first:])):
+            dest["timestamp"] = src["timestamp"]
+            dest["line"] = src["line"]
+            dest["logiclevel"] = src["level"]
+        self._cursor += len(frames)
+        self._CURSOR.pack_into(self.buf, 0, self._cursor)
+
+    @classmethod
+    def record_dtype(cls):
+        '''The numpy dtype of the records.'''
+        np = t.np
+        return np.dtype({
+            "names" : ["timestamp", "line", "logiclevel"],
+            "formats" : ["<u8", np.uint8, np.uint8],
+            "offsets" : [0, 8, 9],
+            "itemsize" : cls.RECORD.size
+            })
+
+    def close(self):
+        '''Detaches from the ring, the ring is removed when its creator
+        closes it.
+        '''
+        self.buf = None
+        self._shm.close()
+        if self.owner:
+            self._shm.unlink()
+
+
+class TeensyRingReader(object):
+    '''Reads the events from a TeensyEventRing with a cursor of its own.
+    It starts at the events that are published after it was created.
+    self.lost counts the events that were overwritten before they were read.
+    '''
+
+    def __init__(self, ring: TeensyEventRing):
+        self.ring = ring
+        self.cursor = ring.write_cursor()
+        self.lost = 0
+
+    def available(self) -> int:
+        '''The number of events that can be read.'''
+        return min(self.ring.write_cursor() - self.cursor, self.ring.capacity)
+
+    def _check_overrun(self):
+        '''Skips the records that were or are being overwritten.'''
+        oldest = self.ring.claim_cursor() - self.ring.capacity
+        if self.cursor < oldest:
+            self.lost += oldest - self.cursor
+            self.cursor = oldest
+
+    def read(self, maxcount: int=None) -> list:
+        '''Returns the published events as TeensyLineEvents.'''
+        ring = self.ring
+        end = ring.write_cursor()
+        self._check_overrun()
+        if maxcount is not None:
+            end = min(end, self.cursor + maxcount)
+        start = self.cursor
+        unpack = ring.RECORD.unpack_from
+        buf = ring.buf
+        records = [unpack(buf, ring._record_offset(i)) for i in range(start, end)]
+        # Drop what the producer overwrote while the records were copied,
+        # including the record it may be writing right now.
+        skip = max(0, ring.claim_cursor() - ring.capacity - start)
+        if skip:
+            self.lost += skip
+            records = records[skip:]
+        self.cursor = end
+        return [t.TeensyLineEvent(*record) for record in records]
+
+    def read_array(self, maxcount: int=None):
+        '''Returns the published events as a numpy structured array with the
+        fields timestamp, line and logiclevel.
+        '''
+        np = t.np
+        ring = self.ring
+        end = ring.write_cursor()
+        self._check_overrun()
+        if maxcount is not None:
+            end = min(end, self.cursor + maxcount)
+        start = self.cursor
+        records = np.ndarray(
+            (ring.capacity,), ring.record_dtype(), ring.buf, ring._HEADER_SIZE
+            )
+        first = start % ring.capacity
+        count = end - start
+        if first + count <= ring.capacity:
+            result = records[first:first + count].copy()
+        else:
+            result = np.concatenate(
+                (records[first:], records[:first + count - ring.capacity])
+                )
+        skip = max(0, ring.claim_cursor() - ring.capacity - start)
+        if skip:
+            self.lost += skip
+            result = result[skip:]
+        self.cursor = end
+        return result
+
+
+class _RingEventQueue(object):
+    '''A stand in for Teensy.events in the parent process. It reads the
+    events from the ring with a reader of its own and supports the
+    queue.Queue methods that consumers use.
+    '''
+
+    def __init__(self, ring, signal):
+        self._reader = TeensyRingReader(ring)
+        self._signal = signal
+        self._buffer = []
+        self._lock = threading.Lock()
+
+    @property
+    def lost(self):
+        return self._reader.lost
+
+    def _refill(self):
+        if not self._buffer:
+            self._buffer = self._reader.read()
+            self._buffer.reverse()
+        return bool(self._buffer)
+
+    def qsize(self):
+        with self._lock:
+            return len(self._buffer) + self._reader.available()
+
+    def empty(self):
+        return not self.qsize()
+
+    def get(self, block=True, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                if self._refill():
+                    return self._buffer.pop()
+            if not block:
+                raise q.Empty
+            self._signal.clear()
+            with self._lock:
+                if self._refill():
+                    return self._buffer.pop()
+            wait = 0.01
+            if deadline is not None:
+                wait = min(wait, deadline - time.monotonic())
+                if wait <= 0:
+                    raise q.Empty
+            # The signal may be cleared by another consumer, hence the wait
+            # is limited.
+            self._signal.wait(wait)
+
+    def get_nowait(self):
+        return self.get(False)
+
+
+def _make_child_class(base):
+    class _RingTeensy(base):
+        '''A Teensy that publishes its events in a TeensyEventRing.'''
+
+        def __init__(self, ring, signal, *args, **kwargs):
+            self._ring = ring
+            self._signal = signal
+            super(_RingTeensy, self).__init__(*args, **kwargs)
+
+        def handle_event(self, event):
+            self._ring.publish(event)
+
+        def handle_event_array(self, frames):
+            self._ring.publish_frames(frames)
+
+        def _fetch_events(self):
+            cursor = self._ring._cursor
+            super(_RingTeensy, self)._fetch_events()
+            if self._ring._cursor != cursor and not self._signal.is_set():
+                self._signal.set()
+
+    return _RingTeensy
+
+
+def _engine_main(devfn, unix, ring_name, signal, conn, kwargs):
+    '''The child process, it serves the commands that arrive over conn.'''
+    ring = TeensyEventRing(name=ring_name)
+    cls = _make_child_class(t.UnixTeensy if unix else t.Teensy)
+    try:
+        teensy = cls(ring, signal, devfn, **kwargs)
+    except Exception as err:
+        conn.send(("error", err))
+        ring.close()
+        return
+    conn.send(("ok", None))
+    try:
+        while True:
+            try:
+                name, args, kwargs = conn.recv()
+            except EOFError:
+                # The parent is gone.
+                return
+            if name == "close":
+                break
+            try:
+                conn.send(("ok", getattr(teensy, name)(*args, **kwargs)))
+            except Exception as err:
+                conn.send(("error", err))
+    finally:
+        teensy.close()
+        ring.close()
+    conn.send(("ok", None))
+
+
+class ProcessTeensy(object):
+    '''A Teensy that runs in a child process. The commands are forwarded to
+    the child over a pipe, self.events reads the events from a
+    TeensyEventRing of capacity events in shared memory; when the consumer
+    falls behind more than capacity events, the oldest are lost and
+    counted in self.events.lost. Use reader() for a cursor of your own.
+
+    If unix is True the child uses a UnixTeensy. The remaining keyword
+    arguments are passed to the Teensy in the child, e.g. columnar=True,
+    which lets the child publish runs of events at once. Arguments of
+    commands, like the cclock of sync_clock, must be picklable, i.e.
+    module level functions. Subscriptions, handle_event and the event
+    store of the child are not available in this process.
+
+    track_drift isn't available either: the DriftModel would be a copy that
+    the child never updates, and the ring records have no room for host
+    times, so stamp_events can't work. Repeat sync_clock(apply=False), or
+    fit a teensyclock.DriftModel to time_samples in this process instead.
+    '''
+
+    _COMMANDS = (
+        "register_line", "register_lines",
+        "register_single_shot", "register_single_shots",
+        "deregister_input", "deregister_inputs",
+        "time", "time_set", "sync_clock",
+        "time_samples", "rtt_stats", "stats"
+        )
+
+    def __init__(self, devfn="/dev/ttyACM0", unix=False, capacity=1 << 16,
+                 **kwargs):
+        self.connected = False
+        self.clock_sync = None
+        self._ring = TeensyEventRing(capacity)
+        context = mp.get_context("spawn")
+        self._signal = context.Event()
+        self._conn, child_conn = context.Pipe()
+        self._lock = threading.Lock()
+        self.events = _RingEventQueue(self._ring, self._signal)
+        self._process = context.Process(
+            target=_engine_main,
+            args=(devfn, unix, self._ring.name, self._signal, child_conn,
+                  kwargs),
+            daemon=True
+            )
+        self._process.start()
+        child_conn.close()
+        try:
+            self._receive()
+        except BaseException:
+            self._process.join()
+            self._ring.close()
+            raise
+        self.connected = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def reader(self) -> TeensyRingReader:
+        '''Returns a reader with a cursor of its own on the event ring.'''
+        return TeensyRingReader(self._ring)
+
+    def _receive(self):
+        status, result = self._conn.recv()
+        if status == "error":
+            raise result
+        return result
+
+    def _call(self, name, *args, **kwargs):
+        if not self.connected:
+            raise t.TeensyError(t.TeensyError.NOT_CONNECTED)
+        with self._lock:
+            self._conn.send((name, args, kwargs))
+            return self._receive()
+
+    def __getattr__(self, name):
+        if name in self._COMMANDS:
+            return lambda *args, **kwargs: self._call(name, *args, **kwargs)
+        raise AttributeError(name)
+
+    def sync_clock(self, *args, **kwargs) -> tc.ClockSync:
+        '''See Teensy.sync_clock, the result is kept in self.clock_sync.'''
+        self.clock_sync = self._call("sync_clock", *args, **kwargs)
+        return self.clock_sync
+
+    def close(self):
+        '''Closes the Teensy and stops the child process.'''
+        if not self.connected:
+            return
+        self.connected = False
+        with self._lock:
+            self._conn.send(("close", (), {}))
+            self._receive()
+        self._process.join()
+        self._conn.close()
+        self._ring.close()
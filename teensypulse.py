@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+
+# This file is part of pyteensy.
+#
+# pyteensy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# pyteensy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with pyteensy.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+'''The teensypulse module pairs the edges that a Teensy reports into pulses.
+A pulse starts with an edge to the pulse level, by default a rising edge,
+and ends with the next edge of the same line, so each pulse has an onset, an
+offset and a duration.
+
+    pairer = TeensyPulsePairer(single_shots=[4])
+    for pulse in pair_events(teensy.events, pairer, stop):
+        print(pulse.line, pulse.onset, pulse.duration)
+
+pair_edges does the same for arrays of recorded events at once, e.g. the
+records of a teensyrecord.TeensySession:
+
+    pulses = pair_edges(session.line, session.timestamp, session.level)
+'''
+
+from __future__ import print_function
+
+try:
+    import queue as q
+except ImportError:
+    import Queue as q
+
+import pyteensy as pt
+
+if pt.np is not None:
+    # A pulse in the arrays of pair_edges. A single shot has no offset, its
+    # offset is 0 and its duration -1.
+    PULSE_DTYPE = pt.np.dtype([
+        ("line", pt.np.uint8),
+        ("onset", "<u8"),
+        ("offset", "<u8"),
+        ("duration", "<i8"),
+        ("level", pt.np.uint8)
+        ])
+
+
+class TeensyPulse(object):
+    '''A pulse on line from onset until offset, times in us. level is the
+    logic level of the line during the pulse. The event of a single shot
+    line is a pulse without an offset: offset and duration are None and
+    level is the level that the line went to.
+    '''
+
+    __slots__ = ("line", "onset", "offset", "level")
+
+    def __init__(self, line: int, onset: int, offset: int, level: int):
+        self.line = line
+        self.onset = onset
+        self.offset = offset
+        self.level = level
+
+    @property
+    def duration(self) -> int:
+        if self.offset is None:
+            return None
+        return self.offset - self.onset
+
+    def __str__(self):
+        return "{}\t{}\t{}\t{}\t{}".format(
+            self.line, self.onset, self.offset, self.duration, self.level
+            )
+
+
+class TeensyPulsePairer(object):
+    '''Turns a stream of line events into TeensyPulses. Only the onset of
+    the open pulse is remembered per line, so the state is bounded no matter
+    how long the stream is.
+
+    An edge to level opens a pulse and the next edge of the line closes it.
+    When an edge was missed, the stream has two edges to the same level in
+    a row: a second onset replaces the first one, which is counted in
+    self.unpaired, and so is an offset without an onset. The events of the
+    lines in single_shots are never paired, every one is a pulse by itself,
+    see TeensyPulse.
+    '''
+
+    def __init__(self, level: int=1, single_shots=()):
+        self.level = 1 if level else 0
+        self.unpaired = 0
+        self._onsets = [None] * pt.Teensy.NUM_LINES
+        self._single_shots = [False] * pt.Teensy.NUM_LINES
+        for line in single_shots:
+            self.set_single_shot(line)
+
+    def set_single_shot(self, line: int, single_shot: bool=True):
+        '''Marks line as a single shot line, or as a normal line again.'''
+        self._single_shots[line] = single_shot
+        self._onsets[line] = None
+
+    def push(self, event: pt.TeensyLineEvent) -> TeensyPulse:
+        '''Adds the next event, returns the pulse that it completes or None.
+        '''
+        line = event.line
+        level = 1 if event.logiclevel else 0
+        if self._single_shots[line]:
+            return TeensyPulse(line, event.timestamp, None, level)
+        onset = self._onsets[line]
+        if level == self.level:
+            if onset is not None:
+                self.unpaired += 1
+            self._onsets[line] = event.timestamp
+            return None
+        if onset is None:
+            self.unpaired += 1
+            return None
+        self._onsets[line] = None
+        return TeensyPulse(line, onset, event.timestamp, self.level)
+
+    def flush(self) -> list:
+        '''Returns the pulses that are still open as TeensyPulses without an
+        offset, e.g. at the end of a session, and forgets them.
+        '''
+        pulses = [
+            TeensyPulse(line, onset, None, self.level)
+            for line, onset in enumerate(self._onsets) if onset is not None
+            ]
+        self._onsets = [None] * pt.Teensy.NUM_LINES
+        return pulses
+
+
+def pair_events(events, pairer: TeensyPulsePairer, stop=None, poll=0.001):
+    '''Generates the pulses of events, an iterable of line events or a
+    queue such as Teensy.events. A queue is read until stop, a
+    threading.Event, is set, poll is how long to wait for an event in
+    seconds. The pulses that are open at the end are not generated, they
+    remain in the pairer.
+    '''
+    if not isinstance(events, q.Queue):
+        for event in events:
+            pulse = pairer.push(event)
+            if pulse is not None:
+                yield pulse
+        return
+    while stop is None or not stop.is_set():
+        try:
+            event = events.get(True, poll)
+        except q.Empty:
+            continue
+        pulse = pairer.push(event)
+        if pulse is not None:
+            yield pulse
+
+
+def pair_edges(line, timestamp, level, pulse_level=1, single_shots=()):
+    '''Pairs the edges in the arrays line, timestamp and level at once and
+    returns an array of PULSE_DTYPE, sorted by line and onset. The events
+    must be in order of time per line, as a Teensy reports them. The pairs
+    are the same as those of a TeensyPulsePairer: a pulse is an edge to
+    pulse_level that is directly followed by an edge of the same line to the
+    other level. Pulses that are still open at the end are left out.
+    '''
+    np = pt.np
+    if np is None:
+        raise ImportError("pair_edges requires numpy")
+    line = np.asarray(line, np.uint8)
+    timestamp = np.asarray(timestamp)
+    level = np.asarray(level) != 0
+    # A stable sort keeps the order of time within every line.
+    order = np.argsort(line, kind="stable")
+    line = line[order]
+    timestamp = timestamp[order]
+    level = level[order]
+
+    is_single = np.zeros(pt.Teensy.NUM_LINES, bool)
+    is_single[list(single_shots)] = True
+    single = is_single[line]
+    onset = level == bool(pulse_level)
+    paired = onset[:-1] & ~onset[1:] & (line[1:] == line[:-1]) & ~single[:-1]
+    starts = np.flatnonzero(paired)
+    singles = np.flatnonzero(single)
+
+    pulses = np.empty(len(starts) + len(singles), PULSE_DTYPE)
+    npairs = len(starts)
+    pulses["line"][:npairs] = line[starts]
+    pulses["onset"][:npairs] = timestamp[starts]
+    pulses["offset"][:npairs] = timestamp[starts + 1]
+    pulses["duration"][:npairs] = \
+        pulses["offset"][:npairs].astype(np.int64) - \
+        pulses["onset"][:npairs].astype(np.int64)
+    pulses["level"][:npairs] = 1 if pulse_level else 0
+    pulses["line"][npairs:] = line[singles]
+    pulses["onset"][npairs:] = timestamp[singles]
+    pulses["offset"][npairs:] = 0
+    pulses["duration"][npairs:] = -1
+    pulses["level"][npairs:] = level[singles]
+    if len(singles):
+        pulses = pulses[np.lexsort((pulses["onset"], pulses["line"]))]
+    return pulses
@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+
+# This file is part of pyteensy.
+#
+# pyteensy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# pyteensy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with pyteensy.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+'''The teensyrecord module writes the events of a Teensy to a session file
+while they arrive and reads such files back.
+
+A session file starts with a header block of HEADER_SIZE bytes: the magic
+bytes, the format version, the record size, followed by JSON metadata,
+e.g. the device and the clock synchronization, padded with spaces. The
+header block may be rewritten while recording. After the header follow
+fixed size records: the raw EVENT_TRIGGER frame as it was received,
+followed by the host time in ns at which it was received, as a little
+endian unsigned 64 bit integer. A file is only ever appended to, so after
+a crash all records up to the last flush can be read.
+'''
+
+from __future__ import print_function
+import json
+import mmap
+import os
+import struct
+import time
+
+import pyteensy as pt
+
+MAGIC = b"PYTEENSY"
+VERSION = 1
+HEADER_SIZE = 4096
+
+_HEADER = struct.Struct("<8sHH")
+_FRAME_SIZE = pt._TeensyPackage._EVENT_TRIGGER.size
+_RECORD = struct.Struct("<{}sQ".format(_FRAME_SIZE))
+_HOST_NS = struct.Struct("<Q")
+
+if pt.np is not None:
+    # The layout of a record in a session file.
+    RECORD_DTYPE = pt.np.dtype([
+        ("size", pt.np.uint8),
+        ("type", pt.np.uint8),
+        ("line", pt.np.uint8),
+        ("timestamp", "<u8"),
+        ("level", pt.np.uint8),
+        ("host_ns", "<u8")
+        ])
+    assert RECORD_DTYPE.itemsize == _RECORD.size
+    # A record as the raw frame and the host time, to copy runs of frames.
+    _RUN_DTYPE = pt.np.dtype([
+        ("frame", "V{}".format(_FRAME_SIZE)),
+        ("host_ns", "<u8")
+        ])
+
+
+class TeensyRecorder(object):
+    '''Appends the events that a Teensy receives to a session file. Pass it
+    as the recorder argument of a Teensy; it is then fed from the thread
+    that reads the device, before the events are decoded.
+
+    Records are collected in a buffer of batch_size records, which is
+    written when it is full or when it is older than flush_interval
+    seconds. Every fsync_interval seconds the file is also synced to disk.
+    clock returns the host receive time in ns that is stored with every
+    record, by default time.time_ns.
+    '''
+
+    def __init__(
+            self,
+            filename,
+            metadata: dict=None,
+            batch_size: int=4096,
+            flush_interval: float=0.1,
+            fsync_interval: float=1.0,
+            clock: callable=time.time_ns
+            ):
+        self.filename = filename
+        self.metadata = dict(metadata or {})
+        self.metadata.setdefault("clock", getattr(clock, "__name__", ""))
+        self.clock = clock
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self.nrecords = 0
+        self._buf = bytearray(batch_size * _RECORD.size)
+        self._pos = 0
+        # The buffer as records, runs of frames are copied into it at once.
+        self._records = None
+        if pt.np is not None:
+            self._records = pt.np.frombuffer(self._buf, _RUN_DTYPE)
+        self._fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+        self._write_header()
+        os.lseek(self._fd, HEADER_SIZE, os.SEEK_SET)
+        now = time.monotonic()
+        self._flushed = now
+        self._synced = now
+        self._unsynced = False  # records were written since the last sync
+
+    def _write_header(self):
+        meta = json.dumps(self.metadata).encode("utf-8")
+        header = _HEADER.pack(MAGIC, VERSION, _RECORD.size) + meta
+        if len(header) > HEADER_SIZE:
+            raise ValueError("The metadata doesn't fit in the header.")
+        os.pwrite(self._fd, header.ljust(HEADER_SIZE, b" "), 0)
+
+    def update_metadata(self, **kwargs):
+        '''Adds the keyword arguments to the metadata and rewrites the header.
+        The values must be serializable as JSON. Once the recorder is
+        closed, only self.metadata is updated.
+        '''
+        self.metadata.update(kwargs)
+        if self._fd is not None:
+            self._write_header()
+
+    def record(self, buf, offset: int, host_ns: int):
+        '''Records the EVENT_TRIGGER frame at offset in buf.'''
+        if self._pos == len(self._buf):
+            self.flush()
+        pos = self._pos
+        end = pos + _FRAME_SIZE
+        self._buf[pos:end] = buf[offset:offset + _FRAME_SIZE]
+        _HOST_NS.pack_into(self._buf, end, host_ns)
+        self._pos = end + _HOST_NS.size
+
+    def record_run(self, buf, offset: int, nframes: int, host_ns: int):
+        '''Records nframes consecutive EVENT_TRIGGER frames at offset in buf.
+        The frames are copied with one numpy slice assignment per batch.
+        '''
+        frames = pt.np.frombuffer(
+            buf, "V{}".format(_FRAME_SIZE), nframes, offset
+            )
+        records = self._records
+        done = 0
+        while done < nframes:
+            if self._pos == len(self._buf):
+                self.flush()
+            first = self._pos // _RECORD.size
+            count = min(nframes - done, len(records) - first)
+            dest = records[first:first + count]
+            dest["frame"] = frames[done:done + count]
+            dest["host_ns"] = host_ns
+            self._pos += count * _RECORD.size
+            done += count
+
+    @property
+    def closed(self) -> bool:
+        return self._fd is None
+
+    def due(self):
+        '''Returns the number of seconds until buffered records must be
+        written or written records must be synced, or None if there is
+        nothing to do.
+        '''
+        deadlines = []
+        if self._pos:
+            deadlines.append(self._flushed + self.flush_interval)
+        if self._pos or self._unsynced:
+            deadlines.append(self._synced + self.fsync_interval)
+        if not deadlines or self._fd is None:
+            return None
+        return max(0.0, min(deadlines) - time.monotonic())
+
+    def poll(self):
+        '''Writes the buffered records and syncs the file when that is due.'''
+        if self._fd is None:
+            return
+        now = time.monotonic()
+        if self._pos and now - self._flushed >= self.flush_interval:
+            self.flush()
+        if self._unsynced and now - self._synced >= self.fsync_interval:
+            os.fsync(self._fd)
+            self._synced = now
+            self._unsynced = False
+
+    def flush(self):
+        '''Writes the buffered records to the file.'''
+        if self._fd is None:
+            return
+        view = memoryview(self._buf)[:self._pos]
+        while view:
+            view = view[os.write(self._fd, view):]
+        if self._pos:
+            self._unsynced = True
+        self.nrecords += self._pos // _RECORD.size
+        self._pos = 0
+        self._flushed = time.monotonic()
+
+    def close(self):
+        '''Writes the buffered records, syncs and closes the file.'''
+        if self._fd is None:
+            return
+        self.flush()
+        os.fsync(self._fd)
+        os.close(self._fd)
+        self._fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class TeensySession(object):
+    '''A session file that is opened for reading. The file is memory mapped
+    and self.records is a numpy structured array (see RECORD_DTYPE) that is
+    a view on the mapping, so even huge files open instantly and only the
+    parts that are used are read from disk. self.metadata contains the
+    metadata from the header.
+    '''
+
+    def __init__(self, filename):
+        if pt.np is None:
+            raise ImportError("TeensySession requires numpy")
+        with open(filename, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < HEADER_SIZE:
+                raise ValueError("{} is not a session file".format(filename))
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, record_size = _HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or record_size != _RECORD.size:
+            raise ValueError("{} is not a session file".format(filename))
+        if version != VERSION:
+            raise ValueError(
+                "Unsupported session file version {}".format(version)
+                )
+        meta = self._mmap[_HEADER.size:HEADER_SIZE]
+        self.metadata = json.loads(meta.decode("utf-8"))
+        # A record that was written partially, is ignored.
+        nrecords = (size - HEADER_SIZE) // _RECORD.size
+        self.records = pt.np.frombuffer(
+            self._mmap, RECORD_DTYPE, nrecords, HEADER_SIZE
+            )
+
+    def __len__(self):
+        return len(self.records)
+
+    @property
+    def line(self):
+        return self.records["line"]
+
+    @property
+    def timestamp(self):
+        return self.records["timestamp"]
+
+    @property
+    def level(self):
+        return self.records["level"]
+
+    @property
+    def host_ns(self):
+        return self.records["host_ns"]
+
+    def close(self):
+        '''Releases the mapping, the arrays obtained from it must be gone.'''
+        self.records = None
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def read_session(filename) -> TeensySession:
+    '''Opens a session file for reading.'''
+    return TeensySession(filename)
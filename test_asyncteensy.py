@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+# This file is part of pyteensy.
+#
+# pyteensy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# pyteensy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with pyteensy.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+'''Tests of AsyncTeensy against the emulator.'''
+
+import asyncio
+import time as tm
+
+import pytest
+
+import pyteensy as pt
+from asyncteensy import AsyncTeensy
+
+TIMEOUT = 5.0
+
+
+def _run(coroutine):
+    return asyncio.run(asyncio.wait_for(coroutine, TIMEOUT))
+
+
+def test_commands(emulator):
+    async def commands():
+        async with await AsyncTeensy.open(emulator.devfn) as teensy:
+            # The commands are pipelined.
+            times = await asyncio.gather(*[teensy.time() for _ in range(16)])
+            assert times == sorted(times)
+            await teensy.time_set(10 ** 6)
+            assert await teensy.time() >= 10 ** 6
+            await teensy.register_line(1)
+            await teensy.register_single_shot(2)
+            assert emulator.lines == {1: False, 2: True}
+            await teensy.deregister_input(1)
+            assert emulator.lines == {2: True}
+        assert not teensy.connected
+
+    _run(commands())
+
+
+def test_invalid_line(emulator_class):
+    async def register():
+        with emulator_class(nlines=4) as emulator:
+            async with await AsyncTeensy.open(emulator.devfn) as teensy:
+                with pytest.raises(pt.TeensyError) as info:
+                    await teensy.register_line(5)
+                assert info.value.int_error == \
+                    pt.TeensyError.INVALID_TRIGGER_LINE
+                assert await teensy.time() >= 0
+
+    _run(register())
+
+
+def test_events(emulator):
+    async def receive():
+        teensy = await AsyncTeensy.open(emulator.devfn)
+        await teensy.register_line(3)
+        for level in (1, 0, 1):
+            emulator.trigger(3, level)
+        received = []
+        async for event in teensy.events():
+            received.append((event.line, event.logiclevel))
+            if len(received) == 3:
+                teensy.close()
+        return received
+
+    assert _run(receive()) == [(3, 1), (3, 0), (3, 1)]
+
+
+def test_sync_clock(emulator_class):
+    def cclock():
+        return tm.monotonic_ns() // 1000
+
+    async def sync():
+        with emulator_class(start_us=10 ** 9) as emulator:
+            async with await AsyncTeensy.open(emulator.devfn) as teensy:
+                result = await teensy.sync_clock(cclock, samples=8)
+                assert result.applied
+                assert abs(result.offset) < 20000
+                assert teensy.clock_sync is result
+
+    _run(sync())
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+# This file is part of pyteensy.
+#
+# pyteensy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# pyteensy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with pyteensy.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+'''Tests of the clock synchronization of teensyclock and pyteensy.'''
+
+import time as tm
+
+import pytest
+
+import pyteensy as pt
+import teensyclock as tc
+
+
+def _cclock():
+    return tm.monotonic_ns() // 1000
+
+
+def test_estimate_offset():
+    # The Teensy clock runs 1000 us ahead, the exchanges take 10 to 40 us
+    # and the Teensy reads its clock anywhere in between.
+    samples = [
+        tc.ClockSample(host, host + 1000 + delay // 2, host + delay)
+        for host, delay in zip(range(0, 10000, 1000), [10, 40, 20, 30] * 3)
+        ]
+    result = tc.estimate_offset(samples, keep=0.5)
+    assert result.nsamples == 5
+    assert result.rtt == 10
+    assert abs(result.offset - 1000) <= result.uncertainty
+    assert result.to_host_time(result.to_teensy_time(5000)) == 5000
+    with pytest.raises(ValueError):
+        tc.estimate_offset([])
+
+
+def test_sync_clock(emulator_class):
+    with emulator_class(start_us=10 ** 9) as emulator:
+        with pt.Teensy(emulator.devfn) as teensy:
+            before = teensy.sync_clock(_cclock, samples=8, apply=False)
+            assert not before.applied
+            assert abs(before.offset - (10 ** 9 - _cclock())) < 10 ** 7
+            after = teensy.sync_clock(_cclock, samples=8)
+            assert after.applied
+            assert after.nsamples == 2     # the fastest quarter
+            assert abs(after.offset) < 20000
+            assert teensy.clock_sync is after
+            with pytest.raises(pt.TeensyError) as info:
+                teensy.sync_clock(_cclock, thres_us=0, samples=4)
+            assert info.value.int_error == pt.TeensyError.UNABLE_TO_SYNC
+
+
+def test_drift_model():
+    # The Teensy clock runs 200 ppm fast and starts at 5000 us.
+    model = tc.DriftModel(window=32)
+    for i in range(32):
+        host = i * 100000
+        teensy = 5000 + round((host + 10) * (1 + 200e-6))
+        model.add(tc.ClockSample(host, teensy, host + 20 + i % 3))
+    assert len(model) == 32
+    assert abs(model.skew_ppm - 200) < 5
+    assert abs(model.to_host_time(5000 + 1000200) - 1000000) < 5
+    assert abs(model.to_teensy_time(model.to_host_time(10 ** 6)) - 10 ** 6) \
+        < 1e-3
+    assert len(model.residuals) == 32
+
+
+def test_track_drift(emulator_class, wait_for):
+    with emulator_class(skew_ppm=500) as emulator:
+        with pt.Teensy(emulator.devfn) as teensy:
+            model = teensy.track_drift(
+                _cclock, interval=0.02, stamp_events=True
+                )
+            assert wait_for(lambda: len(model) >= 10)
+            teensy.register_line(1)
+            emulator.trigger(1)
+            event = teensy.events.get(timeout=5.0)
+            assert isinstance(event, pt.TeensyStampedLineEvent)
+            assert abs(event.host_time - _cclock()) < 50000
+            teensy.stop_tracking_drift()
+            count = len(model)
+            tm.sleep(0.1)
+            assert len(model) == count
+
+
+def _within(clock, emulator, slack_us=2000):
+    '''Tells whether now() lies between two reads of the emulated clock.'''
+    before = emulator.clock()
+    now = clock.now()
+    after = emulator.clock()
+    error = clock.error_us() + slack_us
+    return before - error <= now <= after + error
+
+
+def test_teensy_clock(emulator, teensy):
+    clock = tc.TeensyClock(teensy, samples=8)
+    assert clock.error_us() >= 0
+    assert _within(clock, emulator)
+    # now() and to_teensy_time() convert with the same parameters.
+    perf_ns = tm.perf_counter_ns()
+    assert abs(clock.to_teensy_time(perf_ns) - clock.now(lambda: perf_ns)) \
+        < 1e-3
+
+
+def test_teensy_clock_skew(emulator_class):
+    with emulator_class(start_us=10 ** 9, skew_ppm=1000) as emulator:
+        with pt.Teensy(emulator.devfn) as teensy:
+            clock = tc.TeensyClock(teensy, samples=16, min_span=0.2)
+            # Before min_span the clocks are assumed to run equally fast.
+            assert "rate = 1.000000000" in str(clock)
+            tm.sleep(0.3)
+            sync = clock.calibrate()
+            assert abs(sync.offset - (emulator.clock() - tc.perf_counter_us())) \
+                < 10000
+            _, _, scale = clock._params
+            assert abs(scale * 1000 - 1.001) < 5e-4
+            assert _within(clock, emulator)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+# This file is part of pyteensy.
+#
+# pyteensy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# pyteensy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with pyteensy.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+'''Tests of TeensyEventStore and of the columnar mode of a Teensy.'''
+
+import pytest
+
+import pyteensy as pt
+
+np = pytest.importorskip("numpy")
+
+
+def test_store_append():
+    store = pt.TeensyEventStore(capacity=2)
+    for i in range(100):
+        store.append(1000 + i, i % 3, i & 1)
+    assert len(store) == 100
+    events = store.events()
+    assert events.dtype == pt.EVENT_DTYPE
+    assert events["timestamp"].tolist() == list(range(1000, 1100))
+    assert events["line"].tolist() == [i % 3 for i in range(100)]
+    event = store[-1]
+    assert (event.timestamp, event.line, event.logiclevel) == (1099, 0, 1)
+    with pytest.raises(IndexError):
+        store[100]
+    assert [event.timestamp for event in store] == list(range(1000, 1100))
+
+
+def test_store_zero_capacity():
+    store = pt.TeensyEventStore(capacity=0)
+    store.append(1, 2, 1)
+    assert len(store) == 1
+
+
+def test_store_extend_frames():
+    frames = np.zeros(5, pt._EVENT_TRIGGER_DTYPE)
+    frames["line"] = [1, 2, 3, 4, 5]
+    frames["timestamp"] = [10, 20, 30, 40, 50]
+    frames["level"] = [0, 1, 7, 0, 1]
+    store = pt.TeensyEventStore(capacity=0)
+    store.extend_frames(frames)
+    store.extend_frames(frames[:2])
+    events = store.drain()
+    assert len(store) == 0
+    assert events["line"].tolist() == [1, 2, 3, 4, 5, 1, 2]
+    assert events["level"].tolist() == [0, 1, 1, 0, 1, 0, 1]
+
+
+def test_columnar_teensy(emulator_class, wait_for):
+    nevents = 5000
+    with emulator_class(rate=50000, burst=50, count=nevents) as emulator:
+        with pt.Teensy(emulator.devfn, columnar=True) as teensy:
+            teensy.register_lines([1, 2])
+            # Commands are answered while the events stream in.
+            times = [teensy.time() for _ in range(20)]
+            assert times == sorted(times)
+            assert wait_for(lambda: len(teensy.event_store) == nevents)
+            assert teensy.events.empty()
+            events = teensy.event_store.drain()
+    assert emulator.dropped == 0
+    assert set(events["line"].tolist()) == {1, 2}
+    assert (np.diff(events["timestamp"].astype(np.int64)) >= 0).all()
+    # The levels of every line alternate, so no frame was lost or split.
+    for line in (1, 2):
+        levels = events["level"][events["line"] == line]
+        assert (levels[1:] != levels[:-1]).all()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+# This file is part of pyteensy.
+#
+# pyteensy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# pyteensy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with pyteensy.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+'''Tests of the commands of a Teensy: pipelining, batches and errors.'''
+
+import time as tm
+
+import pytest
+
+import pyteensy as pt
+
+TIMEOUT = 5.0
+
+
+def test_pipelined_commands(teensy, emulator):
+    futures = [teensy.submit(teensy.TIME) for _ in range(32)]
+    times = [future.result(TIMEOUT) for future in futures]
+    assert times == sorted(times)
+    teensy.time_set(1000000)
+    assert teensy.time() >= 1000000
+    assert emulator.clock() >= 1000000
+
+
+def test_register_and_events(teensy, emulator):
+    teensy.register_lines([1, 2])
+    assert sorted(emulator.lines) == [1, 2]
+    emulator.trigger(2, 1)
+    event = teensy.events.get(timeout=TIMEOUT)
+    assert (event.line, event.logiclevel) == (2, 1)
+    teensy.deregister_inputs([1, 2])
+    assert emulator.lines == {}
+
+
+def test_batch_error(emulator_class):
+    with emulator_class(nlines=4) as emulator:
+        with pt.Teensy(emulator.devfn) as teensy:
+            with pytest.raises(pt.TeensyError) as info:
+                teensy.register_lines([1, 5, 2, 7])
+            assert info.value.int_error == pt.TeensyError.INVALID_TRIGGER_LINE
+            assert info.value.extra == "5, 7"
+            # The valid lines of the batch were registered anyway.
+            assert sorted(emulator.lines) == [1, 2]
+            assert teensy.time() >= 0
+
+
+def test_invalid_lines_are_not_sent(teensy, emulator):
+    with pytest.raises(pt.TeensyError) as info:
+        teensy.register_lines([1, 300])
+    assert info.value.int_error == pt.TeensyError.INVALID_TRIGGER_LINE
+    assert "300" in info.value.extra
+    with pytest.raises(pt.TeensyError):
+        teensy.register_line(-1)
+    with pytest.raises(pt.TeensyError):
+        teensy.register_single_shot("1")
+    assert emulator.lines == {}
+
+
+def test_failed_task_keeps_thread_alive(teensy):
+    # The caller of a failed task gets the error instead of waiting forever
+    # and the thread goes on with the next task.
+    with pytest.raises(ValueError):
+        teensy.time_set(-1)
+    with pytest.raises(Exception):
+        teensy.submit(teensy.TIME_SET, -1).result(TIMEOUT)
+    with pytest.raises(ValueError):
+        teensy.submit(999)
+    with pytest.raises(ValueError):
+        teensy.sync_clock(lambda: tm.monotonic_ns() // 1000, samples=0)
+    assert teensy.time() >= 0
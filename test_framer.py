@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+# This file is part of pyteensy.
+#
+# pyteensy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# pyteensy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with pyteensy.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+'''Tests of the decoding of the frames that a Teensy sends.'''
+
+import pytest
+
+import pyteensy as pt
+
+_EVENT = pt._TeensyPackage._EVENT_TRIGGER
+
+
+def _event_frame(line, timestamp, level):
+    return _EVENT.pack(
+        _EVENT.size, pt._TeensyPackage.EVENT_TRIGGER, line, timestamp, level
+        )
+
+
+def _frames(framer):
+    '''Returns the frames that framer has complete as bytes.'''
+    frames = []
+    while True:
+        offset = framer.next_frame()
+        if offset < 0:
+            return frames
+        frames.append(bytes(framer.buf[offset:offset + framer.buf[offset]]))
+
+
+def test_split_frames():
+    framer = pt._TeensyFramer()
+    frame = _event_frame(3, 123456789, 1)
+    for byte in frame[:-1]:
+        framer.feed(bytes([byte]))
+        assert framer.next_frame() == -1
+    framer.feed(frame[-1:])
+    assert _frames(framer) == [frame]
+    assert len(framer) == 0
+
+
+def test_merged_frames():
+    framer = pt._TeensyFramer()
+    frames = [_event_frame(line, line * 1000, line & 1) for line in range(5)]
+    data = b"".join(frames)
+    # The last frame is cut in two, its tail arrives with the next read.
+    framer.feed(data[:-5])
+    assert _frames(framer) == frames[:-1]
+    assert len(framer) == len(frames[-1]) - 5
+    framer.feed(data[-5:])
+    assert _frames(framer) == frames[-1:]
+
+
+def test_compaction():
+    framer = pt._TeensyFramer(64)
+    frame = _event_frame(1, 1, 1)
+    for _ in range(100):
+        framer.feed(frame[:7])
+        assert _frames(framer) == []
+        framer.feed(frame[7:])
+        assert _frames(framer) == [frame]
+
+
+def test_invalid_size():
+    framer = pt._TeensyFramer()
+    framer.feed(b"\x01\x00")
+    with pytest.raises(pt.TeensyError):
+        framer.next_frame()
+
+
+def test_events_behind_blocking_reply(emulator_class, wait_for):
+    # An event that arrives together with the reply of a blocking exchange
+    # must be dispatched without waiting for the next read.
+    class ChattyEmulator(emulator_class):
+        '''Sends an event right behind every TIME reply.'''
+
+        def _reply(self, buf, offset):
+            super(ChattyEmulator, self)._reply(buf, offset)
+            if buf[offset + 1] == self._PKG.TIME:
+                self._event(3)
+
+    with ChattyEmulator() as emulator:
+        with pt.Teensy(emulator.devfn) as teensy:
+            teensy.time_samples(1)
+            assert wait_for(lambda: teensy.events.qsize() == 1, 1.0)
+            assert teensy.events.get_nowait().line == 3
+            assert len(teensy._framer) == 0
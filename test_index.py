@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+# This file is part of pyteensy.
+#
+# pyteensy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# pyteensy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with pyteensy.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+'''Tests of the time index of teensyindex.'''
+
+import random
+
+import pytest
+
+import pyteensy as pt
+import teensyindex
+
+
+def test_index_queries(random_events):
+    events = random_events(2000, [1, 2, 5])
+    index = teensyindex.TeensyEventIndex()
+    for event in events:
+        index.add_event(event)
+    assert len(index) == len(events)
+    assert index.lines() == [1, 2, 5]
+    rng = random.Random(4)
+    end = events[-1].timestamp
+    for _ in range(200):
+        line = rng.choice([1, 2, 3, 5])
+        t0 = rng.randint(0, end)
+        t1 = t0 + rng.randint(0, end // 10)
+        expected = [
+            event for event in events
+            if event.line == line and t0 <= event.timestamp < t1
+            ]
+        timestamps, levels = index.window(line, t0, t1)
+        assert list(timestamps) == [event.timestamp for event in expected]
+        assert list(levels) == [event.logiclevel for event in expected]
+        assert index.count(line, t0, t1) == len(expected)
+
+        after = [
+            event for event in events
+            if event.line == line and event.timestamp >= t0
+            ]
+        first = index.first_after(line, t0)
+        if after:
+            assert first.timestamp == after[0].timestamp
+        else:
+            assert first is None
+        before = [
+            event for event in events
+            if event.line == line and event.timestamp < t0
+            ]
+        last = index.last_before(line, t0)
+        if before:
+            assert last.timestamp == before[-1].timestamp
+        else:
+            assert last is None
+
+
+def test_index_out_of_order():
+    index = teensyindex.TeensyEventIndex()
+    for timestamp in (30, 10, 20):
+        index.add(timestamp, 1, 1)
+    assert list(index.window(1, 0, 100)[0]) == [10, 20, 30]
+    assert index.first_after(1, 15).timestamp == 20
+
+
+def test_index_epochs(random_events):
+    np = pytest.importorskip("numpy")
+    events = random_events(2000, [1, 2])
+    index = teensyindex.TeensyEventIndex()
+    for event in events:
+        index.add_event(event)
+    onsets = np.array([1000, 50000, 50500, 400000])
+    trial, latency, level = index.epochs(1, onsets, 200, 3000)
+    expected = [
+        (i, event.timestamp - onset, event.logiclevel)
+        for i, onset in enumerate(onsets.tolist())
+        for event in events
+        if event.line == 1 and onset - 200 <= event.timestamp < onset + 3000
+        ]
+    assert list(zip(trial.tolist(), latency.tolist(), level.tolist())) == \
+        expected
+
+
+def test_index_extend(random_events):
+    pytest.importorskip("numpy")
+    events = random_events(500, [1, 2])
+    store = pt.TeensyEventStore()
+    for event in events:
+        store.append(event.timestamp, event.line, event.logiclevel)
+    index = teensyindex.TeensyEventIndex()
+    index.extend(store.events())
+    for line in (1, 2):
+        assert list(index.window(line, 0, 1 << 63)[0]) == [
+            event.timestamp for event in events if event.line == line
+            ]
+
+
+def test_attach(teensy, emulator, wait_for):
+    index = teensyindex.TeensyEventIndex()
+    index.attach(teensy)
+    teensy.register_lines([1, 2])
+    emulator.trigger(1, 1)
+    emulator.trigger(2, 1)
+    emulator.trigger(1, 0)
+    assert wait_for(lambda: len(index) == 3)
+    timestamps, levels = index.window(1, 0, 1 << 63)
+    assert list(levels) == [1, 0]
+    assert list(timestamps) == sorted(timestamps)
+    # The events still reach the queue of the Teensy.
+    assert teensy.events.qsize() == 3
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+# This file is part of pyteensy.
+#
+# pyteensy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# pyteensy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with pyteensy.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+'''Tests of the latency analysis of teensylatency.'''
+
+try:
+    import queue as q
+except ImportError:
+    import Queue as q
+
+import pytest
+
+import pyteensy as pt
+import teensyevents
+
+
+def test_analyze_latency():
+    np = pytest.importorskip("numpy")
+    teensylatency = pytest.importorskip("teensylatency")
+    rng = np.random.default_rng(5)
+    host = np.cumsum(rng.integers(900, 1100, 5000)).astype(np.float64)
+    teensy = 123456.0 + host * (1 + 20e-6) + rng.normal(0, 5, len(host))
+    # A missing and an extra edge.
+    teensy = np.sort(np.append(np.delete(teensy, 2000), teensy[3000] + 400))
+    report = teensylatency.analyze_latency(host, teensy, tolerance_us=200)
+    assert report.nmatched == len(host) - 1
+    assert list(report.missing) == [2000]
+    assert len(report.extra) == 1
+    assert abs(report.drift_ppm - 20) < 1
+    assert report.std < 10
+
+
+def test_given_offset():
+    np = pytest.importorskip("numpy")
+    teensylatency = pytest.importorskip("teensylatency")
+    host = np.arange(0.0, 100000.0, 1000.0)
+    # An edge halfway every interval would match either neighbour without
+    # the offset.
+    report = teensylatency.analyze_latency(
+        host, host + 500.0, tolerance_us=600, offset_us=500.0
+        )
+    assert report.nmatched == len(host)
+    assert abs(report.offset - 500.0) < 1e-6
+    assert report.max_abs < 1e-6
+
+
+def test_no_edges():
+    np = pytest.importorskip("numpy")
+    teensylatency = pytest.importorskip("teensylatency")
+    report = teensylatency.analyze_latency(np.arange(10.0), [])
+    assert report.nmatched == 0
+    assert list(report.missing) == list(range(10))
+    assert report.std == report.mae == report.max_abs == 0.0
+    assert report.histogram_lines() == []
+    assert "matched 0, missing 10, extra 0" in str(report)
+
+
+def test_compare_events(capsys):
+    np = pytest.importorskip("numpy")
+    pytest.importorskip("teensylatency")
+    times = np.arange(1.0, 1.1, 0.001).tolist()
+    events = q.Queue()
+    for time_s in times:
+        events.put(pt.TeensyLineEvent(int(time_s * 1e6) + 250, 2, 1))
+    teensyevents.compare_events(times, events)
+    out = capsys.readouterr().out
+    assert out.startswith("line 2:\n")
+    assert "matched {}, missing 0, extra 0".format(len(times)) in out
+    teensyevents.compare_events(times, events)
+    assert capsys.readouterr().out.startswith("No events were received")
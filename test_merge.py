@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+# This file is part of pyteensy.
+#
+# pyteensy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# pyteensy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with pyteensy.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+'''Tests of the streaming merge of teensymerge.'''
+
+import random
+
+import pyteensy as pt
+import teensymerge
+
+
+class _Offset(object):
+    '''A clock model that adds a constant offset.'''
+
+    def __init__(self, offset):
+        self.offset = offset
+
+    def to_host_time(self, timestamp):
+        return timestamp + self.offset
+
+
+def test_waits_for_all_sources():
+    merger = teensymerge.TeensyMerger(lateness_us=10 ** 6)
+    merger.add_source("a")
+    merger.add_source("b")
+    merger.push("a", pt.TeensyLineEvent(100, 1, 1))
+    merger.push("a", pt.TeensyLineEvent(300, 1, 0))
+    # Nothing is known about b yet, only the lateness bounds the wait.
+    assert merger.watermark() == 300 - 10 ** 6
+    assert merger.pop_ready() == []
+    merger.push("b", pt.TeensyLineEvent(200, 2, 1))
+    assert merger.watermark() == 200
+    ready = merger.pop_ready()
+    assert [(time_us, device) for time_us, device, _ in ready] == \
+        [(100, "a"), (200, "b")]
+    assert [time_us for time_us, _, _ in merger.flush()] == [300]
+
+
+def test_lateness_bounds_the_wait():
+    merger = teensymerge.TeensyMerger(lateness_us=50)
+    merger.add_source("a")
+    merger.add_source("silent")
+    merger.push("a", pt.TeensyLineEvent(100, 1, 1))
+    merger.push("a", pt.TeensyLineEvent(200, 1, 0))
+    assert merger.watermark() == 150
+    assert [time_us for time_us, _, _ in merger.pop_ready()] == [100]
+
+
+def test_clock_advances_watermark():
+    now = [0]
+    merger = teensymerge.TeensyMerger(lateness_us=50, clock=lambda: now[0])
+    merger.add_source("a")
+    merger.add_source("b")
+    merger.push("a", pt.TeensyLineEvent(100, 1, 1))
+    assert merger.pop_ready() == []
+    now[0] = 1000
+    assert merger.watermark() == 950
+    assert len(merger.pop_ready()) == 1
+
+
+def test_late_events():
+    merger = teensymerge.TeensyMerger(lateness_us=10)
+    merger.add_source("a")
+    merger.add_source("b")
+    merger.push("a", pt.TeensyLineEvent(1000, 1, 1))
+    merger.push("b", pt.TeensyLineEvent(1000, 2, 1))
+    assert len(merger.pop_ready()) == 2
+    merger.push("b", pt.TeensyLineEvent(500, 2, 0))
+    assert merger.late == 1
+    assert [time_us for time_us, _, _ in merger.pop_ready()] == [500]
+
+
+def test_order_with_models(random_events):
+    merger = teensymerge.TeensyMerger(lateness_us=10 ** 9)
+    merger.add_source("a", _Offset(0))
+    merger.add_source("b", _Offset(-5000))
+    streams = {
+        "a": random_events(500, [1, 2], seed=1),
+        "b": [
+            pt.TeensyLineEvent(event.timestamp + 5000, 3, event.logiclevel)
+            for event in random_events(500, [3], seed=2)
+            ]
+        }
+    rng = random.Random(3)
+    merged = []
+    positions = {"a": 0, "b": 0}
+    while any(positions[device] < 500 for device in streams):
+        device = rng.choice(
+            [device for device in streams if positions[device] < 500]
+            )
+        merger.push(device, streams[device][positions[device]])
+        positions[device] += 1
+        merged += merger.pop_ready()
+    merged += merger.flush()
+    times = [time_us for time_us, _, _ in merged]
+    assert len(times) == 1000
+    assert times == sorted(times)
+    assert merger.late == 0
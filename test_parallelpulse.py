@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+# This file is part of pyteensy.
+#
+# pyteensy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# pyteensy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with pyteensy.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+'''Tests of the PulseScheduler of parallelpulse, with a toggle that notes
+the time instead of a parallel port.
+'''
+
+import time as tm
+
+import pytest
+
+np = pytest.importorskip("numpy")
+parallelpulse = pytest.importorskip("parallelpulse")
+
+
+class _Toggle(object):
+    '''Stands in for a TogglePort.'''
+
+    def __init__(self):
+        self.times_ns = []
+
+    def toggle(self):
+        self.times_ns.append(tm.perf_counter_ns())
+
+
+def _deadlines(count, interval_ms, delay_ms=20):
+    start = tm.perf_counter_ns() + delay_ms * 10 ** 6
+    return start + np.arange(count, dtype=np.int64) * interval_ms * 10 ** 6
+
+
+def test_deadlines():
+    toggle = _Toggle()
+    scheduler = parallelpulse.PulseScheduler(toggle.toggle)
+    deadlines = _deadlines(20, 5)
+    times, lateness = scheduler.run(deadlines)
+    assert len(toggle.times_ns) == len(times) == 20
+    # No toggle comes early and every time is noted just before its toggle.
+    assert (times >= deadlines).all()
+    assert (lateness == times - deadlines).all()
+    assert (times <= np.array(toggle.times_ns)).all()
+    p50, p99, worst = scheduler.lateness_us()
+    assert 0 <= p50 <= p99 <= worst
+    # The last part of the wait is spun, a generous bound for a busy host.
+    assert p50 < 2000
+
+
+def test_stop():
+    toggle = _Toggle()
+    scheduler = parallelpulse.PulseScheduler(toggle.toggle)
+    scheduler.start(_deadlines(10, 1000, delay_ms=0))
+    with pytest.raises(RuntimeError):
+        scheduler.start(_deadlines(1, 1))
+    tm.sleep(0.1)
+    scheduler.stop()
+    assert len(toggle.times_ns) == len(scheduler.times_ns) == 1
+    assert len(scheduler.lateness_ns) == 1
+    # A stopped scheduler can start again.
+    scheduler.run(_deadlines(2, 1))
+    assert len(toggle.times_ns) == 3
+
+
+def test_no_toggles():
+    scheduler = parallelpulse.PulseScheduler(_Toggle().toggle)
+    assert list(scheduler.lateness_us()) == [0.0, 0.0, 0.0]
+    times, lateness = scheduler.run([])
+    assert len(times) == len(lateness) == 0
+
+
+def test_pulse_train():
+    toggle = _Toggle()
+    scheduler = parallelpulse.PulseScheduler(toggle.toggle)
+    start = tm.perf_counter()
+    times = parallelpulse.pulse_train(
+        toggle, number=10, jitter=(0.001, 0.003), scheduler=scheduler
+        )
+    assert len(times) == len(toggle.times_ns) == 10
+    assert times == sorted(times)
+    assert start < times[0] and times[-1] - start < 1.0
+    assert len(scheduler.lateness_ns) == 10
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+# This file is part of pyteensy.
+#
+# pyteensy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# pyteensy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with pyteensy.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+'''Tests of TeensyPool against several emulators.'''
+
+import os
+
+import pytest
+
+import pyteensy as pt
+
+teensypool = pytest.importorskip("teensypool")
+
+TIMEOUT = 5.0
+
+
+@pytest.fixture
+def pool():
+    with teensypool.TeensyPool() as pool:
+        yield pool
+
+
+def test_add_and_remove(pool, emulator_class):
+    with emulator_class() as left_emu, emulator_class() as right_emu:
+        left = pool.add(left_emu.devfn, "left")
+        right = pool.add(right_emu.devfn, "right", unix=True)
+        assert isinstance(right, teensypool.PooledUnixTeensy)
+        with pytest.raises(ValueError):
+            pool.add(left_emu.devfn, "left")
+        left.register_line(1)
+        right.register_lines([1, 2])
+        assert sorted(right_emu.lines) == [1, 2]
+        left_emu.trigger(1, 1)
+        right_emu.trigger(2, 0)
+        received = sorted(
+            (device_id, event.line, event.logiclevel)
+            for device_id, event in (
+                pool.events.get(timeout=TIMEOUT) for _ in range(2)
+                )
+            )
+        assert received == [("left", 1, 1), ("right", 2, 0)]
+
+        pool.remove("left")
+        assert list(pool.devices) == ["right"]
+        assert not left.connected
+        # The other device is still served.
+        assert right.time() >= 0
+        right_emu.trigger(1)
+        assert pool.events.get(timeout=TIMEOUT)[0] == "right"
+
+
+def test_failed_device_is_released(pool, emulator_class):
+    with emulator_class() as good_emu:
+        good = pool.add(good_emu.devfn, "good")
+        emulator = emulator_class()
+        failing = pool.add(emulator.devfn, "failing", unix=True)
+        fd = failing._serial
+        # The pseudo terminal hangs up.
+        emulator.close()
+        with pytest.raises(pt.TeensyError):
+            for _ in range(100):
+                failing.submit(failing.TIME).result(TIMEOUT)
+        assert not failing.connected
+        pool.remove("failing")
+        with pytest.raises(OSError):
+            os.fstat(fd)
+        assert good.time() >= 0
+
+
+def test_control_task_error(pool, emulator):
+    teensy = pool.add(emulator.devfn)
+
+    def fail(teensy):
+        raise RuntimeError("unable to serve")
+
+    with pytest.raises(RuntimeError):
+        pool._control_task(fail, teensy, pt.TeensyError.UNABLE_TO_CONNECT)
+    # The thread of the pool survived.
+    assert teensy.time() >= 0
+    pool.remove(emulator.devfn)
+    assert not pool.devices
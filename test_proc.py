@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+# This file is part of pyteensy.
+#
+# pyteensy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# pyteensy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with pyteensy.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+'''Tests of the event ring of teensyproc and of ProcessTeensy.'''
+
+try:
+    import queue as q
+except ImportError:
+    import Queue as q
+
+import pytest
+
+import pyteensy as pt
+import teensyclock as tc
+import teensyproc
+
+TIMEOUT = 5.0
+
+
+@pytest.fixture
+def ring():
+    ring = teensyproc.TeensyEventRing(capacity=4)
+    yield ring
+    ring.close()
+
+
+def _publish(ring, first, count):
+    for timestamp in range(first, first + count):
+        ring.publish(pt.TeensyLineEvent(timestamp, 1, timestamp & 1))
+
+
+def test_ring_read(ring):
+    reader = teensyproc.TeensyRingReader(ring)
+    _publish(ring, 0, 3)
+    assert reader.available() == 3
+    assert [event.timestamp for event in reader.read(2)] == [0, 1]
+    assert [event.timestamp for event in reader.read()] == [2]
+    assert reader.read() == []
+    assert reader.lost == 0
+
+
+def test_ring_overrun(ring):
+    reader = teensyproc.TeensyRingReader(ring)
+    late_reader = teensyproc.TeensyRingReader(ring)
+    _publish(ring, 0, 3)
+    assert len(reader.read()) == 3
+    _publish(ring, 3, 7)
+    assert reader.available() == 4
+    assert [event.timestamp for event in reader.read()] == [6, 7, 8, 9]
+    assert reader.lost == 3
+    # Every reader has a cursor of its own.
+    assert [event.timestamp for event in late_reader.read()] == [6, 7, 8, 9]
+    assert late_reader.lost == 6
+
+
+def test_ring_arrays(ring):
+    np = pytest.importorskip("numpy")
+    reader = teensyproc.TeensyRingReader(ring)
+    frames = np.zeros(7, pt._EVENT_TRIGGER_DTYPE)
+    frames["timestamp"] = np.arange(7)
+    frames["line"] = 2
+    frames["level"] = [0, 1] * 3 + [0]
+    ring.publish_frames(frames[:3])
+    assert reader.read_array()["timestamp"].tolist() == [0, 1, 2]
+    # The run wraps around the end of the ring, its oldest frames are lost.
+    ring.publish_frames(frames)
+    records = reader.read_array()
+    assert records["timestamp"].tolist() == [3, 4, 5, 6]
+    assert records["logiclevel"].tolist() == [1, 0, 1, 0]
+    assert reader.lost == 3
+
+
+def test_attach_by_name(ring):
+    other = teensyproc.TeensyEventRing(name=ring.name)
+    reader = teensyproc.TeensyRingReader(other)
+    _publish(ring, 0, 2)
+    assert [event.timestamp for event in reader.read()] == [0, 1]
+    assert other.capacity == 4
+    other.close()
+
+
+@pytest.mark.parametrize("unix", [False, True])
+def test_process_teensy(emulator, unix):
+    with teensyproc.ProcessTeensy(emulator.devfn, unix=unix) as teensy:
+        assert teensy.connected
+        teensy.register_lines([1, 2])
+        assert sorted(emulator.lines) == [1, 2]
+        with pytest.raises(pt.TeensyError):
+            teensy.register_line(300)
+        teensy.time_set(10 ** 6)
+        assert teensy.time() >= 10 ** 6
+        result = teensy.sync_clock(tc.perf_counter_us, samples=4)
+        assert teensy.clock_sync.offset == result.offset
+        assert teensy.rtt_stats()["time"]["count"] >= 9
+        with pytest.raises(AttributeError):
+            teensy.track_drift
+        emulator.trigger(2, 1)
+        event = teensy.events.get(timeout=TIMEOUT)
+        assert (event.line, event.logiclevel) == (2, 1)
+        with pytest.raises(q.Empty):
+            teensy.events.get(timeout=0.01)
+    assert not teensy.connected
+    with pytest.raises(pt.TeensyError):
+        teensy.time()
+
+
+def test_process_teensy_overrun(emulator_class, wait_for):
+    nevents = 200
+    with emulator_class(rate=10 ** 5, burst=100, count=nevents) as emulator:
+        with teensyproc.ProcessTeensy(
+                emulator.devfn, unix=True, capacity=16
+                ) as teensy:
+            teensy.register_line(1)
+            assert wait_for(lambda: teensy._ring.write_cursor() == nevents)
+            received = []
+            while True:
+                try:
+                    received.append(teensy.events.get_nowait().timestamp)
+                except q.Empty:
+                    break
+            assert len(received) == 16
+            assert received == sorted(received)
+            assert teensy.events.lost == nevents - 16
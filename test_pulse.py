@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+# This file is part of pyteensy.
+#
+# pyteensy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# pyteensy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with pyteensy.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+'''Tests of the pairing of edges into pulses of teensypulse.'''
+
+import threading
+
+import pytest
+
+import pyteensy as pt
+import teensypulse
+
+
+def test_pulse_pairer():
+    pairer = teensypulse.TeensyPulsePairer(single_shots=[4])
+    stream = [
+        pt.TeensyLineEvent(10, 1, 1),
+        pt.TeensyLineEvent(15, 2, 0),   # an offset without an onset
+        pt.TeensyLineEvent(20, 1, 0),
+        pt.TeensyLineEvent(25, 4, 1),
+        pt.TeensyLineEvent(30, 1, 1),
+        pt.TeensyLineEvent(40, 1, 1),   # the offset of 30 was missed
+        pt.TeensyLineEvent(45, 1, 0),
+        pt.TeensyLineEvent(50, 2, 1),
+        ]
+    pulses = list(teensypulse.pair_events(stream, pairer))
+    assert [(p.line, p.onset, p.offset, p.duration) for p in pulses] == [
+        (1, 10, 20, 10),
+        (4, 25, None, None),
+        (1, 40, 45, 5),
+        ]
+    assert pairer.unpaired == 2
+    open_pulses = pairer.flush()
+    assert [(p.line, p.onset, p.offset) for p in open_pulses] == \
+        [(2, 50, None)]
+
+
+def test_pair_edges_matches_pairer(random_events):
+    np = pytest.importorskip("numpy")
+    events = random_events(3000, [1, 2, 3, 7])
+    # Missed edges.
+    del events[100], events[1000], events[2000]
+    pairer = teensypulse.TeensyPulsePairer(single_shots=[7])
+    expected = sorted(
+        (pulse.line, pulse.onset,
+         pulse.offset if pulse.offset is not None else 0,
+         pulse.duration if pulse.duration is not None else -1,
+         pulse.level)
+        for pulse in teensypulse.pair_events(events, pairer)
+        )
+    pulses = teensypulse.pair_edges(
+        np.array([event.line for event in events]),
+        np.array([event.timestamp for event in events], np.uint64),
+        np.array([event.logiclevel for event in events]),
+        single_shots=[7]
+        )
+    assert pulses.dtype == teensypulse.PULSE_DTYPE
+    assert [tuple(pulse) for pulse in pulses.tolist()] == expected
+
+
+def test_pair_queue(teensy, emulator):
+    stop = threading.Event()
+    pairer = teensypulse.TeensyPulsePairer()
+    pulses = teensypulse.pair_events(teensy.events, pairer, stop)
+    teensy.register_line(3)
+    emulator.trigger(3, 1)
+    emulator.trigger(3, 0)
+    pulse = next(pulses)
+    assert (pulse.line, pulse.level) == (3, 1)
+    assert pulse.duration == pulse.offset - pulse.onset >= 0
+    # The generator ends once stop is set.
+    stop.set()
+    assert list(pulses) == []
+    assert pairer.flush() == []
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+# This file is part of pyteensy.
+#
+# pyteensy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# pyteensy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with pyteensy.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+'''Tests of the overflow policies of TeensyEventQueue.'''
+
+import time as tm
+
+try:
+    import queue as q
+except ImportError:
+    import Queue as q
+
+import pytest
+
+import pyteensy as pt
+
+
+def test_drop_oldest():
+    events = pt.TeensyEventQueue(3, pt.TeensyEventQueue.DROP_OLDEST)
+    for i in range(5):
+        events.put(i)
+    assert [events.get_nowait() for _ in range(3)] == [2, 3, 4]
+    assert events.dropped == 2
+
+
+def test_drop_newest():
+    events = pt.TeensyEventQueue(3, pt.TeensyEventQueue.DROP_NEWEST)
+    for i in range(5):
+        events.put(i)
+    assert [events.get_nowait() for _ in range(3)] == [0, 1, 2]
+    assert events.dropped == 2
+
+
+def test_spill():
+    events = pt.TeensyEventQueue(3, pt.TeensyEventQueue.SPILL)
+    for i in range(10):
+        events.put(pt.TeensyLineEvent(i, 1, i & 1))
+    assert events.spilled == 7
+    # The spilled events count as queued.
+    assert events.qsize() == 10
+    events.put(pt.TeensyLineEvent(10, 1, 0))
+    timestamps = []
+    while not events.empty():
+        timestamps.append(events.get_nowait().timestamp)
+    assert timestamps == list(range(11))
+    assert events.dropped == 0
+
+
+def test_block():
+    events = pt.TeensyEventQueue(2, pt.TeensyEventQueue.BLOCK)
+    events.put(0)
+    events.put(1)
+    with pytest.raises(q.Full):
+        events.put(2, timeout=0.01)
+    with pytest.raises(q.Full):
+        events.put(2, block=False)
+    events.close()
+    # A closed queue drops what doesn't fit instead of waiting.
+    events.put(2)
+    assert events.dropped == 1
+    assert [events.get_nowait(), events.get_nowait()] == [0, 1]
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        pt.TeensyEventQueue(3, "overwrite")
+
+
+def test_close_under_block(emulator_class, wait_for):
+    with emulator_class(rate=10000, burst=10) as emulator:
+        teensy = pt.Teensy(emulator.devfn, queue_size=10, overflow="block")
+        teensy.register_line(1)
+        assert wait_for(teensy.events.full)
+        start = tm.monotonic()
+        teensy.close()
+        assert tm.monotonic() - start < 1.0
+        assert not teensy._thread.is_alive()
+
+
+@pytest.mark.parametrize("policy", pt.TeensyEventQueue.POLICIES)
+def test_full(policy):
+    events = pt.TeensyEventQueue(2, policy)
+    assert events.maxsize == 2
+    events.put(0)
+    assert not events.full()
+    events.put(1)
+    assert events.full()
+    events.get_nowait()
+    assert not events.full()
+    assert not pt.TeensyEventQueue(0, policy).full()
+
+
+@pytest.mark.parametrize("policy", pt.TeensyEventQueue.POLICIES[1:])
+def test_put_nowait_never_raises(policy):
+    events = pt.TeensyEventQueue(1, policy)
+    for i in range(3):
+        events.put_nowait(i)
+    assert events.dropped + events.spilled == 2
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+# This file is part of pyteensy.
+#
+# pyteensy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# pyteensy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with pyteensy.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+'''Tests of the session files of teensyrecord.'''
+
+import time as tm
+
+import pytest
+
+import pyteensy as pt
+import teensyrecord as tr
+
+np = pytest.importorskip("numpy")
+
+
+def _check_session(filename, nevents):
+    '''Checks the records of a session with nevents events on lines 1 and 2
+    and returns its metadata.
+    '''
+    with tr.read_session(filename) as session:
+        assert len(session) == nevents
+        assert set(session.line.tolist()) == {1, 2}
+        timestamps = session.timestamp.astype(np.int64)
+        assert (np.diff(timestamps) >= 0).all()
+        assert (np.diff(session.host_ns.astype(np.int64)) >= 0).all()
+        for line in (1, 2):
+            levels = session.level[session.line == line]
+            assert (levels[1:] != levels[:-1]).all()
+        metadata = session.metadata
+        del timestamps, levels
+    return metadata
+
+
+@pytest.mark.parametrize("columnar", [False, True])
+def test_round_trip(tmp_path, emulator_class, wait_for, columnar):
+    filename = str(tmp_path / "session.pyteensy")
+    nevents = 3000
+    recorder = tr.TeensyRecorder(
+        filename, metadata={"subject": 7}, batch_size=256
+        )
+    with emulator_class(rate=30000, burst=30, count=nevents) as emulator:
+        with pt.Teensy(
+                emulator.devfn, columnar=columnar, recorder=recorder
+                ) as teensy:
+            teensy.register_lines([1, 2])
+            teensy.sync_clock(lambda: tm.monotonic_ns() // 1000, samples=4)
+            if columnar:
+                assert wait_for(lambda: len(teensy.event_store) == nevents)
+            else:
+                assert wait_for(lambda: teensy.events.qsize() == nevents)
+    # Closing the Teensy wrote the buffered records.
+    assert recorder.nrecords == nevents
+    recorder.close()
+    metadata = _check_session(filename, nevents)
+    assert metadata["subject"] == 7
+    assert metadata["device"] == emulator.devfn
+    assert metadata["clock_sync"]["applied"]
+
+
+def test_flush_interval(tmp_path, emulator, wait_for):
+    filename = str(tmp_path / "session.pyteensy")
+    recorder = tr.TeensyRecorder(filename, flush_interval=0.01)
+    with pt.Teensy(emulator.devfn, recorder=recorder) as teensy:
+        teensy.register_line(1)
+        emulator.trigger(1)
+        # The worker writes the record although no more events arrive.
+        assert wait_for(lambda: recorder.nrecords == 1)
+        with tr.read_session(filename) as session:
+            assert len(session) == 1
+    recorder.close()
+
+
+def test_metadata_after_close(tmp_path, emulator):
+    filename = str(tmp_path / "session.pyteensy")
+    recorder = tr.TeensyRecorder(filename)
+    with pt.Teensy(emulator.devfn, recorder=recorder) as teensy:
+        recorder.close()
+        result = teensy.sync_clock(lambda: tm.monotonic_ns() // 1000)
+    assert recorder.metadata["clock_sync"]["offset_us"] == result.offset
+    with tr.read_session(filename) as session:
+        assert "clock_sync" not in session.metadata
+
+
+def test_not_a_session(tmp_path):
+    filename = tmp_path / "other"
+    filename.write_bytes(b"x" * tr.HEADER_SIZE)
+    with pytest.raises(ValueError):
+        tr.read_session(str(filename))
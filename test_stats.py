@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+# This file is part of pyteensy.
+#
+# pyteensy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# pyteensy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with pyteensy.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+'''Tests of the instrumentation of a Teensy.'''
+
+import time as tm
+
+import pytest
+
+import pyteensy as pt
+
+
+def test_histogram():
+    histogram = pt.TeensyHistogram()
+    for value in range(1, 101):
+        histogram.add(value)
+    snapshot = histogram.snapshot()
+    assert snapshot["count"] == 100
+    assert snapshot["mean"] == 50.5
+    assert snapshot["max"] == 100
+    # The percentiles are the upper bounds of the power of two buckets.
+    assert snapshot["p50"] == 63
+    assert snapshot["p99"] == 100
+    assert sum(snapshot["buckets"]) == 100
+
+
+@pytest.mark.parametrize("cls", ["Teensy", "UnixTeensy"])
+def test_stats(emulator_class, wait_for, cls):
+    nevents = 500
+    with emulator_class(rate=20000, burst=20, count=nevents) as emulator:
+        with getattr(pt, cls)(emulator.devfn, instrument=True) as teensy:
+            teensy.register_line(1)
+            assert wait_for(lambda: teensy.events.qsize() == nevents)
+            teensy.sync_clock(lambda: tm.monotonic_ns() // 1000, samples=4)
+            stats = teensy.stats(reset=True)
+            assert stats["events"] == nevents
+            assert stats["frames"] >= nevents + stats["replies"]
+            assert stats["bytes_read"] >= nevents * 12
+            assert stats["reads"] > 0
+            assert stats["frames_per_read"]["count"] > 0
+            assert stats["handle_event_ns"]["count"] == nevents
+            assert stats["queue_high_water"] >= 1
+            assert len(stats["syncs"]) == 1
+            assert stats["command_rtt_us"]["time"]["count"] >= 8
+            # The statistics started over.
+            stats = teensy.stats()
+            assert stats["events"] == 0
+            assert stats["syncs"] == []
+            assert stats["command_rtt_us"]["time"]["count"] == 0
+
+
+def test_report_stats(emulator, wait_for):
+    reports = []
+    with pt.Teensy(emulator.devfn, instrument=True) as teensy:
+        teensy.report_stats(reports.append, interval=0.01)
+        assert wait_for(lambda: len(reports) >= 3)
+        assert "bytes_read" in reports[-1]
+        teensy.report_stats(None)
+        count = len(reports)
+        tm.sleep(0.05)
+        assert len(reports) == count
+
+
+def test_not_instrumented(emulator):
+    with pt.Teensy(emulator.devfn) as teensy:
+        assert teensy.stats() is None
+        with pytest.raises(ValueError):
+            teensy.report_stats(print)
+
+
+def test_rtt_stats(teensy):
+    for _ in range(10):
+        teensy.time()
+    teensy.register_line(1)
+    stats = teensy.rtt_stats(reset=True)
+    assert stats["time"]["count"] == 10
+    assert stats["register_input"]["count"] == 1
+    assert stats["time_set"]["count"] == 0
+    assert teensy.rtt_stats()["time"]["count"] == 0
+
+
+def test_stamped_time(emulator, teensy):
+    host_send, teensy_us, host_recv = teensy.time(stamped=True)
+    assert host_send <= host_recv <= tm.perf_counter_ns()
+    assert abs(teensy_us - emulator.clock()) < 10 ** 6
+    host_send, teensy_us, host_recv = teensy.time_samples(5)
+    assert len(host_send) == len(teensy_us) == len(host_recv) == 5
+    assert list(teensy_us) == sorted(teensy_us)
+    assert all(send <= recv for send, recv in zip(host_send, host_recv))
+    assert all(
+        recv <= send for recv, send in zip(host_recv[:-1], host_send[1:])
+        )
+    assert teensy.rtt_stats()["time"]["count"] == 6
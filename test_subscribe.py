@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+# This file is part of pyteensy.
+#
+# pyteensy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# pyteensy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with pyteensy.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+'''Tests of the per line subscriptions of a Teensy.'''
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import pyteensy as pt
+
+
+@pytest.fixture(params=["inline", "thread", "executor"])
+def executor(request):
+    if request.param == "inline":
+        yield None
+    elif request.param == "thread":
+        yield "thread"
+    else:
+        with ThreadPoolExecutor(1) as pool:
+            yield pool
+
+
+def test_subscribe(emulator, executor, wait_for):
+    calls = []
+    rising = []
+    with pt.Teensy(emulator.devfn, executor=executor) as teensy:
+        def callback(event):
+            calls.append((event.timestamp, threading.get_ident()))
+
+        subscription = teensy.subscribe(4, callback)
+        rising_subscription = teensy.subscribe(
+            4, lambda event: rising.append(event.logiclevel), level=1
+            )
+        assert teensy.subscriptions() == [subscription, rising_subscription]
+        teensy.register_lines([4, 5])
+        for _ in range(10):
+            emulator.trigger(4)
+            emulator.trigger(5)
+        assert wait_for(lambda: len(calls) == 10)
+        assert wait_for(lambda: len(rising) == 5)
+        assert rising == [1] * 5
+        # Events are still queued as well.
+        assert wait_for(lambda: teensy.events.qsize() == 20)
+
+        teensy.unsubscribe(subscription)
+        assert teensy.subscriptions() == [rising_subscription]
+        emulator.trigger(4)
+        emulator.trigger(4)
+        assert wait_for(lambda: len(rising) == 6)
+        worker = teensy._thread.ident
+    assert len(calls) == 10
+    assert subscription.calls == 10
+    # The callbacks are called in order.
+    timestamps = [timestamp for timestamp, _ in calls]
+    assert timestamps == sorted(timestamps)
+    threads = set(thread for _, thread in calls)
+    if executor is None:
+        assert threads == {worker}
+    else:
+        assert worker not in threads
+
+
+def test_failing_callback(emulator, wait_for):
+    def fail(event):
+        raise RuntimeError("callback failed")
+
+    with pt.Teensy(emulator.devfn) as teensy:
+        subscription = teensy.subscribe(2, fail)
+        teensy.register_line(2)
+        emulator.trigger(2)
+        emulator.trigger(2)
+        assert wait_for(lambda: subscription.calls == 2)
+        assert subscription.errors == 2
+        # The thread survived the exceptions.
+        assert teensy.time() >= 0
+
+
+def test_subscribe_invalid_line(emulator):
+    with pt.Teensy(emulator.devfn) as teensy:
+        with pytest.raises(pt.TeensyError):
+            teensy.subscribe(256, print)
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+# This file is part of pyteensy.
+#
+# pyteensy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# pyteensy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with pyteensy.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+'''Tests of the output of the teensyevents program.'''
+
+import io
+import json
+import threading
+
+try:
+    import queue as q
+except ImportError:
+    import Queue as q
+
+import pytest
+
+import pyteensy as pt
+import teensyevents
+
+_EVENTS = [
+    pt.TeensyLineEvent(1000, 1, 1),
+    pt.TeensyLineEvent(2 ** 40, 255, 0),
+    pt.TeensyLineEvent(2 ** 64 - 1, 0, 1),
+    ]
+
+
+def _parse(fmt, data):
+    '''Returns the events in data as tuples (timestamp, line, level).'''
+    if fmt == teensyevents.EventWriter.TSV:
+        return [
+            tuple(int(field) for field in line.split(b"\t"))
+            for line in data.splitlines()
+            ]
+    if fmt == teensyevents.EventWriter.NDJSON:
+        return [
+            (event["timestamp"], event["line"], event["logiclevel"])
+            for event in map(json.loads, data.splitlines())
+            ]
+    frame = pt._TeensyPackage._EVENT_TRIGGER
+    events = []
+    for offset in range(0, len(data), frame.size):
+        size, pkgtype, line, timestamp, level = frame.unpack_from(
+            data, offset
+            )
+        assert (size, pkgtype) == (frame.size, pt._TeensyPackage.EVENT_TRIGGER)
+        events.append((timestamp, line, level))
+    return events
+
+
+@pytest.mark.parametrize("fmt", teensyevents.EventWriter.FORMATS)
+def test_formats(fmt):
+    out = io.BytesIO()
+    writer = teensyevents.EventWriter(out, fmt, flush_events=100)
+    writer.write(_EVENTS)
+    # Nothing is written before the batch is full or flushed.
+    assert out.getvalue() == b""
+    writer.flush()
+    assert _parse(fmt, out.getvalue()) == [
+        (event.timestamp, event.line, event.logiclevel) for event in _EVENTS
+        ]
+    assert writer.nevents == 3
+
+
+def test_flush_events():
+    out = io.BytesIO()
+    writer = teensyevents.EventWriter(out, flush_events=2)
+    writer.write(_EVENTS[:1])
+    assert out.getvalue() == b""
+    writer.write(_EVENTS[1:2])
+    assert len(out.getvalue().splitlines()) == 2
+
+
+def test_flush_ms():
+    out = io.BytesIO()
+    writer = teensyevents.EventWriter(out, flush_ms=0.0)
+    assert writer.timeout() is None
+    writer.write(_EVENTS)
+    assert writer.timeout() == 0.0
+    writer.poll()
+    assert len(out.getvalue().splitlines()) == 3
+    assert writer.timeout() is None
+
+
+def test_unknown_format():
+    with pytest.raises(ValueError):
+        teensyevents.EventWriter(io.BytesIO(), "csv")
+
+
+class _Source(object):
+    '''Stands in for a Teensy, its queue raises KeyboardInterrupt at the
+    get with index interrupt, as Ctrl+C would.
+    '''
+
+    class _Queue(q.Queue):
+
+        def __init__(self, interrupt):
+            q.Queue.__init__(self)
+            self.interrupt = interrupt
+            self.gets = 0
+
+        def get(self, block=True, timeout=None):
+            self.gets += 1
+            if self.gets == self.interrupt:
+                raise KeyboardInterrupt
+            return q.Queue.get(self, block, timeout)
+
+    def __init__(self, nevents, interrupt):
+        self.events = self._Queue(interrupt)
+        for i in range(nevents):
+            self.events.put(pt.TeensyLineEvent(i, 1, i & 1))
+
+
+def test_stream_interrupted():
+    out = io.BytesIO()
+    writer = teensyevents.EventWriter(out, flush_events=64, flush_ms=10000)
+    source = _Source(200, interrupt=100)
+    teensyevents.stream_events(source, writer, threading.Event())
+    timestamps = [event[0] for event in _parse("tsv", out.getvalue())]
+    assert timestamps == list(range(200))
+
+
+def test_stream(emulator_class, wait_for):
+    nevents = 2000
+    out = io.BytesIO()
+    writer = teensyevents.EventWriter(out, "binary", flush_events=128)
+    stop = threading.Event()
+    with emulator_class(rate=20000, burst=20, count=nevents) as emulator:
+        with pt.Teensy(emulator.devfn) as teensy:
+            thread = threading.Thread(
+                target=teensyevents.stream_events, args=(teensy, writer, stop)
+                )
+            thread.start()
+            teensy.register_lines([1, 2])
+            assert wait_for(lambda: emulator.nevents == nevents)
+            assert wait_for(lambda: writer.nevents == nevents)
+            stop.set()
+            thread.join()
+    events = _parse("binary", out.getvalue())
+    assert len(events) == nevents
+    assert [event[0] for event in events] == sorted(
+        event[0] for event in events
+        )